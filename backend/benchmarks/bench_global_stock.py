@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark: global stock upload processing, previous iterrows loops vs vectorized frames.
+
+Covers everything upload_global_stock does between parsing the sheet and
+writing to Mongo: the {product: {store: stock}} dict and the stock_history
+documents for every matched store.
+
+Usage (from backend/):
+    python benchmarks/bench_global_stock.py [products] [stores]
+"""
+
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from services.global_stock import history_frame, stock_data, stock_history_documents, stock_matrix  # noqa: E402
+
+
+def process_with_iterrows(df, store_map, prev_stocks_map, recorded_at):
+    """What upload_global_stock did before"""
+    product_col = df.columns[0]
+    store_columns = list(df.columns[1:])
+    
+    data = {}
+    for _, row in df.iterrows():
+        product = str(row[product_col]).strip()
+        if not product or product == 'nan':
+            continue
+        product_data = {}
+        for store_col in store_columns:
+            stock = row[store_col]
+            if pd.notna(stock):
+                try:
+                    product_data[str(store_col)] = float(stock)
+                except Exception:
+                    product_data[str(store_col)] = 0
+            else:
+                product_data[str(store_col)] = 0
+        data[product] = product_data
+    
+    history_entries = []
+    for product, store_stocks in data.items():
+        for store_name in [col for col in store_columns if col in store_map]:
+            store_id = store_map[store_name]
+            stock = store_stocks.get(store_name, 0)
+            prev_stock = prev_stocks_map.get((store_id, product), 0)
+            history_entries.append({
+                "id": str(uuid.uuid4()),
+                "store_id": store_id,
+                "store_name": store_name,
+                "product": product,
+                "stock": stock,
+                "prev_stock": prev_stock,
+                "change": stock - prev_stock,
+                "recorded_at": recorded_at
+            })
+    return data, history_entries
+
+
+def process_vectorized(df, store_map, prev_stocks_map, recorded_at):
+    stock = stock_matrix(df)
+    return stock_data(stock), stock_history_documents(history_frame(stock, store_map, prev_stocks_map), recorded_at)
+
+
+def best_of(runs, func, *args):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    stores = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    
+    rng = np.random.default_rng(0)
+    store_names = [f"Точка {i}" for i in range(stores)]
+    df = pd.DataFrame(rng.integers(0, 50, size=(products, stores)), columns=store_names)
+    df.insert(0, "Товар", [f"Табак для кальяна Товар {i} 50 г" for i in range(products)])
+    
+    store_map = {name: f"store-{i}" for i, name in enumerate(store_names)}
+    prev_stocks_map = {
+        (store_id, f"Табак для кальяна Товар {i} 50 г"): 10
+        for store_id in store_map.values() for i in range(0, products, 2)
+    }
+    
+    print(f"{products} products x {stores} stores = {products * stores} history entries")
+    print(f"{'path':<12} | {'seconds':>8}")
+    for label, func in [("iterrows", process_with_iterrows), ("vectorized", process_vectorized)]:
+        elapsed = best_of(3, func, df, store_map, prev_stocks_map, "2024-01-01T00:00:00+00:00")
+        print(f"{label:<12} | {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark: upload parsing, previous in-memory pd.read_excel path vs spooled streaming ingest.
+
+Builds a global stock sheet (products x stores, 200k cells by default) and
+compares wall time and peak traced memory.
+
+Usage (from backend/):
+    python benchmarks/bench_ingest.py [products] [stores]
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from services.ingest import read_table  # noqa: E402
+
+
+def read_in_memory(path):
+    """What upload_global_stock did before: whole upload in memory, then pandas"""
+    with open(path, "rb") as handle:
+        contents = handle.read()
+    return pd.read_excel(io.BytesIO(contents))
+
+
+def measure(func, *args):
+    """Wall time of a plain run, then peak traced allocations of a second run"""
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1024 * 1024)
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    stores = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.integers(0, 50, size=(products, stores)), columns=[f"Точка {i}" for i in range(stores)])
+    df.insert(0, "Товар", [f"Табак для кальяна Товар {i} 50 г" for i in range(products)])
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx_path = os.path.join(tmp, "stock.xlsx")
+        csv_path = os.path.join(tmp, "stock.csv")
+        df.to_excel(xlsx_path, index=False)
+        df.to_csv(csv_path, index=False, sep=";")
+        
+        print(f"{products} products x {stores} stores = {products * stores} cells")
+        print(f"{'path':<28} | {'seconds':>8} | {'peak MiB':>8}")
+        for label, func, path in [
+            ("pd.read_excel(BytesIO) xlsx", read_in_memory, xlsx_path),
+            ("read_table xlsx", read_table, xlsx_path),
+            ("read_table csv", read_table, csv_path),
+        ]:
+            elapsed, peak = measure(func, path)
+            print(f"{label:<28} | {elapsed:>8.2f} | {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark: order workbook rendering, previous pandas/openpyxl path vs streaming writer.
+
+Usage (from backend/):
+    python benchmarks/bench_order_workbook.py [rows ...]
+"""
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import pandas as pd  # noqa: E402
+from openpyxl.styles import Font  # noqa: E402
+
+from services.order_pipeline import iter_order_workbook  # noqa: E402
+
+
+def render_with_openpyxl(store_name, products, orders):
+    """The rendering path routes/orders.py used before the streaming writer"""
+    output_df = pd.DataFrame([
+        {store_name: product, 'Заказ': int(order)}
+        for product, order in zip(products, orders)
+    ])
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        output_df.to_excel(writer, index=False, sheet_name='Заказ')
+        worksheet = writer.sheets['Заказ']
+        bold_font = Font(bold=True)
+        for row in worksheet.iter_rows():
+            for cell in row:
+                cell.font = bold_font
+    return output.getvalue()
+
+
+def render_streaming(store_name, products, orders):
+    """Consume the chunks the way StreamingResponse does, without keeping them"""
+    size = 0
+    for chunk in iter_order_workbook(store_name, products, orders):
+        size += len(chunk)
+    return size
+
+
+def measure(func, *args):
+    """Wall time of a plain run, then peak traced allocations of a second run"""
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1024 * 1024)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print(f"{'rows':>8} | {'openpyxl s':>10} | {'openpyxl MiB':>12} | {'stream s':>8} | {'stream MiB':>10}")
+    for rows in sizes:
+        products = [f"Табак для кальяна Товар {i} 50 г" for i in range(rows)]
+        orders = [float(i % 17 + 1) for i in range(rows)]
+        old_time, old_mem = measure(render_with_openpyxl, "Центр", products, orders)
+        new_time, new_mem = measure(render_streaming, "Центр", products, orders)
+        print(f"{rows:>8} | {old_time:>10.2f} | {old_mem:>12.1f} | {new_time:>8.2f} | {new_mem:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from datetime import timezone
 import os
 import logging
 from pathlib import Path
@@ -9,20 +10,46 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Timestamps are stored as BSON dates and read back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, tzinfo=timezone.utc)
 db = client[os.environ['DB_NAME']]
 
 
 async def create_indexes():
     """Create database indexes for faster queries"""
     try:
-        # Stock history indexes for fast lookups
+        # Per-entry stock history written before the buckets (read by migrations)
         await db.stock_history.create_index([("store_id", 1), ("product", 1), ("recorded_at", -1)])
         await db.stock_history.create_index([("store_id", 1), ("recorded_at", -1)])
         await db.stock_history.create_index([("recorded_at", -1)])
         
+        # Stock history: one bucket of points per (store, product, day)
+        await db.stock_history_buckets.create_index([("store_id", 1), ("product", 1), ("day", 1)], unique=True)
+        
+        # Net stock change per (store, day, product) for the period overview
+        await db.stock_store_daily.create_index([("store_id", 1), ("day", 1), ("product", 1)], unique=True)
+        
+        # Latest stock per (store, product), maintained on every stock ingest
+        await db.stock_latest.create_index([("store_id", 1), ("product", 1)], unique=True)
+        
+        # Global uploads per store: unchanged values are carried forward to these times
+        await db.stock_ingests.create_index([("store_id", 1), ("recorded_at", -1)])
+        
+        # Global stock snapshots: meta documents and their columnar chunks
+        await db.global_stock.create_index([("uploaded_at", -1)])
+        await db.global_stock.create_index([("id", 1)])
+        await db.global_stock_chunks.create_index([("snapshot_id", 1), ("kind", 1), ("column", 1), ("chunk", 1)])
+        
         # Order history indexes
         await db.order_history.create_index([("store_id", 1), ("created_at", -1)])
+        # Multikey: per-product order history reads only the orders containing the product
+        await db.order_history.create_index([("store_id", 1), ("items.product", 1), ("created_at", 1)])
+        
+        # Persistent product -> limit match memo
+        await db.match_cache.create_index(
+            [("store_id", 1), ("limits_version", 1), ("product", 1)],
+            unique=True
+        )
         
         # Stores index
         await db.stores.create_index([("name", 1)])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Backfill the stock_latest collection from stock_history.
+
+Run once after deploying, from backend/:
+    python migrations/backfill_stock_latest.py
+
+Safe to re-run: entries go through the same recorded_at-guarded upserts as
+live ingests, so values newer than the backfilled ones are kept.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.stock_history import update_latest_stocks  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+async def backfill() -> int:
+    await create_indexes()
+    
+    # Follows the (store_id, product, recorded_at) index, so $first is the latest entry
+    cursor = db.stock_history.aggregate([
+        {"$sort": {"store_id": 1, "product": 1, "recorded_at": -1}},
+        {"$group": {
+            "_id": {"store_id": "$store_id", "product": "$product"},
+            "store_name": {"$first": "$store_name"},
+            "stock": {"$first": "$stock"},
+            "prev_stock": {"$first": {"$ifNull": ["$prev_stock", 0]}},
+            "change": {"$first": {"$ifNull": ["$change", 0]}},
+            "recorded_at": {"$first": "$recorded_at"}
+        }}
+    ], allowDiskUse=True)
+    
+    total = 0
+    batch = []
+    async for doc in cursor:
+        batch.append({**doc.pop("_id"), **doc})
+        if len(batch) >= BATCH_SIZE:
+            await update_latest_stocks(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        await update_latest_stocks(batch)
+        total += len(batch)
+    return total
+
+
+async def main():
+    try:
+        total = await backfill()
+        logging.info(f"stock_latest backfilled: {total} (store, product) pairs")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
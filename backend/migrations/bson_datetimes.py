@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Convert timestamps stored as ISO strings into BSON dates in every collection,
+so range queries and sorts compare instants instead of text.
+
+Run once after deploying, from backend/ (after the other migrations):
+    python migrations/bson_datetimes.py
+
+Safe to re-run and to run while the app is serving: only string values are
+touched, each update is guarded by the value it replaces, and a day bucket
+whose converted key already exists (written by a live ingest) is merged
+into that bucket.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pymongo import UpdateOne  # noqa: E402
+from pymongo.errors import DuplicateKeyError  # noqa: E402
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.stock_history import as_datetime  # noqa: E402
+
+BATCH_SIZE = 1000
+
+# collection -> top-level timestamp fields
+TIMESTAMP_FIELDS = {
+    "stock_history": ["recorded_at"],
+    "stock_latest": ["recorded_at"],
+    "stock_ingests": ["recorded_at"],
+    "global_stock": ["uploaded_at", "stock_date"],
+    "order_history": ["created_at"],
+    "stores": ["created_at"],
+    "product_mappings": ["created_at"],
+    "filters": ["created_at"],
+}
+
+# collection -> (fields of the unique key besides day, array whose items carry recorded_at)
+DAY_BUCKETS = {
+    "stock_history_buckets": (["store_id", "product"], "points"),
+}
+
+
+async def convert_field(collection, field: str) -> int:
+    converted = 0
+    operations = []
+    async for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+        operations.append(UpdateOne(
+            {"_id": doc["_id"], field: doc[field]},
+            {"$set": {field: as_datetime(doc[field])}}
+        ))
+        if len(operations) >= BATCH_SIZE:
+            converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+    return converted
+
+
+def converted_items(items):
+    return [{**item, "recorded_at": as_datetime(item["recorded_at"])} for item in items]
+
+
+async def convert_buckets(collection, key_fields, items_field: str) -> int:
+    """
+    Buckets keyed by a string day are no longer written to (live ingests use
+    date keys), so each is rewritten whole; if a live ingest already created
+    the bucket under the date key, the items are merged into it.
+    """
+    converted = 0
+    async for doc in collection.find({"day": {"$type": "string"}}):
+        day = as_datetime(doc["day"])
+        items = converted_items(doc.get(items_field, []))
+        try:
+            await collection.update_one({"_id": doc["_id"]}, {"$set": {"day": day, items_field: items}})
+        except DuplicateKeyError:
+            await collection.update_one(
+                {**{field: doc[field] for field in key_fields}, "day": day},
+                {"$addToSet": {items_field: {"$each": items}}}
+            )
+            await collection.delete_one({"_id": doc["_id"]})
+        converted += 1
+    return converted
+
+
+async def convert() -> dict:
+    await create_indexes()
+    
+    counts = {}
+    for name, fields in TIMESTAMP_FIELDS.items():
+        for field in fields:
+            counts[f"{name}.{field}"] = await convert_field(db[name], field)
+    for name, (key_fields, items_field) in DAY_BUCKETS.items():
+        counts[f"{name}.day"] = await convert_buckets(db[name], key_fields, items_field)
+    return counts
+
+
+async def main():
+    try:
+        counts = await convert()
+        for field, count in counts.items():
+            logging.info(f"{field}: {count} converted")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Fold per-entry stock_history documents into stock_history_buckets, one
+document per (store_id, product, day) holding that day's points.
+
+Run once after deploying, from backend/:
+    python migrations/bucket_stock_history.py
+
+Safe to re-run: points are added with $addToSet, so entries already folded
+in are not duplicated and points written by live ingests are kept. The old
+stock_history collection is left in place; drop it once the buckets check out.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pymongo import UpdateOne  # noqa: E402
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.stock_history import bucket_day, history_point  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+def bucket_update(key, store_name, points) -> UpdateOne:
+    store_id, product, day = key
+    return UpdateOne(
+        {"store_id": store_id, "product": product, "day": day},
+        {"$addToSet": {"points": {"$each": points}}, "$set": {"store_name": store_name}},
+        upsert=True
+    )
+
+
+async def fold() -> int:
+    await create_indexes()
+    
+    # Follows the (store_id, product, recorded_at) index, so each bucket's entries are adjacent
+    cursor = db.stock_history.find({}, {"_id": 0}).sort([("store_id", 1), ("product", 1), ("recorded_at", -1)])
+    
+    folded = 0
+    operations = []
+    key, store_name, points = None, None, []
+    async for entry in cursor:
+        entry_key = (entry["store_id"], entry["product"], bucket_day(entry["recorded_at"]))
+        if entry_key != key:
+            if points:
+                operations.append(bucket_update(key, store_name, points))
+            key, store_name, points = entry_key, entry.get("store_name"), []
+        points.append(history_point(entry))
+        folded += 1
+        if len(operations) >= BATCH_SIZE:
+            await db.stock_history_buckets.bulk_write(operations, ordered=False)
+            operations = []
+    if points:
+        operations.append(bucket_update(key, store_name, points))
+    if operations:
+        await db.stock_history_buckets.bulk_write(operations, ordered=False)
+    return folded
+
+
+async def main():
+    try:
+        total = await fold()
+        logging.info(f"stock_history folded into buckets: {total} entries")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Convert global_stock uploads that keep the whole matrix inline (data dict)
+into columnar snapshots with their chunks in global_stock_chunks.
+
+Run once after deploying, from backend/:
+    python migrations/columnar_global_stock.py
+
+Safe to re-run: only documents that still have data are converted, and
+chunks left over from an interrupted run are replaced.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd  # noqa: E402
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.global_stock import (  # noqa: E402
+    SNAPSHOT_CHUNK_SIZE, SNAPSHOT_FORMAT, delete_snapshot_chunks, snapshot_chunks
+)
+
+
+async def convert() -> int:
+    await create_indexes()
+    
+    converted = 0
+    # One document at a time: each may be close to the 16 MB limit
+    ids = [doc["id"] async for doc in db.global_stock.find({"data": {"$exists": True}}, {"_id": 0, "id": 1})]
+    for snapshot_id in ids:
+        doc = await db.global_stock.find_one({"id": snapshot_id}, {"_id": 0, "data": 1, "store_columns": 1})
+        if not doc or "data" not in doc:
+            continue
+        
+        stock = pd.DataFrame.from_dict(doc["data"], orient="index", dtype=float).fillna(0)
+        stock.columns = [str(column) for column in stock.columns]
+        
+        await delete_snapshot_chunks(snapshot_id)
+        chunks = snapshot_chunks(snapshot_id, stock, SNAPSHOT_CHUNK_SIZE)
+        if chunks:
+            await db.global_stock_chunks.insert_many(chunks, ordered=False)
+        
+        await db.global_stock.update_one({"id": snapshot_id}, {
+            "$set": {
+                "store_columns": list(stock.columns),
+                "products_count": len(stock),
+                "format": SNAPSHOT_FORMAT,
+                "chunk_size": SNAPSHOT_CHUNK_SIZE
+            },
+            "$unset": {"data": ""}
+        })
+        converted += 1
+        logging.info(f"Snapshot {snapshot_id}: {len(stock)} products x {len(stock.columns)} stores")
+    return converted
+
+
+async def main():
+    try:
+        converted = await convert()
+        logging.info(f"Converted {converted} global stock uploads to columnar snapshots")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Collapse duplicate products in store limit arrays to one entry each, keeping
+the last one listed (the limit readers already used), so the positional
+per-limit updates always address the single entry of a product.
+
+Run once after deploying, from backend/:
+    python migrations/dedupe_limits.py
+
+Safe to re-run and to run while the app is serving: a store is only
+rewritten when its limits are still exactly the ones that were deduplicated.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.limits import dedupe_limits  # noqa: E402
+
+
+async def dedupe() -> int:
+    await create_indexes()
+    
+    deduped = 0
+    async for store in db.stores.find({"limits.1": {"$exists": True}}, {"_id": 0, "id": 1, "limits": 1}):
+        limits = store["limits"]
+        unique = dedupe_limits(limits)
+        if len(unique) == len(limits):
+            continue
+        result = await db.stores.update_one(
+            {"id": store["id"], "limits": limits},
+            {"$set": {"limits": unique}, "$inc": {"limits_version": 1}}
+        )
+        if result.modified_count:
+            deduped += 1
+            logging.info(f"Store {store['id']}: {len(limits) - len(unique)} duplicate limits removed")
+        else:
+            logging.warning(f"Store {store['id']}: limits changed while deduplicating; re-run the migration")
+    return deduped
+
+
+async def main():
+    try:
+        total = await dedupe()
+        logging.info(f"Limits deduplicated in {total} stores")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Build the daily rollups (stock_store_daily: the net stock change of each
+store, day and product) from the stock changes in stock_history_buckets.
+
+Run once after deploying, from backend/ (after bucket_stock_history.py),
+preferably while no stock is being uploaded:
+    python migrations/rollup_store_stock.py
+
+Drops the unique (store_id, day) index of the earlier one-document-per-day
+rollups first. Safe to re-run: every rollup is recomputed from its buckets
+and set, not added to. An upload landing on a day while that day is being rebuilt can
+be overwritten; running the migration again repairs it, because the
+buckets hold every change.
+"""
+
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pymongo import UpdateOne  # noqa: E402
+
+from database import close_db_connection, create_indexes, db  # noqa: E402
+from services.stock_history import bucket_day, bucket_entries  # noqa: E402
+
+BATCH_SIZE = 1000
+LEGACY_INDEX = "store_id_1_day_1"
+
+
+async def rollup() -> int:
+    # Rollups from before they were kept per product held every change in one array,
+    # under a unique (store_id, day) index that would reject a second product of a day
+    await db.stock_store_daily.delete_many({"changes": {"$exists": True}})
+    if LEGACY_INDEX in await db.stock_store_daily.index_information():
+        await db.stock_store_daily.drop_index(LEGACY_INDEX)
+    await create_indexes()
+    
+    rolled = 0
+    operations = []
+    cursor = db.stock_history_buckets.find({"points": {"$elemMatch": {"change": {"$ne": 0}}}}, {"_id": 0})
+    async for bucket in cursor:
+        # One bucket holds exactly the (store, day, product) of one rollup
+        change = sum(entry.get("change", 0) for entry in bucket_entries(bucket))
+        operations.append(UpdateOne(
+            {"store_id": bucket["store_id"], "day": bucket_day(bucket["day"]), "product": bucket["product"]},
+            {"$set": {"change": change}},
+            upsert=True
+        ))
+        rolled += 1
+        if len(operations) >= BATCH_SIZE:
+            await db.stock_store_daily.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.stock_store_daily.bulk_write(operations, ordered=False)
+    return rolled
+
+
+async def main():
+    try:
+        total = await rollup()
+        logging.info(f"stock_store_daily rolled up: {total} (store, day, product) changes")
+    finally:
+        await close_db_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
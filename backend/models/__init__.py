@@ -1,18 +1,18 @@
 from .store import LimitItem, Store, StoreCreate, StoreUpdate, LimitBulkUpdate, LimitRenameRequest
-from .filter import FilterExpression, FilterCreate
+from .filter import FilterExpression, FilterCreate, FilterValidateRequest
 from .mapping import ProductMapping, ProductMappingCreate, ProductMappingUpdate
 from .stock import GlobalStockUpload, StockHistoryEntry
-from .order import OrderHistoryEntry, TextDataItem, ProcessTextRequest, ProcessRequest
+from .order import OrderHistoryEntry, TextDataItem, ProcessTextRequest, ProcessAllRequest, ProcessRequest
 
 __all__ = [
     # Store models
     'LimitItem', 'Store', 'StoreCreate', 'StoreUpdate', 'LimitBulkUpdate', 'LimitRenameRequest',
     # Filter models
-    'FilterExpression', 'FilterCreate',
+    'FilterExpression', 'FilterCreate', 'FilterValidateRequest',
     # Mapping models
     'ProductMapping', 'ProductMappingCreate', 'ProductMappingUpdate',
     # Stock models
     'GlobalStockUpload', 'StockHistoryEntry',
     # Order models
-    'OrderHistoryEntry', 'TextDataItem', 'ProcessTextRequest', 'ProcessRequest',
+    'OrderHistoryEntry', 'TextDataItem', 'ProcessTextRequest', 'ProcessAllRequest', 'ProcessRequest',
 ]
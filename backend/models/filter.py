@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
+from typing import Optional
 import uuid
 from datetime import datetime, timezone
 
@@ -8,9 +9,14 @@ class FilterExpression(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     expression: str
+    canonical: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
 class FilterCreate(BaseModel):
     name: str
     expression: str
+
+
+class FilterValidateRequest(BaseModel):
+    expression: str
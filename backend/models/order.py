@@ -26,6 +26,14 @@ class ProcessTextRequest(BaseModel):
     seller_request: Optional[str] = None
 
 
+class ProcessAllRequest(BaseModel):
+    # Empty list means every store that has a column in the global stock
+    store_ids: List[str] = Field(default_factory=list)
+    filter_expressions: List[str] = Field(default_factory=list)
+    # Optional seller request text per store id
+    seller_requests: Dict[str, str] = Field(default_factory=dict)
+
+
 class ProcessRequest(BaseModel):
     store_id: str
     filter_expressions: List[str] = Field(default_factory=list)
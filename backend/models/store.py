@@ -14,6 +14,7 @@ class Store(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     limits: List[LimitItem] = Field(default_factory=list)
+    limits_version: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
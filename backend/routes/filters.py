@@ -4,7 +4,8 @@ import uuid
 from datetime import datetime, timezone
 
 from database import db
-from models import FilterExpression, FilterCreate
+from models import FilterExpression, FilterCreate, FilterValidateRequest
+from services.filter_engine import FilterExpressionError, compile_condition, describe_filter
 
 router = APIRouter()
 
@@ -18,12 +19,23 @@ async def get_filters():
 @router.post("/filters", response_model=FilterExpression)
 async def create_filter(filter_input: FilterCreate):
     filter_expr = FilterExpression(**filter_input.model_dump())
+    try:
+        compiled = compile_condition(filter_expr.expression)
+    except FilterExpressionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filter_expr.canonical = compiled.canonical
+    
     filter_dict = filter_expr.model_dump()
-    filter_dict["created_at"] = filter_dict["created_at"].isoformat()
     await db.filters.insert_one(filter_dict)
     return filter_expr
 
 
+@router.post("/filters/validate")
+async def validate_filter(request: FilterValidateRequest):
+    """Parse and type-check an expression without saving it"""
+    return describe_filter(request.expression)
+
+
 @router.delete("/filters/{filter_id}")
 async def delete_filter(filter_id: str):
     result = await db.filters.delete_one({"id": filter_id})
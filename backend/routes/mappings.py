@@ -5,6 +5,7 @@ from datetime import datetime, timezone
 
 from database import db
 from models import ProductMapping, ProductMappingCreate, ProductMappingUpdate
+from services.processing import bump_mappings_version
 
 router = APIRouter()
 
@@ -24,8 +25,8 @@ async def create_product_mapping(mapping_input: ProductMappingCreate):
     
     mapping = ProductMapping(**mapping_input.model_dump())
     mapping_dict = mapping.model_dump()
-    mapping_dict["created_at"] = mapping_dict["created_at"].isoformat()
     await db.product_mappings.insert_one(mapping_dict)
+    await bump_mappings_version()
     return mapping
 
 
@@ -41,6 +42,7 @@ async def update_product_mapping(mapping_id: str, mapping_update: ProductMapping
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Mapping not found")
+    await bump_mappings_version()
     
     mapping = await db.product_mappings.find_one({"id": mapping_id}, {"_id": 0})
     return mapping
@@ -51,4 +53,5 @@ async def delete_product_mapping(mapping_id: str):
     result = await db.product_mappings.delete_one({"id": mapping_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Mapping not found")
+    await bump_mappings_version()
     return {"message": "Mapping deleted successfully"}
@@ -1,229 +1,94 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Query
 from fastapi.responses import StreamingResponse
-from typing import List, Optional
+from typing import Iterator, List, Optional
+import asyncio
 import logging
-import uuid
 import io
 import json
+import re
+import zipfile
 import pandas as pd
-from datetime import datetime, timezone
 from urllib.parse import quote
 
 from database import db
-from models import ProcessTextRequest
-from services.matching import find_best_match_improved
-from services.processing import evaluate_filter_expression, apply_product_mappings
+from models import ProcessTextRequest, ProcessAllRequest
+from services.matching import matcher_cache
+from services.filter_engine import FilterExpressionError, compile_filters
+from services.ingest import spooled_upload
+from services.executor import CPU_POOL_WORKERS, ExecutorError, run_cpu_bound
+from services.order_pipeline import OrderPipeline, OrderPipelineError, iter_order_workbook
+from services.stock_history import record_stock_history
 
 router = APIRouter()
 
+# Path separators and characters Windows does not allow in file names
+_UNSAFE_FILENAME_CHARS = re.compile(r'[\x00-\x1f<>:"/\\|?*]')
+
+
+def archive_entry_name(store: dict, used: set) -> str:
+    """ZIP entry name of a store's workbook: its name made file-safe, the store id added when taken"""
+    name = _UNSAFE_FILENAME_CHARS.sub("_", store["name"]).strip(" .") or store["id"]
+    entry = f"{name}.xlsx"
+    if entry.casefold() in used:
+        entry = f"{name} ({store['id']}).xlsx"
+    used.add(entry.casefold())
+    return entry
+
+
+def order_workbook_response(
+    output: Iterator[bytes],
+    store_name: str,
+    server_timing: Optional[str] = None
+) -> StreamingResponse:
+    filename = f"{store_name}.xlsx"
+    encoded_filename = quote(filename)
+    
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
+        "Access-Control-Expose-Headers": "Content-Disposition"
+    }
+    if server_timing:
+        headers["Server-Timing"] = server_timing
+        headers["Access-Control-Expose-Headers"] = "Content-Disposition, Server-Timing"
+    
+    return StreamingResponse(
+        output,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers=headers
+    )
+
 
 @router.post("/process-text")
 async def process_text_data(request: ProcessTextRequest):
     try:
-        # Get store limits
+        try:
+            filters = compile_filters(request.filter_expressions)
+        except FilterExpressionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         store = await db.stores.find_one({"id": request.store_id})
         if not store:
             raise HTTPException(status_code=404, detail="Store not found")
         
-        limits_dict = {item['product']: item['limit'] for item in store.get('limits', [])}
+        pipeline = OrderPipeline(store, filters, request.seller_request, record_stock_history=True)
         
         # Get data either from request or from global stock
-        if request.use_global_stock:
-            # Load from global stock
-            global_stock = await db.global_stock.find_one({}, sort=[("uploaded_at", -1)])
-            if not global_stock:
-                raise HTTPException(status_code=400, detail="Нет загруженных общих остатков")
-            
-            store_name = store["name"]
-            stock_data = global_stock.get("data", {})
-            
-            # Get "Электро" stock for warehouse check
-            electro_stock = {}
-            for product, stores in stock_data.items():
-                electro_val = stores.get("Электро", 0)
-                electro_stock[product] = electro_val
-            
-            data_list = []
-            removed_by_electro = 0
-            for product, stores in stock_data.items():
-                # Check Электро warehouse: if (Электро stock - 2) <= 0, skip this product
-                electro_val = electro_stock.get(product, 0)
-                if electro_val - 2 <= 0:
-                    removed_by_electro += 1
-                    continue
-                
-                stock = stores.get(store_name, 0)
-                data_list.append({"product": product, "stock": stock})
-            
-            if removed_by_electro > 0:
-                logging.info(f"Removed {removed_by_electro} products - not available on Электро warehouse")
-            
-            if not data_list:
-                raise HTTPException(status_code=400, detail=f"Нет данных для точки '{store_name}' в общих остатках")
-            
-            data_dict = {
-                'Товар': [item["product"] for item in data_list],
-                'Остаток': [item["stock"] for item in data_list]
-            }
-        else:
-            # Use provided data
-            data_dict = {
-                'Товар': [item.product for item in request.data],
-                'Остаток': [item.stock for item in request.data]
-            }
-        
-        df = pd.DataFrame(data_dict)
-        
-        # Process data
-        df['Остаток'] = pd.to_numeric(df['Остаток'], errors='coerce').fillna(0)
-        df['Товар'] = df['Товар'].astype(str)
-        
-        # Apply product mappings
-        df = await apply_product_mappings(df)
-        
-        # Save stock history
-        history_entries = []
-        for _, row in df.iterrows():
-            history_entries.append({
-                "id": str(uuid.uuid4()),
-                "store_id": store["id"],
-                "store_name": store["name"],
-                "product": row["Товар"],
-                "stock": row["Остаток"],
-                "recorded_at": datetime.now(timezone.utc).isoformat()
-            })
-        if history_entries:
-            await db.stock_history.insert_many(history_entries)
-        
-        # Pre-calculate all matches
-        logging.info(f"Starting limit matching for {len(df)} products against {len(limits_dict)} limits")
-        
-        match_cache = {}
-        for product in df['Товар'].unique():
-            match = find_best_match_improved(product, limits_dict)
-            if match and limits_dict[match] > 0:
-                match_cache[product] = (match, limits_dict[match])
-        
-        logging.info(f"Found {len(match_cache)} products with matching limits")
-        
-        # Filter to only products with limits
-        df = df[df['Товар'].isin(match_cache.keys())]
-        
-        if len(df) == 0:
-            raise HTTPException(
-                status_code=400, 
-                detail="Не найдено товаров с лимитами. Проверьте лимиты и названия товаров."
-            )
-        
-        # Calculate order and limits
-        df['Лимиты'] = df['Товар'].apply(lambda x: match_cache[x][1])
-        df['Заказ'] = df.apply(lambda row: max(0, match_cache[row['Товар']][1] - row['Остаток']), axis=1)
-        
-        # Remove zero orders
-        df = df[df['Заказ'] > 0]
-        
-        # Apply custom filters
-        if request.filter_expressions:
-            for expr in request.filter_expressions:
-                if expr.strip():
-                    df = df[df.apply(
-                        lambda row: evaluate_filter_expression(
-                            expr,
-                            row['Лимиты'],
-                            row['Остаток'],
-                            row['Заказ']
-                        ),
-                        axis=1
-                    )]
-        
-        if len(df) == 0:
-            raise HTTPException(
-                status_code=400, 
-                detail="Не найдено товаров для заказа."
-            )
-        
-        # Append seller request text
-        seller_items = []
-        if request.seller_request and request.seller_request.strip():
-            seller_lines = [line.strip() for line in request.seller_request.strip().split('\n') if line.strip()]
-            seller_rows = [{
-                'Товар': line,
-                'Остаток': 0,
-                'Лимиты': 0,
-                'Заказ': 0
-            } for line in seller_lines]
-            
-            if seller_rows:
-                df = pd.concat([df, pd.DataFrame(seller_rows)], ignore_index=True)
-                seller_items = [{
-                    "product": row['Товар'],
-                    "stock": 0,
-                    "order": 0,
-                    "limit": 0,
-                    "is_seller_request": True
-                } for row in seller_rows]
-        
-        logging.info(f"Final order: {len(df)} items")
-        
-        # Save order to history
-        order_items = []
-        for _, row in df.iterrows():
-            is_seller = row["Товар"] in [item["product"] for item in seller_items]
-            order_items.append({
-                "product": row["Товар"],
-                "stock": float(row["Остаток"]),
-                "order": float(row["Заказ"]),
-                "limit": float(row["Лимиты"]),
-                "is_seller_request": is_seller
-            })
-        
-        order_history = {
-            "id": str(uuid.uuid4()),
-            "store_id": store["id"],
-            "store_name": store["name"],
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "items": order_items,
-            "seller_request": request.seller_request if request.seller_request else None
-        }
-        await db.order_history.insert_one(order_history)
-        
-        # Generate Excel response in the same format as order history download
-        store_name = store['name']
-        
-        # Create simplified format: Store name column + Заказ column
-        output_df = pd.DataFrame([
-            {store_name: row['Товар'], 'Заказ': int(row['Заказ'])}
-            for _, row in df.iterrows()
-        ])
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            output_df.to_excel(writer, index=False, sheet_name='Заказ')
-            
-            # Apply bold font to all cells
-            from openpyxl.styles import Font
-            workbook = writer.book
-            worksheet = writer.sheets['Заказ']
-            bold_font = Font(bold=True)
-            
-            for row in worksheet.iter_rows():
-                for cell in row:
-                    cell.font = bold_font
-        
-        output.seek(0)
-        
-        filename = f"{store_name}.xlsx"
-        encoded_filename = quote(filename)
-        
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={
-                "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
-                "Access-Control-Expose-Headers": "Content-Disposition"
-            }
-        )
+        with pipeline.stage("ingest"):
+            if request.use_global_stock:
+                df = await OrderPipeline.ingest_global_stock(store["name"])
+            else:
+                df = OrderPipeline.ingest_frame(pd.DataFrame({
+                    'Товар': [item.product for item in request.data],
+                    'Остаток': [item.stock for item in request.data]
+                }))
+        
+        result = await pipeline.run(df)
+        return order_workbook_response(pipeline.stream(result.df), store["name"], result.server_timing())
     
+    except OrderPipelineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
@@ -238,160 +103,133 @@ async def process_order(
     filter_expressions: str = "[]",
     seller_request: str = ""
 ):
-    """Process order from uploaded Excel file - uses same logic as process_text_data"""
+    """Process order from uploaded Excel/CSV file - uses same pipeline as process_text_data"""
     try:
         filter_list = json.loads(filter_expressions)
+        try:
+            filters = compile_filters(filter_list)
+        except FilterExpressionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         store = await db.stores.find_one({"id": store_id})
         if not store:
             raise HTTPException(status_code=404, detail="Store not found")
         
-        limits_dict = {item['product']: item['limit'] for item in store.get('limits', [])}
+        pipeline = OrderPipeline(store, filters, seller_request)
         
-        contents = await file.read()
-        df = pd.read_excel(io.BytesIO(contents))
-        
-        if 'Товар' not in df.columns or 'Остаток' not in df.columns:
-            raise HTTPException(status_code=400, detail="Excel file must contain 'Товар' and 'Остаток' columns")
-        
-        df['Остаток'] = pd.to_numeric(df['Остаток'], errors='coerce').fillna(0)
-        df['Товар'] = df['Товар'].astype(str)
-        
-        # Apply product mappings (same as process_text_data)
-        df = await apply_product_mappings(df)
-        
-        # Pre-calculate all matches (optimized approach from process_text_data)
-        logging.info(f"Starting limit matching for {len(df)} products against {len(limits_dict)} limits")
-        
-        match_cache = {}
-        for product in df['Товар'].unique():
-            match = find_best_match_improved(product, limits_dict)
-            if match and limits_dict[match] > 0:
-                match_cache[product] = (match, limits_dict[match])
-        
-        logging.info(f"Found {len(match_cache)} products with matching limits")
-        
-        # Filter to only products with limits
-        df = df[df['Товар'].isin(match_cache.keys())]
-        
-        if len(df) == 0:
-            raise HTTPException(
-                status_code=400, 
-                detail="Не найдено товаров с лимитами. Проверьте лимиты и названия товаров."
-            )
-        
-        # Calculate order and limits
-        df['Лимиты'] = df['Товар'].apply(lambda x: match_cache[x][1])
-        df['Заказ'] = df.apply(lambda row: max(0, match_cache[row['Товар']][1] - row['Остаток']), axis=1)
-        
-        # Remove zero orders
-        df = df[df['Заказ'] > 0]
-        
-        # Apply custom filters
-        if filter_list:
-            for expr in filter_list:
-                if expr.strip():
-                    df = df[df.apply(
-                        lambda row: evaluate_filter_expression(
-                            expr,
-                            row['Лимиты'],
-                            row['Остаток'],
-                            row['Заказ']
-                        ),
-                        axis=1
-                    )]
-        
-        if len(df) == 0:
-            raise HTTPException(
-                status_code=400, 
-                detail="Не найдено товаров для заказа."
-            )
-        
-        # Append seller request text
-        seller_items = []
-        if seller_request and seller_request.strip():
-            seller_lines = [line.strip() for line in seller_request.strip().split('\n') if line.strip()]
-            seller_rows = [{
-                'Товар': line,
-                'Остаток': 0,
-                'Лимиты': 0,
-                'Заказ': 0
-            } for line in seller_lines]
-            
-            if seller_rows:
-                df = pd.concat([df, pd.DataFrame(seller_rows)], ignore_index=True)
-                seller_items = [{
-                    "product": row['Товар'],
-                    "stock": 0,
-                    "order": 0,
-                    "limit": 0,
-                    "is_seller_request": True
-                } for row in seller_rows]
-        
-        logging.info(f"Final order: {len(df)} items")
-        
-        # Save order to history
-        order_items = []
-        for _, row in df.iterrows():
-            is_seller = row["Товар"] in [item["product"] for item in seller_items]
-            order_items.append({
-                "product": row["Товар"],
-                "stock": float(row["Остаток"]),
-                "order": float(row["Заказ"]),
-                "limit": float(row["Лимиты"]),
-                "is_seller_request": is_seller
-            })
-        
-        order_history = {
-            "id": str(uuid.uuid4()),
-            "store_id": store["id"],
-            "store_name": store["name"],
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "items": order_items,
-            "seller_request": seller_request if seller_request else None
-        }
-        await db.order_history.insert_one(order_history)
-        
-        # Generate Excel response in the same format as order history download
-        store_name = store['name']
-        
-        output_df = pd.DataFrame([
-            {store_name: row['Товар'], 'Заказ': int(row['Заказ'])}
-            for _, row in df.iterrows()
-        ])
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            output_df.to_excel(writer, index=False, sheet_name='Заказ')
-            
-            from openpyxl.styles import Font
-            workbook = writer.book
-            worksheet = writer.sheets['Заказ']
-            bold_font = Font(bold=True)
-            
-            for row in worksheet.iter_rows():
-                for cell in row:
-                    cell.font = bold_font
-        
-        output.seek(0)
-        
-        filename = f"{store_name}.xlsx"
-        encoded_filename = quote(filename)
+        with pipeline.stage("ingest"):
+            async with spooled_upload(file) as path:
+                df = await run_cpu_bound(OrderPipeline.read_order_file, path)
         
+        result = await pipeline.run(df)
+        return order_workbook_response(pipeline.stream(result.df), store["name"], result.server_timing())
+    
+    except OrderPipelineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Processing error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/process-all")
+async def process_all_stores(request: ProcessAllRequest):
+    """
+    Generate orders for several stores from one load of the latest global stock.
+    Returns a ZIP with one workbook per store plus summary.json; all order
+    history and stock history documents are written with one bulk insert each.
+    """
+    try:
+        try:
+            filters = compile_filters(request.filter_expressions)
+        except FilterExpressionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        stock = await OrderPipeline.load_global_stock()
+        
+        query = {"id": {"$in": request.store_ids}} if request.store_ids else {"name": {"$in": list(stock.columns)}}
+        stores = await db.stores.find(query, {"_id": 0}).to_list(None)
+        if not stores:
+            raise HTTPException(status_code=404, detail="Stores not found")
+        
+        # Stores share the worker pools; keep them from overflowing the pending-job bound
+        semaphore = asyncio.Semaphore(CPU_POOL_WORKERS)
+        
+        async def build_store_order(store: dict):
+            async with semaphore:
+                pipeline = OrderPipeline(
+                    store, filters, request.seller_requests.get(store["id"]), record_stock_history=True
+                )
+                try:
+                    with pipeline.stage("ingest"):
+                        df = OrderPipeline.ingest_store_column(stock, store["name"])
+                    result = await pipeline.run(df, persist=False)
+                    return store, result, await pipeline.render(result.df), None, pipeline.stock_history
+                except OrderPipelineError as e:
+                    # Like /process-text, stock seen before the pipeline gave up is still recorded
+                    return store, None, None, str(e), pipeline.stock_history
+        
+        outcomes = await asyncio.gather(*(build_store_order(store) for store in stores))
+        
+        orders = [result.order for _, result, _, _, _ in outcomes if result]
+        stock_history = [entry for *_, entries in outcomes for entry in entries]
+        await record_stock_history(stock_history)
+        if orders:
+            await db.order_history.insert_many([dict(order) for order in orders])
+        
+        summary = []
+        entry_names = {"summary.json"}
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+            for store, result, output, error, _ in outcomes:
+                entry = {"store_id": store["id"], "store_name": store["name"]}
+                if error:
+                    entry["error"] = error
+                else:
+                    entry.update({
+                        "order_id": result.order["id"],
+                        "items_count": len(result.order["items"]),
+                        "total_order": float(result.df['Заказ'].sum()),
+                        "file": archive_entry_name(store, entry_names),
+                        "timings": result.timings,
+                    })
+                    zf.writestr(entry["file"], output.getvalue())
+                summary.append(entry)
+            zf.writestr("summary.json", json.dumps(summary, ensure_ascii=False, indent=2))
+        archive.seek(0)
+        
+        logging.info(f"Processed {len(orders)} of {len(stores)} stores from global stock")
+        
+        encoded_filename = quote("Заказы.zip")
         return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            archive,
+            media_type="application/zip",
             headers={
                 "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
                 "Access-Control-Expose-Headers": "Content-Disposition"
             }
         )
     
+    except OrderPipelineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Processing error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/matcher-cache/stats")
+async def get_matcher_cache_stats():
+    """Hit/miss counters of the compiled limit matcher cache"""
+    return matcher_cache.stats()
+
+
 @router.get("/stores/{store_id}/orders")
 async def get_store_orders(store_id: str):
     """Get order history for a store"""
@@ -436,34 +274,9 @@ async def download_order(store_id: str, order_id: str):
     store_name = store["name"] if store else "Заказ"
     
     items = order.get("items", [])
-    df = pd.DataFrame([
-        {store_name: item.get("product", ""), "Заказ": item.get("order", 0)}
-        for item in items
-    ])
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Заказ')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Заказ']
-        from openpyxl.styles import Font
-        bold_font = Font(bold=True)
-        
-        for row in worksheet.iter_rows():
-            for cell in row:
-                cell.font = bold_font
-    
-    output.seek(0)
-    
-    filename = f"{store_name}.xlsx"
-    encoded_filename = quote(filename)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={
-            "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
-            "Access-Control-Expose-Headers": "Content-Disposition"
-        }
+    output = iter_order_workbook(
+        store_name,
+        (item.get("product", "") for item in items),
+        (item.get("order", 0) for item in items)
     )
+    return order_workbook_response(output, store_name)
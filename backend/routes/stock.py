@@ -1,13 +1,25 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Query
-from typing import List
+from fastapi import APIRouter, HTTPException, UploadFile, File, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from typing import List, Optional
+import hashlib
+import json
 import logging
-import uuid
-import io
 import pandas as pd
 from datetime import datetime, timezone, timedelta
 from urllib.parse import unquote
 
 from database import db
+from services.executor import ExecutorError, run_cpu_bound
+from services.global_stock import (
+    get_snapshot, history_frame, latest_snapshot, read_global_stock, read_snapshot_slice, save_snapshot,
+    stock_history_documents
+)
+from services.ingest import IngestError, spooled_upload
+from services.stock_history import (
+    history_mask, latest_store_stock, load_latest_entries, product_stock_series, record_stock_history
+)
+from services.stock_matrix import stock_matrix_cache, widen
 
 router = APIRouter()
 
@@ -17,7 +29,7 @@ async def upload_global_stock(
     file: UploadFile = File(...),
     stock_date: str = Query(None, description="Date for the stock in ISO format (YYYY-MM-DD). Defaults to today.")
 ):
-    """Upload global stock Excel file with columns: Товар, Store1, Store2, ..."""
+    """Upload global stock Excel/CSV file with columns: Товар, Store1, Store2, ..."""
     try:
         # Parse stock date or use current date
         if stock_date:
@@ -30,45 +42,14 @@ async def upload_global_stock(
         else:
             parsed_date = datetime.now(timezone.utc)
         
-        contents = await file.read()
-        df = pd.read_excel(io.BytesIO(contents))
-        
-        if len(df.columns) < 2:
-            raise HTTPException(status_code=400, detail="File must have at least 2 columns")
+        async with spooled_upload(file) as path:
+            stock = await run_cpu_bound(read_global_stock, path)
         
-        product_col = df.columns[0]
-        store_columns = list(df.columns[1:])
+        store_columns = list(stock.columns)
         
-        # Build data dict
-        data = {}
-        for _, row in df.iterrows():
-            product = str(row[product_col]).strip()
-            if not product or product == 'nan':
-                continue
-            
-            product_data = {}
-            for store_col in store_columns:
-                stock = row[store_col]
-                if pd.notna(stock):
-                    try:
-                        product_data[str(store_col)] = float(stock)
-                    except:
-                        product_data[str(store_col)] = 0
-                else:
-                    product_data[str(store_col)] = 0
-            
-            data[product] = product_data
-        
-        # Save to database
-        upload_record = {
-            "id": str(uuid.uuid4()),
-            "uploaded_at": datetime.now(timezone.utc).isoformat(),
-            "stock_date": parsed_date.isoformat(),
-            "store_columns": store_columns,
-            "data": data
-        }
-        
-        await db.global_stock.insert_one(upload_record)
+        # Save to database as a columnar snapshot
+        snapshot = await save_snapshot(stock, datetime.now(timezone.utc), parsed_date)
+        await stock_matrix_cache.publish(snapshot["id"], stock)
         
         # Load all stores and create name->id mapping
         all_stores = await db.stores.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)
@@ -80,81 +61,87 @@ async def upload_global_stock(
         if not valid_store_columns:
             return {
                 "message": "Global stock uploaded but no matching stores found",
-                "products_count": len(data),
+                "products_count": len(stock),
                 "stores_found": store_columns,
                 "stock_date": parsed_date.isoformat()
             }
         
-        # Get all previous stocks
-        prev_stocks_pipeline = [
-            {"$match": {"store_id": {"$in": list(store_map.values())}}},
-            {"$sort": {"recorded_at": -1}},
-            {"$group": {
-                "_id": {"store_id": "$store_id", "product": "$product"},
-                "prev_stock": {"$first": "$stock"}
-            }}
-        ]
-        prev_stocks_result = await db.stock_history.aggregate(prev_stocks_pipeline).to_list(None)
-        
-        prev_stocks_map = {}
-        for item in prev_stocks_result:
-            key = (item["_id"]["store_id"], item["_id"]["product"])
-            prev_stocks_map[key] = item["prev_stock"]
-        
-        # Batch insert all history entries
-        history_entries = []
-        recorded_at_str = parsed_date.isoformat()
+        # Previous stock of every (store, product) from the materialized latest values
+        valid_store_ids = [store_map[col] for col in valid_store_columns]
+        latest = await load_latest_entries(valid_store_ids)
+        prev_stocks_map = {key: doc["stock"] for key, doc in latest.items()}
         
-        for product, store_stocks in data.items():
-            for store_name in valid_store_columns:
-                store_id = store_map[store_name]
-                stock = store_stocks.get(store_name, 0)
-                
-                prev_stock = prev_stocks_map.get((store_id, product), 0)
-                change = stock - prev_stock
-                
-                history_entries.append({
-                    "id": str(uuid.uuid4()),
-                    "store_id": store_id,
-                    "store_name": store_name,
-                    "product": product,
-                    "stock": stock,
-                    "prev_stock": prev_stock,
-                    "change": change,
-                    "recorded_at": recorded_at_str
-                })
+        # Long (store, product) rows for every matched store, built column-wise;
+        # only new and changed values (and keyframes) become documents
+        history = history_frame(stock, store_map, prev_stocks_map)
+        history = history[history_mask(history, parsed_date, latest)]
+        history_entries = stock_history_documents(history, parsed_date)
         
-        if history_entries:
-            await db.stock_history.insert_many(history_entries)
+        await record_stock_history(history_entries, latest, complete_stores=valid_store_ids, recorded_at=parsed_date)
         
-        logging.info(f"Global stock uploaded: {len(data)} products, {len(valid_store_columns)} stores, {len(history_entries)} entries")
+        logging.info(f"Global stock uploaded: {len(stock)} products, {len(valid_store_columns)} stores, {len(history_entries)} entries")
         
         return {
             "message": "Global stock uploaded successfully",
-            "products_count": len(data),
+            "products_count": len(stock),
             "stores_found": valid_store_columns,
             "entries_created": len(history_entries),
             "stock_date": parsed_date.isoformat()
         }
-        
+    
     except HTTPException:
         raise
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         logging.error(f"Global stock upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _snapshot_etag(snapshot: dict, params: dict) -> str:
+    """Strong validator: a snapshot never changes, so its id plus the slice parameters identify the body"""
+    key = json.dumps([snapshot["id"], params], ensure_ascii=False, sort_keys=True)
+    return '"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+async def _snapshot_response(request: Request, snapshot: dict, params: dict) -> Response:
+    etag = _snapshot_etag(snapshot, params)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    record = await read_snapshot_slice(snapshot, **params)
+    return JSONResponse(jsonable_encoder(record), headers=headers)
+
+
+def _slice_params(stores, prefix, search, offset, limit) -> dict:
+    return {"stores": stores, "prefix": prefix or None, "search": search or None, "offset": offset, "limit": limit}
+
+
 @router.get("/global-stock/latest")
-async def get_latest_global_stock():
-    """Get the most recent global stock upload"""
-    record = await db.global_stock.find_one(
-        {}, 
-        {"_id": 0},
-        sort=[("uploaded_at", -1)]
-    )
-    if not record:
+async def get_latest_global_stock(
+    request: Request,
+    stores: Optional[List[str]] = Query(None, description="Store columns to return (repeat the parameter). Defaults to all."),
+    prefix: Optional[str] = Query(None, description="Only products starting with this text (case-insensitive)"),
+    search: Optional[str] = Query(None, description="Only products containing this text (case-insensitive)"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, description="Page size. Defaults to all matching products.")
+):
+    """Get the most recent global stock upload, optionally a slice of it; supports If-None-Match"""
+    snapshot = await latest_snapshot()
+    if not snapshot:
         return None
-    return record
+    return await _snapshot_response(request, snapshot, _slice_params(stores, prefix, search, offset, limit))
 
 
 @router.get("/global-stock/history")
@@ -168,12 +155,20 @@ async def get_global_stock_history():
 
 
 @router.get("/global-stock/{stock_id}")
-async def get_global_stock_by_id(stock_id: str):
-    """Get specific global stock upload by ID"""
-    record = await db.global_stock.find_one({"id": stock_id}, {"_id": 0})
-    if not record:
+async def get_global_stock_by_id(
+    request: Request,
+    stock_id: str,
+    stores: Optional[List[str]] = Query(None, description="Store columns to return (repeat the parameter). Defaults to all."),
+    prefix: Optional[str] = Query(None, description="Only products starting with this text (case-insensitive)"),
+    search: Optional[str] = Query(None, description="Only products containing this text (case-insensitive)"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, description="Page size. Defaults to all matching products.")
+):
+    """Get specific global stock upload by ID, optionally a slice of it; supports If-None-Match"""
+    snapshot = await get_snapshot(stock_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="Stock record not found")
-    return record
+    return await _snapshot_response(request, snapshot, _slice_params(stores, prefix, search, offset, limit))
 
 
 @router.get("/stores/{store_id}/stock-history")
@@ -196,28 +191,7 @@ async def get_store_stock_history(
     else:
         start_date = now - timedelta(days=365)
     
-    pipeline = [
-        {"$match": {"store_id": store_id}},
-        {"$sort": {"recorded_at": -1}},
-        {"$group": {
-            "_id": "$product",
-            "latest_stock": {"$first": "$stock"},
-            "prev_stock": {"$first": {"$ifNull": ["$prev_stock", 0]}},
-            "change": {"$first": {"$ifNull": ["$change", 0]}},
-            "last_updated": {"$first": "$recorded_at"}
-        }},
-        {"$project": {
-            "_id": 0,
-            "product": "$_id",
-            "latest_stock": 1,
-            "prev_stock": 1,
-            "change": 1,
-            "last_updated": 1
-        }},
-        {"$sort": {"product": 1}}
-    ]
-    
-    products_data = await db.stock_history.aggregate(pipeline).to_list(10000)
+    products_data = await latest_store_stock(store_id, since=start_date)
     
     return {
         "store_name": store["name"],
@@ -232,7 +206,8 @@ async def get_store_stock_history(
 async def get_product_stock_history(
     store_id: str,
     product: str,
-    period: str = Query("week", enum=["day", "week", "month", "year"])
+    period: str = Query("week", enum=["day", "week", "month", "year"]),
+    points: int = Query(500, ge=3, le=5000, description="Maximum number of stock points; longer series are downsampled")
 ):
     """Get stock history for a specific product"""
     store = await db.stores.find_one({"id": store_id})
@@ -251,32 +226,24 @@ async def get_product_stock_history(
     
     product_decoded = unquote(product)
     
-    stock_records = await db.stock_history.find(
-        {
-            "store_id": store_id,
-            "product": product_decoded,
-            "recorded_at": {"$gte": start_date.isoformat()}
-        },
-        {"_id": 0}
-    ).sort("recorded_at", 1).to_list(1000)
+    # Unchanged values are not stored; the series carries them forward step-wise
+    stock_records = await product_stock_series(store_id, product_decoded, start_date, points)
     
+    # Orders containing the product via the items.product multikey index; the
+    # $elemMatch projection returns only its line, not the whole items array
     order_records = await db.order_history.find(
         {
             "store_id": store_id,
-            "created_at": {"$gte": start_date.isoformat()}
+            "items.product": product_decoded,
+            "created_at": {"$gte": start_date}
         },
-        {"_id": 0, "created_at": 1, "items": 1}
+        {"_id": 0, "created_at": 1, "items": {"$elemMatch": {"product": product_decoded}}}
     ).sort("created_at", 1).to_list(1000)
     
-    orders_data = []
-    for order in order_records:
-        for item in order.get("items", []):
-            if item.get("product") == product_decoded:
-                orders_data.append({
-                    "date": order["created_at"],
-                    "order": item.get("order", 0)
-                })
-                break
+    orders_data = [{
+        "date": order["created_at"],
+        "order": order["items"][0].get("order", 0)
+    } for order in order_records]
     
     return {
         "product": product_decoded,
@@ -299,11 +266,14 @@ async def get_new_products(store_id: str):
         raise HTTPException(status_code=404, detail="Store not found")
     
     # Get latest global stock
-    global_stock = await db.global_stock.find_one({}, sort=[("uploaded_at", -1)])
-    if not global_stock:
+    matrix = await stock_matrix_cache.get()
+    if matrix is None:
         return {"new_products": [], "message": "Нет загруженных общих остатков"}
     
-    stock_data = global_stock.get("data", {})
+    # Only consider products with Электро stock >= 3
+    electro = matrix.column("Электро")
+    on_electro = electro >= 3
+    candidates = zip(matrix.products[on_electro].tolist(), widen(electro[on_electro]).tolist())
     
     # Get store limits as a dict
     limits_dict = {item['product']: item['limit'] for item in store.get('limits', [])}
@@ -312,18 +282,12 @@ async def get_new_products(store_id: str):
     blacklist_doc = await db.product_blacklist.find_one({"_type": "global"})
     blacklist = set(blacklist_doc.get("products", [])) if blacklist_doc else set()
     
-    # Find products on Электро with stock >= 3 that are not in limits or have limit = 0
+    # Of those, products that are not in limits or have limit = 0
     new_products = []
-    for product, stores in stock_data.items():
+    for product, electro_stock in candidates:
         # Skip if in blacklist
         if product in blacklist:
             continue
-            
-        electro_stock = stores.get("Электро", 0)
-        
-        # Only consider products with Электро stock >= 3
-        if electro_stock < 3:
-            continue
         
         # Check if product is not in limits or has limit = 0
         current_limit = limits_dict.get(product, None)
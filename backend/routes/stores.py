@@ -6,6 +6,8 @@ from datetime import datetime, timezone
 
 from database import db
 from models import Store, StoreCreate, StoreUpdate, LimitBulkUpdate, LimitRenameRequest
+from services.limits import LimitConflictError, merge_limits, rename_limit as rename_store_limit, set_limit
+from services.matching import matcher_cache
 
 
 class LimitUpdateRequest(BaseModel):
@@ -51,7 +53,6 @@ async def create_store(store_input: StoreCreate):
     
     store = Store(**store_dict)
     store_dict = store.model_dump()
-    store_dict["created_at"] = store_dict["created_at"].isoformat()
     await db.stores.insert_one(store_dict)
     return store
 
@@ -78,49 +79,28 @@ async def delete_store(store_id: str):
     result = await db.stores.delete_one({"id": store_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Store not found")
+    matcher_cache.evict_store(store_id)
+    await db.match_cache.delete_many({"store_id": store_id})
     return {"message": "Store deleted successfully"}
 
 
 @router.post("/stores/{store_id}/limits")
 async def update_store_limits(store_id: str, limit_update: LimitBulkUpdate):
+    new_limits = [{"product": item.product, "limit": item.limit} for item in limit_update.limits]
+    
     # Apply to all stores - merge with existing limits
     if limit_update.apply_to_all:
-        all_stores = await db.stores.find({}, {"_id": 0}).to_list(1000)
-        
-        for store in all_stores:
-            existing_limits = {item['product']: item['limit'] for item in store.get('limits', [])}
-            
-            # Add/update new limits
-            for new_limit in limit_update.limits:
-                existing_limits[new_limit.product] = new_limit.limit
-            
-            merged_limits = [{"product": k, "limit": v} for k, v in existing_limits.items()]
-            
-            await db.stores.update_one(
-                {"id": store["id"]},
-                {"$set": {"limits": merged_limits}}
-            )
-        
-        modified_count = len(all_stores)
+        await merge_limits(None, new_limits)
+        modified_count = await db.stores.count_documents({})
         return {"message": f"Updated limits for {modified_count} stores"}
     
     # Apply to single store
-    store = await db.stores.find_one({"id": store_id})
+    store = await db.stores.find_one({"id": store_id}, {"_id": 1})
     if not store:
         raise HTTPException(status_code=404, detail="Store not found")
     
-    # Merge new limits with existing ones
-    existing_limits = {item['product']: item['limit'] for item in store.get('limits', [])}
-    
-    for new_limit in limit_update.limits:
-        existing_limits[new_limit.product] = new_limit.limit
-    
-    merged_limits = [{"product": k, "limit": v} for k, v in existing_limits.items()]
-    
-    await db.stores.update_one(
-        {"id": store_id},
-        {"$set": {"limits": merged_limits}}
-    )
+    # Merge new limits with existing ones, one array element at a time
+    await merge_limits(store_id, new_limits)
     return {"message": "Limits updated successfully"}
 
 
@@ -129,25 +109,8 @@ async def update_single_limit(store_id: str, product_name: str, new_limit: int):
     from urllib.parse import unquote
     product_name = unquote(product_name)
     
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
+    if not await set_limit(store_id, product_name, new_limit):
         raise HTTPException(status_code=404, detail="Store not found")
-    
-    limits = store.get('limits', [])
-    found = False
-    for limit in limits:
-        if limit['product'] == product_name:
-            limit['limit'] = new_limit
-            found = True
-            break
-    
-    if not found:
-        limits.append({"product": product_name, "limit": new_limit})
-    
-    await db.stores.update_one(
-        {"id": store_id},
-        {"$set": {"limits": limits}}
-    )
     return {"message": "Limit updated successfully"}
 
 
@@ -156,25 +119,14 @@ async def rename_limit(store_id: str, product_name: str, request: LimitRenameReq
     from urllib.parse import unquote
     product_name = unquote(product_name)
     
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
+    try:
+        renamed = await rename_store_limit(store_id, product_name, request.new_name)
+    except LimitConflictError:
+        raise HTTPException(status_code=409, detail="Limit for this product already exists")
+    if renamed is None:
         raise HTTPException(status_code=404, detail="Store not found")
-    
-    limits = store.get('limits', [])
-    found = False
-    for limit in limits:
-        if limit['product'] == product_name:
-            limit['product'] = request.new_name
-            found = True
-            break
-    
-    if not found:
+    if not renamed:
         raise HTTPException(status_code=404, detail="Limit not found")
-    
-    await db.stores.update_one(
-        {"id": store_id},
-        {"$set": {"limits": limits}}
-    )
     return {"message": "Limit renamed successfully"}
 
 
@@ -185,14 +137,14 @@ async def delete_limit(store_id: str, product_name: str, apply_to_all: bool = Fa
     
     if apply_to_all:
         result = await db.stores.update_many(
-            {},
-            {"$pull": {"limits": {"product": product_name}}}
+            {"limits.product": product_name},
+            {"$pull": {"limits": {"product": product_name}}, "$inc": {"limits_version": 1}}
         )
         return {"message": f"Limit deleted from {result.modified_count} stores"}
     
     result = await db.stores.update_one(
         {"id": store_id},
-        {"$pull": {"limits": {"product": product_name}}}
+        {"$pull": {"limits": {"product": product_name}}, "$inc": {"limits_version": 1}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Store not found")
@@ -205,50 +157,22 @@ async def delete_limit(store_id: str, product_name: str, apply_to_all: bool = Fa
 @router.post("/stores/{store_id}/limit/update")
 async def update_single_limit_safe(store_id: str, request: LimitUpdateRequest):
     """Update a single limit - safe version that handles special characters"""
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
+    if not await set_limit(store_id, request.product_name, request.new_limit):
         raise HTTPException(status_code=404, detail="Store not found")
-    
-    limits = store.get('limits', [])
-    found = False
-    for limit in limits:
-        if limit['product'] == request.product_name:
-            limit['limit'] = request.new_limit
-            found = True
-            break
-    
-    if not found:
-        limits.append({"product": request.product_name, "limit": request.new_limit})
-    
-    await db.stores.update_one(
-        {"id": store_id},
-        {"$set": {"limits": limits}}
-    )
     return {"message": "Limit updated successfully"}
 
 
 @router.post("/stores/{store_id}/limit/rename")
 async def rename_limit_safe(store_id: str, request: LimitRenameByBodyRequest):
     """Rename a limit - safe version that handles special characters"""
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
+    try:
+        renamed = await rename_store_limit(store_id, request.product_name, request.new_name)
+    except LimitConflictError:
+        raise HTTPException(status_code=409, detail="Limit for this product already exists")
+    if renamed is None:
         raise HTTPException(status_code=404, detail="Store not found")
-    
-    limits = store.get('limits', [])
-    found = False
-    for limit in limits:
-        if limit['product'] == request.product_name:
-            limit['product'] = request.new_name
-            found = True
-            break
-    
-    if not found:
+    if not renamed:
         raise HTTPException(status_code=404, detail="Limit not found")
-    
-    await db.stores.update_one(
-        {"id": store_id},
-        {"$set": {"limits": limits}}
-    )
     return {"message": "Limit renamed successfully"}
 
 
@@ -257,14 +181,14 @@ async def delete_limit_safe(store_id: str, request: LimitDeleteRequest):
     """Delete a limit - safe version that handles special characters"""
     if request.apply_to_all:
         result = await db.stores.update_many(
-            {},
-            {"$pull": {"limits": {"product": request.product_name}}}
+            {"limits.product": request.product_name},
+            {"$pull": {"limits": {"product": request.product_name}}, "$inc": {"limits_version": 1}}
         )
         return {"message": f"Limit deleted from {result.modified_count} stores"}
     
     result = await db.stores.update_one(
         {"id": store_id},
-        {"$pull": {"limits": {"product": request.product_name}}}
+        {"$pull": {"limits": {"product": request.product_name}}, "$inc": {"limits_version": 1}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Store not found")
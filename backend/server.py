@@ -7,6 +7,8 @@ import logging
 
 from database import create_indexes, close_db_connection
 from routes import api_router
+from services.processing import load_saved_filters
+from services.executor import shutdown_executors
 
 # Create FastAPI app
 app = FastAPI(
@@ -44,11 +46,13 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database indexes on startup"""
+    """Initialize database indexes and compiled filter cache on startup"""
     await create_indexes()
+    await load_saved_filters()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Close database connection on shutdown"""
+    """Close database connection and worker pools on shutdown"""
     await close_db_connection()
+    shutdown_executors()
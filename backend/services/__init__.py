@@ -1,10 +1,17 @@
-from .matching import tokenize, find_exact_match, find_best_match_improved
+from .matching import tokenize, find_exact_match, find_best_match_improved, LimitMatcher, get_store_matcher, matcher_cache
 from .processing import evaluate_filter_expression, apply_product_mappings
+from .filter_engine import FilterExpressionError, compile_filter, apply_filters
 
 __all__ = [
     'tokenize',
     'find_exact_match', 
     'find_best_match_improved',
+    'LimitMatcher',
+    'get_store_matcher',
+    'matcher_cache',
     'evaluate_filter_expression',
     'apply_product_mappings',
+    'FilterExpressionError',
+    'compile_filter',
+    'apply_filters',
 ]
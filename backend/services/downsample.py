@@ -0,0 +1,42 @@
+import math
+
+import numpy as np
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Positions of the points kept by Largest-Triangle-Three-Buckets
+    downsampling of a series sorted by x to at most threshold points. The
+    first and last points are always kept; in between, each bucket keeps the
+    point forming the largest triangle with the previously kept point and the
+    average of the next bucket, which preserves peaks and steps.
+    """
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    if threshold < 3:
+        return np.array([0, n - 1][:max(threshold, 0)], dtype=np.int64)
+    
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (threshold - 2)
+    
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        next_start = end
+        next_end = min(int(math.floor((i + 2) * every)) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        
+        area = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(area.argmax())
+        kept[i + 1] = previous
+    kept[-1] = n - 1
+    return kept
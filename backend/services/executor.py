@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import BrokenExecutor, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# Pool configuration
+# CPU_POOL_KIND: "process" runs parsing/rendering in worker processes, "thread" keeps everything in-process
+CPU_POOL_KIND = os.environ.get("CPU_POOL_KIND", "process")
+CPU_POOL_WORKERS = int(os.environ.get("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+THREAD_POOL_WORKERS = int(os.environ.get("THREAD_POOL_WORKERS", "4"))
+# Jobs allowed to wait or run at once, including ones whose request timed out;
+# further requests are refused instead of queueing forever
+CPU_POOL_MAX_PENDING = int(os.environ.get("CPU_POOL_MAX_PENDING", "16"))
+# Seconds a single job may take before the request gives up on it
+CPU_TASK_TIMEOUT = float(os.environ.get("CPU_TASK_TIMEOUT", "120"))
+
+
+class ExecutorError(RuntimeError):
+    status_code = 503
+
+
+class ExecutorBusyError(ExecutorError):
+    status_code = 503
+
+
+class ExecutorTimeoutError(ExecutorError):
+    status_code = 504
+
+
+_pools: Dict[str, Optional[Executor]] = {"process": None, "thread": None}
+# Jobs submitted and not finished yet; released from the pool callbacks, which run off the event loop
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def _release_slot(_future: Future) -> None:
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def _get_pool(kind: str) -> Executor:
+    pool = _pools[kind]
+    if pool is None:
+        if kind == "process":
+            # spawn: workers must not inherit the event loop or the Mongo client of the server
+            pool = ProcessPoolExecutor(
+                max_workers=CPU_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            pool = ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS, thread_name_prefix="cpu")
+        _pools[kind] = pool
+    return pool
+
+
+async def _run(kind: str, func: Callable[..., Any], *args, timeout: Optional[float] = None) -> Any:
+    global _pending
+    with _pending_lock:
+        if _pending >= CPU_POOL_MAX_PENDING:
+            raise ExecutorBusyError("Сервер занят обработкой других файлов, попробуйте позже")
+        _pending += 1
+    try:
+        job = _get_pool(kind).submit(func, *args)
+    except BaseException:
+        _release_slot(None)
+        raise
+    # The slot is held until the job itself finishes: a timed-out request cannot stop
+    # a job that already started, and that job still occupies a worker
+    job.add_done_callback(_release_slot)
+    
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(job), timeout or CPU_TASK_TIMEOUT)
+    except BrokenExecutor:
+        # A worker died (e.g. OOM on a huge file); start a fresh pool for the next request
+        _pools[kind] = None
+        raise
+    except asyncio.TimeoutError:
+        # Cancelling the wrapper drops the job if it was still queued
+        logging.error(f"{getattr(func, '__qualname__', func)} exceeded {timeout or CPU_TASK_TIMEOUT}s")
+        raise ExecutorTimeoutError("Превышено время обработки")
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args, timeout: Optional[float] = None) -> Any:
+    """
+    Run a self-contained CPU-heavy function (parsing, rendering) off the event loop.
+    In process mode func and its arguments must be picklable.
+    """
+    return await _run("process" if CPU_POOL_KIND == "process" else "thread", func, *args, timeout=timeout)
+
+
+async def run_blocking(func: Callable[..., Any], *args, timeout: Optional[float] = None) -> Any:
+    """Run work that needs in-process state (cached matchers, automatons) in the thread pool"""
+    return await _run("thread", func, *args, timeout=timeout)
+
+
+def shutdown_executors() -> None:
+    for kind, pool in _pools.items():
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            _pools[kind] = None
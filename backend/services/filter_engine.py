@@ -0,0 +1,197 @@
+import ast
+import operator
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Filter variables and the order columns they read
+VARIABLES = ('Лимиты', 'Остаток', 'Заказ')
+
+_ARITHMETIC = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+}
+
+_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+Env = Dict[str, np.ndarray]
+Evaluator = Callable[[Env], np.ndarray]
+
+
+class FilterExpressionError(ValueError):
+    """Raised when a filter expression cannot be parsed or uses something outside the whitelist"""
+
+
+def _as_bool(values: np.ndarray) -> np.ndarray:
+    return values if values.dtype == bool else values != 0
+
+
+class CompiledFilter:
+    """
+    Filter expression parsed once into a whitelisted AST and compiled into a
+    closure over NumPy arrays, so a whole order is filtered with a handful of
+    array operations instead of one eval per row.
+
+    Arithmetic follows NumPy rules: division by zero gives inf/nan instead of
+    raising, so comparisons against it are False.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise FilterExpressionError(f"Синтаксическая ошибка в выражении '{expression}': {e.msg}") from e
+        
+        self.variables: List[str] = []
+        self.cost = 0
+        self._evaluate, self.result_type = self._compile(tree.body)
+        self.canonical = ast.unparse(tree.body)
+
+    def _compile(self, node: ast.AST) -> Tuple[Evaluator, str]:
+        """Returns (evaluator, result type) where type is 'bool' or 'number'"""
+        self.cost += 1
+        
+        if isinstance(node, ast.Name):
+            if node.id not in VARIABLES:
+                raise FilterExpressionError(
+                    f"Неизвестная переменная '{node.id}'. Доступны: {', '.join(VARIABLES)}"
+                )
+            if node.id not in self.variables:
+                self.variables.append(node.id)
+            name = node.id
+            return (lambda env: env[name]), 'number'
+        
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool):
+                value = np.bool_(node.value)
+                return (lambda env: value), 'bool'
+            if isinstance(node.value, (int, float)):
+                value = np.float64(node.value)
+                return (lambda env: value), 'number'
+            raise FilterExpressionError(f"Недопустимое значение: {node.value!r}")
+        
+        if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC:
+            func = _ARITHMETIC[type(node.op)]
+            left, _ = self._compile(node.left)
+            right, _ = self._compile(node.right)
+            
+            def binop(env):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    return func(np.asarray(left(env), dtype=float), np.asarray(right(env), dtype=float))
+            return binop, 'number'
+        
+        if isinstance(node, ast.UnaryOp):
+            operand, operand_type = self._compile(node.operand)
+            if isinstance(node.op, ast.Not):
+                return (lambda env: ~_as_bool(np.asarray(operand(env)))), 'bool'
+            if isinstance(node.op, ast.USub):
+                return (lambda env: -np.asarray(operand(env), dtype=float)), 'number'
+            if isinstance(node.op, ast.UAdd):
+                return (lambda env: np.asarray(operand(env), dtype=float)), 'number'
+        
+        if isinstance(node, ast.Compare):
+            if not all(type(op) in _COMPARISONS for op in node.ops):
+                raise FilterExpressionError("Допустимые сравнения: >, <, >=, <=, ==, !=")
+            operands = [self._compile(node.left)[0]] + [self._compile(c)[0] for c in node.comparators]
+            ops = [_COMPARISONS[type(op)] for op in node.ops]
+            
+            def compare(env):
+                values = [np.asarray(o(env)) for o in operands]
+                result = ops[0](values[0], values[1])
+                # Chained comparisons: a < b < c means (a < b) and (b < c)
+                for i in range(1, len(ops)):
+                    result = result & ops[i](values[i], values[i + 1])
+                return result
+            return compare, 'bool'
+        
+        if isinstance(node, ast.BoolOp):
+            compiled = [self._compile(value) for value in node.values]
+            parts = [c[0] for c in compiled]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            
+            def boolop(env):
+                result = _as_bool(np.asarray(parts[0](env)))
+                for part in parts[1:]:
+                    result = combine(result, _as_bool(np.asarray(part(env))))
+                return result
+            result_type = 'bool' if all(c[1] == 'bool' for c in compiled) else 'number'
+            return boolop, result_type
+        
+        raise FilterExpressionError(f"Недопустимая конструкция в выражении: {ast.unparse(node)}")
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        """Boolean mask over the Лимиты/Остаток/Заказ columns of df"""
+        env = {name: df[name].to_numpy(dtype=float) for name in self.variables}
+        result = _as_bool(np.asarray(self._evaluate(env)))
+        return np.broadcast_to(result, (len(df),))
+
+    def evaluate(self, limits: float, ostatok: float, zakaz: float) -> bool:
+        """Evaluate for a single row"""
+        env = {
+            'Лимиты': np.asarray(limits, dtype=float),
+            'Остаток': np.asarray(ostatok, dtype=float),
+            'Заказ': np.asarray(zakaz, dtype=float),
+        }
+        return bool(_as_bool(np.asarray(self._evaluate(env))))
+
+
+@lru_cache(maxsize=256)
+def compile_filter(expression: str) -> CompiledFilter:
+    """Parse and compile a filter expression; raises FilterExpressionError"""
+    return CompiledFilter(expression)
+
+
+def compile_condition(expression: str) -> CompiledFilter:
+    """Compile an expression that must be a True/False condition, as saved filters are"""
+    compiled = compile_filter(expression)
+    if compiled.result_type != 'bool':
+        raise FilterExpressionError(
+            f"Выражение '{expression}' не является условием. Используйте сравнение, например: Заказ > Лимиты * 2"
+        )
+    return compiled
+
+
+def describe_filter(expression: str) -> Dict[str, Any]:
+    """Parse result of an expression for the validation endpoint"""
+    try:
+        compiled = compile_condition(expression)
+    except FilterExpressionError as e:
+        return {"valid": False, "error": str(e)}
+    return {
+        "valid": True,
+        "canonical": compiled.canonical,
+        "variables": compiled.variables,
+        "result_type": compiled.result_type,
+        # AST nodes, i.e. roughly the number of array operations per order
+        "cost": compiled.cost,
+    }
+
+
+def compile_filters(expressions: List[str]) -> List[CompiledFilter]:
+    """Compile the non-blank expressions of an order request (saved ones are already in the compile cache)"""
+    return [compile_filter(expr) for expr in expressions if expr.strip()]
+
+
+def apply_filters(df: pd.DataFrame, filters: List[CompiledFilter]) -> pd.DataFrame:
+    """Keep only the rows that pass every filter"""
+    if not filters or len(df) == 0:
+        return df
+    keep = np.ones(len(df), dtype=bool)
+    for compiled in filters:
+        keep &= compiled.mask(df)
+    return df[keep]
@@ -0,0 +1,297 @@
+import os
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from bson import Binary
+
+from database import db
+from services.ingest import IngestError, read_table
+
+HISTORY_COLUMNS = ["store_id", "store_name", "product", "stock", "prev_stock", "change"]
+
+
+def stock_matrix(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Global stock sheet (first column Товар, one column per store) as a
+    product x store float frame. Non-numeric and blank cells become 0; rows
+    with a blank product are dropped; a repeated product keeps its last row.
+    """
+    if len(df.columns) < 2:
+        raise IngestError("File must have at least 2 columns")
+    
+    raw_products = df.iloc[:, 0]
+    present = raw_products.notna().to_numpy()
+    products = raw_products[present].map(str).str.strip()
+    keep = ((products != "") & (products != "nan")).to_numpy()
+    
+    rows = np.flatnonzero(present)[keep]
+    products = products[keep]
+    stores = df.iloc[rows, 1:].apply(pd.to_numeric, errors="coerce").fillna(0).astype(float)
+    stores.columns = [str(column) for column in df.columns[1:]]
+    stores.index = pd.Index(products.to_numpy(), name="product")
+    return stores[~stores.index.duplicated(keep="last")]
+
+
+def read_global_stock(path: str) -> pd.DataFrame:
+    """read_table + stock_matrix, meant to run in the CPU pool"""
+    return stock_matrix(read_table(path))
+
+
+def history_frame(
+    stock: pd.DataFrame,
+    store_map: Dict[str, str],
+    prev_stocks: Dict[Tuple[str, str], float]
+) -> pd.DataFrame:
+    """
+    Long (store, product, stock) rows for the stores of store_map present in
+    the matrix, in product-major order, with the previous stock and the change.
+    """
+    store_names = [name for name in stock.columns if name in store_map]
+    if not store_names or stock.empty:
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+    
+    long = stock[store_names].stack().rename("stock").reset_index()
+    long.columns = ["product", "store_name", "stock"]
+    long["store_id"] = long["store_name"].map(store_map)
+    
+    if prev_stocks:
+        prev = pd.Series(
+            list(prev_stocks.values()),
+            index=pd.MultiIndex.from_tuples(list(prev_stocks.keys()), names=["store_id", "product"]),
+            dtype=float
+        )
+        keys = pd.MultiIndex.from_arrays([long["store_id"], long["product"]])
+        long["prev_stock"] = prev.reindex(keys).fillna(0).to_numpy()
+    else:
+        long["prev_stock"] = 0.0
+    long["change"] = long["stock"] - long["prev_stock"]
+    return long[HISTORY_COLUMNS]
+
+
+def stock_data(stock: pd.DataFrame) -> Dict[str, Dict[str, float]]:
+    """{product: {store: stock}} as stored in global_stock.data"""
+    stores = list(stock.columns)
+    return dict(zip(stock.index.tolist(), (dict(zip(stores, row)) for row in stock.to_numpy().tolist())))
+
+
+def stock_history_documents(history: pd.DataFrame, recorded_at: datetime) -> List[Dict[str, Any]]:
+    """stock_history documents for the rows of history_frame()"""
+    return [{
+        "id": str(uuid.uuid4()),
+        "store_id": store_id,
+        "store_name": store_name,
+        "product": product,
+        "stock": stock,
+        "prev_stock": prev_stock,
+        "change": change,
+        "recorded_at": recorded_at
+    } for store_id, store_name, product, stock, prev_stock, change in zip(
+        *(history[column].tolist() for column in HISTORY_COLUMNS)
+    )]
+
+
+# ---- columnar snapshots ----
+#
+# A snapshot is a meta document in global_stock (id, dates, store_columns,
+# products_count) plus documents in global_stock_chunks: the product list
+# and one zlib-compressed float64 array per store, each cut into chunks of
+# SNAPSHOT_CHUNK_SIZE products so no document comes near the BSON limit.
+# Readers fetch the product chunks and only the store columns they need.
+
+SNAPSHOT_FORMAT = "columnar"
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("GLOBAL_STOCK_CHUNK_SIZE", "20000"))
+
+
+def _pack_column(values: np.ndarray) -> Binary:
+    return Binary(zlib.compress(np.ascontiguousarray(values, dtype="<f8").tobytes(), 1))
+
+
+def _unpack_column(blob: bytes) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(blob), dtype="<f8")
+
+
+def snapshot_chunks(snapshot_id: str, stock: pd.DataFrame, chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> List[Dict[str, Any]]:
+    """global_stock_chunks documents of a product x store matrix"""
+    products = stock.index.tolist()
+    values = stock.to_numpy(dtype=float)
+    chunks = []
+    for chunk, start in enumerate(range(0, len(products), chunk_size)):
+        end = start + chunk_size
+        chunks.append({"snapshot_id": snapshot_id, "kind": "products", "chunk": chunk, "products": products[start:end]})
+        chunks.extend({
+            "snapshot_id": snapshot_id,
+            "kind": "column",
+            "column": str(store),
+            "chunk": chunk,
+            "values": _pack_column(values[start:end, position])
+        } for position, store in enumerate(stock.columns))
+    return chunks
+
+
+async def save_snapshot(stock: pd.DataFrame, uploaded_at: datetime, stock_date: datetime) -> Dict[str, Any]:
+    """Store a matrix as a new snapshot; chunks are written before the meta document makes it visible"""
+    snapshot_id = str(uuid.uuid4())
+    chunks = snapshot_chunks(snapshot_id, stock, SNAPSHOT_CHUNK_SIZE)
+    if chunks:
+        await db.global_stock_chunks.insert_many(chunks, ordered=False)
+    
+    meta = {
+        "id": snapshot_id,
+        "uploaded_at": uploaded_at,
+        "stock_date": stock_date,
+        "store_columns": [str(store) for store in stock.columns],
+        "products_count": len(stock),
+        "format": SNAPSHOT_FORMAT,
+        "chunk_size": SNAPSHOT_CHUNK_SIZE
+    }
+    await db.global_stock.insert_one(dict(meta))
+    return meta
+
+
+# Meta documents are read without the inline matrix of legacy uploads
+_META_PROJECTION = {"_id": 0, "data": 0}
+
+
+async def latest_snapshot() -> Optional[Dict[str, Any]]:
+    """Meta document of the most recent upload"""
+    return await db.global_stock.find_one({}, _META_PROJECTION, sort=[("uploaded_at", -1)])
+
+
+async def get_snapshot(snapshot_id: str) -> Optional[Dict[str, Any]]:
+    return await db.global_stock.find_one({"id": snapshot_id}, _META_PROJECTION)
+
+
+async def _legacy_frame(snapshot: Dict[str, Any]) -> pd.DataFrame:
+    """Upload not yet converted by migrations/columnar_global_stock.py: the matrix is inline"""
+    doc = await db.global_stock.find_one({"id": snapshot["id"]}, {"_id": 0, "data": 1})
+    return pd.DataFrame.from_dict((doc or {}).get("data", {}), orient="index", dtype=float).fillna(0)
+
+
+def _wanted_stores(available: List[str], stores: Optional[Iterable[str]]) -> List[str]:
+    return list(available) if stores is None else [store for store in dict.fromkeys(stores) if store in available]
+
+
+async def _snapshot_products(snapshot_id: str) -> List[str]:
+    products: List[str] = []
+    async for doc in db.global_stock_chunks.find(
+        {"snapshot_id": snapshot_id, "kind": "products"}, {"_id": 0, "products": 1}
+    ).sort("chunk", 1):
+        products.extend(doc["products"])
+    return products
+
+
+async def _snapshot_columns(
+    snapshot_id: str,
+    stores: List[str],
+    chunks: Optional[List[int]] = None
+) -> Dict[str, Dict[int, np.ndarray]]:
+    """{store: {chunk: values}} for the given stores, optionally only some chunks"""
+    columns: Dict[str, Dict[int, np.ndarray]] = {store: {} for store in stores}
+    if not stores:
+        return columns
+    query: Dict[str, Any] = {"snapshot_id": snapshot_id, "kind": "column", "column": {"$in": stores}}
+    if chunks is not None:
+        query["chunk"] = {"$in": chunks}
+    async for doc in db.global_stock_chunks.find(query, {"_id": 0, "column": 1, "chunk": 1, "values": 1}):
+        columns[doc["column"]][doc["chunk"]] = _unpack_column(doc["values"])
+    return columns
+
+
+async def load_snapshot_frame(snapshot: Dict[str, Any], stores: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Product x store float frame of a snapshot. With stores given, only those
+    columns are read (stores absent from the snapshot are left out).
+    """
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        frame = await _legacy_frame(snapshot)
+        return frame[_wanted_stores(list(frame.columns), stores)]
+    
+    wanted = _wanted_stores(snapshot.get("store_columns", []), stores)
+    products = await _snapshot_products(snapshot["id"])
+    columns = await _snapshot_columns(snapshot["id"], wanted)
+    return pd.DataFrame({
+        store: np.concatenate([parts[chunk] for chunk in sorted(parts)]) if parts else np.zeros(len(products))
+        for store, parts in columns.items()
+    }, index=pd.Index(products, name="product"), columns=wanted)
+
+
+def _matching_positions(
+    products: List[str],
+    prefix: Optional[str],
+    search: Optional[str]
+) -> np.ndarray:
+    """Positions of products starting with prefix and containing search (case-insensitive)"""
+    positions = np.arange(len(products))
+    if not prefix and not search:
+        return positions
+    names = pd.Series(products, dtype=object).str.casefold()
+    mask = np.ones(len(products), dtype=bool)
+    if prefix:
+        mask &= names.str.startswith(prefix.casefold()).to_numpy(dtype=bool)
+    if search:
+        mask &= names.str.contains(search.casefold(), regex=False).to_numpy(dtype=bool)
+    return positions[mask]
+
+
+async def read_snapshot_slice(
+    snapshot: Dict[str, Any],
+    stores: Optional[Iterable[str]] = None,
+    prefix: Optional[str] = None,
+    search: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Snapshot in the original API shape ({product: {store: stock}} data dict)
+    restricted to some store columns and a page of the products matching
+    prefix/search, in upload order. Only the column chunks covering the
+    page are read and decompressed.
+    """
+    end = None if limit is None else offset + limit
+    
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        frame = await _legacy_frame(snapshot)
+        wanted = _wanted_stores(list(frame.columns), stores)
+        positions = _matching_positions(frame.index.tolist(), prefix, search)
+        page = frame.iloc[positions[offset:end]][wanted]
+    else:
+        wanted = _wanted_stores(snapshot.get("store_columns", []), stores)
+        products = await _snapshot_products(snapshot["id"])
+        positions = _matching_positions(products, prefix, search)
+        page_positions = positions[offset:end]
+        
+        chunk_size = snapshot.get("chunk_size", SNAPSHOT_CHUNK_SIZE)
+        chunk_of = page_positions // chunk_size
+        within = page_positions - chunk_of * chunk_size
+        needed = np.unique(chunk_of).tolist()
+        columns = await _snapshot_columns(snapshot["id"], wanted, needed)
+        
+        values = np.zeros((len(page_positions), len(wanted)))
+        for chunk in needed:
+            rows = chunk_of == chunk
+            for position, store in enumerate(wanted):
+                if chunk in columns[store]:
+                    values[rows, position] = columns[store][chunk][within[rows]]
+        page = pd.DataFrame(
+            values,
+            index=pd.Index([products[i] for i in page_positions.tolist()], name="product"),
+            columns=wanted
+        )
+    
+    record = dict(snapshot)
+    record.update({
+        "stores": wanted,
+        "total": len(positions),
+        "offset": offset,
+        "limit": limit,
+        "data": stock_data(page)
+    })
+    return record
+
+
+async def delete_snapshot_chunks(snapshot_id: str) -> None:
+    await db.global_stock_chunks.delete_many({"snapshot_id": snapshot_id})
@@ -0,0 +1,555 @@
+import csv
+import math
+import numbers
+import os
+import re
+import tempfile
+import zipfile
+from array import array
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+import numpy as np
+import pandas as pd
+from fastapi import UploadFile
+
+# Uploads are copied to disk in chunks of this size instead of being read into memory at once
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+EXCEL_EXTENSIONS = {".xlsx", ".xlsm"}
+LEGACY_EXCEL_EXTENSIONS = {".xls"}
+DELIMITED_EXTENSIONS = {".csv": None, ".tsv": "\t", ".txt": None}
+
+
+class IngestError(ValueError):
+    """Uploaded file that cannot be read as a table"""
+
+
+@asynccontextmanager
+async def spooled_upload(file: UploadFile) -> AsyncIterator[str]:
+    """Copy an upload to a temporary file chunk by chunk; yields its path and removes it afterwards"""
+    suffix = Path(file.filename or "").suffix.lower()
+    handle = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix="upload_")
+    try:
+        with handle:
+            while True:
+                chunk = await file.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                handle.write(chunk)
+        yield handle.name
+    finally:
+        os.unlink(handle.name)
+
+
+def _header_names(raw: List[Any]) -> List[Any]:
+    """Column names the way pandas.read_excel names them: Unnamed: i for blanks, .1/.2 for duplicates"""
+    names = []
+    seen: Dict[Any, int] = {}
+    for i, value in enumerate(raw):
+        name = value if value is not None and value != "" else f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+# Kind of each cell held by _Column while it is numeric
+_MISSING, _INT, _FLOAT = 0, 1, 2
+# Whole numbers beyond this do not survive a float64 array
+_MAX_EXACT_INT = 2 ** 53
+
+
+class _Column:
+    """
+    One column being read. Numbers go into a float64 array with one kind byte
+    per cell (missing, int or float), about 9 bytes a cell instead of a Python
+    object each; the first value that is not a number switches the column to
+    a list of objects, rebuilt exactly (ints stay ints) from the array.
+    """
+    
+    def __init__(self):
+        self.numbers = array("d")
+        self.kinds = bytearray()
+        self.objects: Optional[List[Any]] = None
+    
+    def __len__(self) -> int:
+        return len(self.kinds) if self.objects is None else len(self.objects)
+    
+    def append(self, value: Any) -> None:
+        if self.objects is not None:
+            self.objects.append(value)
+        elif value is None:
+            self.numbers.append(math.nan)
+            self.kinds.append(_MISSING)
+        elif isinstance(value, numbers.Integral) and not isinstance(value, bool) and abs(value) <= _MAX_EXACT_INT:
+            self.numbers.append(value)
+            self.kinds.append(_INT)
+        elif isinstance(value, numbers.Real) and not isinstance(value, (bool, numbers.Integral)):
+            self.numbers.append(value)
+            self.kinds.append(_FLOAT)
+        else:
+            self.to_objects()
+            self.objects.append(value)
+    
+    def append_number_text(self, text: str) -> None:
+        """A numeric cell as stored in sheet XML: an int unless it has a fraction or an exponent"""
+        if "." in text or "E" in text or "e" in text:
+            value, kind = float(text), _FLOAT
+        else:
+            value, kind = int(text), _INT
+            if abs(value) > _MAX_EXACT_INT:
+                self.append(value)
+                return
+        if self.objects is not None:
+            self.objects.append(value)
+        else:
+            self.numbers.append(value)
+            self.kinds.append(kind)
+    
+    def to_objects(self, restore: bool = True) -> None:
+        """Switch to objects; without restore the cells read so far are left as None for the caller to fill"""
+        if self.objects is not None:
+            return
+        if restore:
+            self.objects = [
+                None if kind == _MISSING else int(number) if kind == _INT else number
+                for number, kind in zip(self.numbers, self.kinds)
+            ]
+        else:
+            self.objects = [None] * len(self.kinds)
+        self.numbers, self.kinds = array("d"), bytearray()
+    
+    def series(self) -> pd.Series:
+        """
+        int64 when every cell is a whole number (as pandas.read_excel does),
+        float64 when every present cell is numeric, object otherwise (pandas
+        infers the text dtype). Blank cells become NaN.
+        """
+        if self.objects is not None:
+            return pd.Series([np.nan if value is None else value for value in self.objects])
+        values = np.frombuffer(self.numbers, dtype=np.float64) if len(self.numbers) else np.empty(0)
+        if len(self.kinds) and self.kinds.count(_INT) == len(self.kinds):
+            return pd.Series(values.astype(np.int64), copy=False)
+        # A view of the array: no second copy of the column
+        return pd.Series(values, copy=False)
+    
+    def release(self) -> None:
+        self.numbers, self.kinds, self.objects = array("d"), bytearray(), None
+
+
+def _is_blank(value: Any) -> bool:
+    return value is None or value == ""
+
+
+def _build_frame(header: List[Any], rows: Iterator[List[Any]], columns: Optional[List[_Column]] = None) -> pd.DataFrame:
+    """Feed rows into typed columns; trailing blank rows are dropped (Excel often reports a larger used range)"""
+    names = _header_names(header)
+    if columns is None:
+        columns = [_Column() for _ in names]
+    blank_rows = 0
+    for row in rows:
+        if all(_is_blank(value) for value in row):
+            blank_rows += 1
+            continue
+        for _ in range(blank_rows):
+            for column in columns:
+                column.append(None)
+        blank_rows = 0
+        
+        for column, value in zip(columns, row):
+            column.append(None if value == "" else value)
+        for column in columns[len(row):]:
+            column.append(None)
+    
+    return _frame_from_columns(names, columns)
+
+
+def _frame_from_columns(names: List[Any], columns: List[_Column]) -> pd.DataFrame:
+    # Column by column, each buffer released once its Series exists; copy=False keeps
+    # the columns as they are instead of consolidating them into one more copy
+    data = {}
+    for name, column in zip(names, columns):
+        data[name] = column.series()
+        column.release()
+    return pd.DataFrame(data, copy=False)
+
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def _part_path(target: str) -> str:
+    """Zip member of a relationship target given relative to xl/ or absolute"""
+    return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+
+def _string_item_text(item: ElementTree.Element) -> str:
+    """Text of a shared or inline string: plain or rich-text runs, phonetic hints left out"""
+    parts = []
+    for child in item:
+        if child.tag == f"{{{_MAIN_NS}}}t":
+            parts.append(child.text or "")
+        elif child.tag == f"{{{_MAIN_NS}}}r":
+            parts.extend(t.text or "" for t in child.iter(f"{{{_MAIN_NS}}}t"))
+    return "".join(parts)
+
+
+class _XlsxWorkbook:
+    """
+    What the cells of the first worksheet need from the rest of the package:
+    its member name, the shared strings, the date and duration styles and the
+    1900/1904 date epoch.
+    """
+    
+    def __init__(self, archive: zipfile.ZipFile):
+        from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+        from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900
+        
+        names = set(archive.namelist())
+        workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+        properties = workbook.find(f"{{{_MAIN_NS}}}workbookPr")
+        date1904 = properties is not None and properties.get("date1904", "").lower() in ("1", "true")
+        self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+        
+        relationships = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        targets = {}
+        shared_strings = "xl/sharedStrings.xml"
+        styles = "xl/styles.xml"
+        for relationship in relationships.iter(f"{{{_PACKAGE_REL_NS}}}Relationship"):
+            targets[relationship.get("Id")] = _part_path(relationship.get("Target"))
+            kind = relationship.get("Type", "").rsplit("/", 1)[-1]
+            if kind == "sharedStrings":
+                shared_strings = _part_path(relationship.get("Target"))
+            elif kind == "styles":
+                styles = _part_path(relationship.get("Target"))
+        
+        self.sheet = None
+        for sheet in workbook.iter(f"{{{_MAIN_NS}}}sheet"):
+            target = targets.get(sheet.get(f"{{{_REL_NS}}}id"))
+            if target in names and "/worksheets/" in target:
+                self.sheet = target
+                break
+        if self.sheet is None:
+            raise IngestError("В файле нет листов")
+        
+        self.strings: List[str] = []
+        if shared_strings in names:
+            with archive.open(shared_strings) as handle:
+                for _, element in ElementTree.iterparse(handle):
+                    if element.tag == f"{{{_MAIN_NS}}}si":
+                        self.strings.append(_string_item_text(element))
+                        element.clear()
+        
+        # Style index (cell s attribute) -> True for dates, False for durations
+        self.date_styles: Dict[str, bool] = {}
+        if styles in names:
+            stylesheet = ElementTree.fromstring(archive.read(styles))
+            formats = dict(BUILTIN_FORMATS)
+            for number_format in stylesheet.iter(f"{{{_MAIN_NS}}}numFmt"):
+                formats[int(number_format.get("numFmtId"))] = number_format.get("formatCode", "")
+            cell_formats = stylesheet.find(f"{{{_MAIN_NS}}}cellXfs")
+            for index, cell_format in enumerate(cell_formats if cell_formats is not None else ()):
+                code = formats.get(int(cell_format.get("numFmtId", 0)), "")
+                if is_date_format(code):
+                    self.date_styles[str(index)] = not is_timedelta_format(code)
+
+
+# Sheet XML is fed to the parser in chunks of this size
+XLSX_PARSE_CHUNK_SIZE = 64 * 1024
+
+
+class _SheetReader:
+    """
+    expat handlers reading worksheet XML straight into typed columns, without
+    cell objects. Row 1 is the header. Cells are typed the way openpyxl reads
+    cached results: numbers, shared and inline strings, booleans, dates by
+    style; error cells (#N/A, #DIV/0!) become blanks. Blank rows are only
+    written once a later row has a value, so trailing ones are dropped.
+    
+    The parser runs without namespace processing (a quarter of its time on a
+    plain sheet); element names carry whatever prefix the root element uses.
+    """
+    
+    def __init__(self, workbook: _XlsxWorkbook):
+        from openpyxl.utils.datetime import from_excel, from_ISO8601
+        
+        self._workbook = workbook
+        self._from_excel = from_excel
+        self._from_iso = from_ISO8601
+        self._row = self._cell = self._value = self._text_run = self._phonetic = None
+        self.header: List[Any] = []
+        self.columns: List[_Column] = []
+        # Column letters -> zero-based position
+        self._positions: Dict[str, int] = {}
+        self._row_number = 0
+        self._in_header = False
+        # Columns written in the current row, rows without values not written yet
+        self._filled = 0
+        self._blank_rows = 0
+        self._column = -1
+        self._type = "n"
+        self._style: Optional[str] = None
+        self._text: Optional[str] = None
+        # Inline string text set aside while inside a phonetic hint
+        self._aside: Optional[str] = None
+    
+    def start(self, name: str, attributes: Dict[str, str]) -> None:
+        if name == self._cell:
+            reference = attributes.get("r")
+            if reference is None:
+                self._column += 1
+            else:
+                letters = reference.rstrip("0123456789")
+                position = self._positions.get(letters)
+                if position is None:
+                    position = self._positions[letters] = _column_position(letters)
+                self._column = position
+            self._type = attributes.get("t", "n")
+            self._style = attributes.get("s")
+            self._text = None
+        elif name == self._value:
+            self._text = ""
+        elif name == self._text_run:
+            if self._type == "inlineStr" and self._text is None:
+                self._text = ""
+        elif name == self._row:
+            number = int(attributes.get("r", self._row_number + 1))
+            if self._row_number and number > self._row_number + 1:
+                self._blank_rows += number - self._row_number - 1
+            self._row_number = number
+            self._in_header = number == 1
+            self._filled = 0
+            self._column = -1
+        elif name == self._phonetic:
+            self._aside, self._text = self._text, None
+        elif self._row is None:
+            prefix = name[:name.index(":") + 1] if ":" in name else ""
+            self._row, self._cell, self._value, self._text_run, self._phonetic = (
+                prefix + local for local in ("row", "c", "v", "t", "rPh")
+            )
+    
+    def end(self, name: str) -> None:
+        if name == self._cell:
+            text = self._text
+            if text is None:
+                return
+            self._text = None
+            position = self._column
+            if self._in_header:
+                value = self._convert(text)
+                if value is not None:
+                    self.header.extend([None] * (position + 1 - len(self.header)))
+                    self.header[position] = value
+                return
+            
+            columns = self.columns
+            if position >= len(columns) or position < self._filled:
+                return
+            numeric = self._type == "n" and (self._style is None or self._style not in self._workbook.date_styles)
+            if not numeric:
+                value = self._convert(text)
+                if value is None or value == "":
+                    return
+            if not self._filled and self._blank_rows:
+                for _ in range(self._blank_rows):
+                    for column in columns:
+                        column.append(None)
+                self._blank_rows = 0
+            for column in columns[self._filled:position]:
+                column.append(None)
+            if numeric:
+                columns[position].append_number_text(text)
+            else:
+                columns[position].append(value)
+            self._filled = position + 1
+        elif name == self._row:
+            if self._in_header:
+                self.columns = [_Column() for _ in self.header]
+                self._in_header = False
+            elif self._filled:
+                for column in self.columns[self._filled:]:
+                    column.append(None)
+            elif self.columns:
+                self._blank_rows += 1
+        elif name == self._phonetic:
+            self._text, self._aside = self._aside, None
+    
+    def characters(self, data: str) -> None:
+        if self._text is not None:
+            self._text += data
+    
+    def _convert(self, text: str) -> Any:
+        kind = self._type
+        if kind == "n":
+            value = float(text) if "." in text or "E" in text or "e" in text else int(text)
+            date = self._workbook.date_styles.get(self._style) if self._style else None
+            if date is not None:
+                return self._from_excel(value, self._workbook.epoch, timedelta=not date)
+            return value
+        if kind == "s":
+            return self._workbook.strings[int(text)]
+        if kind in ("str", "inlineStr"):
+            return text
+        if kind == "b":
+            return text.strip() in ("1", "true")
+        if kind == "d":
+            return self._from_iso(text)
+        # "e": #N/A, #DIV/0! and other errors read as blanks
+        return None
+
+
+def _column_position(letters: str) -> int:
+    """Zero-based position of a column given by its letters (A, B, ..., AA)"""
+    position = 0
+    for char in letters.upper():
+        position = position * 26 + ord(char) - 64
+    return position - 1
+
+
+def _read_xlsx(path: str) -> pd.DataFrame:
+    """First worksheet of an .xlsx file, parsed from its XML in chunks into typed columns"""
+    with zipfile.ZipFile(path) as archive:
+        workbook = _XlsxWorkbook(archive)
+        reader = _SheetReader(workbook)
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = reader.start
+        parser.EndElementHandler = reader.end
+        parser.CharacterDataHandler = reader.characters
+        with archive.open(workbook.sheet) as sheet:
+            while True:
+                chunk = sheet.read(XLSX_PARSE_CHUNK_SIZE)
+                parser.Parse(chunk, not chunk)
+                if not chunk:
+                    break
+    if not reader.header and not reader.columns:
+        return pd.DataFrame()
+    return _frame_from_columns(_header_names(reader.header), reader.columns)
+
+
+_NUMBER = re.compile(r"[+-]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:[eE][+-]?\d+)?")
+
+
+def _parse_number(text: str) -> Any:
+    """
+    A delimited cell as a number (spaces as thousands separators and a
+    decimal comma allowed), None when blank, the text itself otherwise.
+    Words such as nan or inf are text.
+    """
+    compact = text.strip().replace(" ", "").replace("\u00a0", "")
+    if not compact:
+        return None
+    if not _NUMBER.fullmatch(compact):
+        return text
+    if compact.lstrip("+-").isdigit():
+        return int(compact)
+    return float(compact.replace(",", "."))
+
+
+def _delimited_format(path: str, delimiter: Optional[str]) -> Tuple[str, str]:
+    """
+    Encoding and delimiter of a delimited file. The whole file is decoded
+    (chunk by chunk) before any row is read, so a cp1251 byte far into the
+    file selects cp1251 instead of failing halfway through the rows.
+    """
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            with open(path, encoding=encoding, newline="") as handle:
+                sample = handle.read(64 * 1024)
+                while handle.read(SPOOL_CHUNK_SIZE):
+                    pass
+        except UnicodeDecodeError:
+            continue
+        if delimiter is None:
+            try:
+                delimiter = csv.Sniffer().sniff(sample, delimiters=";,\t").delimiter
+            except csv.Error:
+                delimiter = ","
+        return encoding, delimiter
+    raise IngestError("Не удалось определить кодировку файла")
+
+
+def _iter_delimited_rows(path: str, encoding: str, delimiter: str) -> Iterator[List[str]]:
+    with open(path, newline="", encoding=encoding) as handle:
+        yield from csv.reader(handle, delimiter=delimiter)
+
+
+def _read_delimited(path: str, delimiter: Optional[str]) -> pd.DataFrame:
+    """
+    Read a delimited file into typed columns. A column holding text anywhere
+    keeps the original text in every row (0123 stays 0123, nan stays nan):
+    the cells it parsed as numbers before its first text cell are read again
+    from the file.
+    """
+    encoding, delimiter = _delimited_format(path, delimiter)
+    rows = _iter_delimited_rows(path, encoding, delimiter)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    
+    columns = [_Column() for _ in header]
+    # Column position -> number of leading cells to read again as text
+    reread: Dict[int, int] = {}
+    
+    def parsed_rows() -> Iterator[List[Any]]:
+        for row in rows:
+            parsed = []
+            for position, text in enumerate(row[:len(columns)]):
+                column = columns[position]
+                if column.objects is not None:
+                    parsed.append(text)
+                    continue
+                value = _parse_number(text)
+                if isinstance(value, str):
+                    if len(column):
+                        reread[position] = len(column)
+                    column.to_objects(restore=False)
+                parsed.append(value)
+            yield parsed
+    
+    df = _build_frame(header, parsed_rows(), columns)
+    if reread:
+        # Frame row i is the i-th row after the header (only trailing blank rows are dropped)
+        restored = {position: df.iloc[:, position].tolist() for position in reread}
+        rows = _iter_delimited_rows(path, encoding, delimiter)
+        next(rows)
+        for index, row in zip(range(max(reread.values())), rows):
+            for position, count in reread.items():
+                if index < count and position < len(row) and row[position].strip():
+                    restored[position][index] = row[position]
+        for position, values in restored.items():
+            df.isetitem(position, pd.Series(values))
+    return df
+
+
+def read_table(path: str) -> pd.DataFrame:
+    """
+    Read the first sheet of an .xlsx file (its XML parsed with expat) or a
+    CSV/TSV file, row by row into typed columns. The first row is the
+    header. Legacy .xls files go through pandas. Meant to run in the CPU pool:
+    takes a path, returns a DataFrame.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix in LEGACY_EXCEL_EXTENSIONS:
+        return pd.read_excel(path)
+    
+    if suffix in DELIMITED_EXTENSIONS:
+        return _read_delimited(path, DELIMITED_EXTENSIONS[suffix])
+    if suffix not in EXCEL_EXTENSIONS:
+        # Unknown or missing extension: look at the magic bytes
+        with open(path, "rb") as handle:
+            magic = handle.read(8)
+        if magic.startswith(b"\xd0\xcf\x11\xe0"):
+            return pd.read_excel(path)
+        if not magic.startswith(b"PK\x03\x04"):
+            return _read_delimited(path, None)
+    
+    return _read_xlsx(path)
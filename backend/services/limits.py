@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateMany, UpdateOne
+
+from database import db
+
+Update = Tuple[Dict[str, Any], Dict[str, Any]]
+
+
+def _limit_updates(store_filter: Dict[str, Any], product: str, limit: int) -> Tuple[Update, Update]:
+    """
+    (filter, update) pairs that set a limit in place where the product is
+    listed and append it where it is not. Each touches one array element and
+    bumps limits_version, so concurrent edits of other products are kept.
+    """
+    in_place = (
+        {**store_filter, "limits.product": product},
+        {"$set": {"limits.$.limit": limit}, "$inc": {"limits_version": 1}}
+    )
+    append = (
+        {**store_filter, "limits.product": {"$ne": product}},
+        {"$push": {"limits": {"product": product, "limit": limit}}, "$inc": {"limits_version": 1}}
+    )
+    return in_place, append
+
+
+async def merge_limits(store_id: Optional[str], limits: List[Dict[str, Any]]) -> None:
+    """
+    Add or update limits of one store, or of every store when store_id is None.
+    Of the two updates of a limit exactly one matches each store; fewer matches
+    mean a concurrent edit appended the product between them, so the batch is
+    applied again and then updates it in place.
+    """
+    if not limits:
+        return
+    store_filter = {} if store_id is None else {"id": store_id}
+    operation = UpdateOne if store_id is not None else UpdateMany
+    operations = [
+        operation(*update)
+        for limit in limits
+        for update in _limit_updates(store_filter, limit["product"], limit["limit"])
+    ]
+    while True:
+        stores = await db.stores.count_documents(store_filter)
+        # Ordered: the append of a product only runs after its in-place update
+        result = await db.stores.bulk_write(operations, ordered=True)
+        if result.matched_count >= stores * len(limits):
+            return
+
+
+async def _store_exists(store_id: str) -> bool:
+    return await db.stores.find_one({"id": store_id}, {"_id": 1}) is not None
+
+
+async def set_limit(store_id: str, product: str, limit: int) -> bool:
+    """Add or update one limit of a store; False when the store does not exist"""
+    updates = _limit_updates({"id": store_id}, product, limit)
+    while True:
+        for update in updates:
+            result = await db.stores.update_one(*update)
+            if result.matched_count:
+                return True
+        if not await _store_exists(store_id):
+            return False
+        # The product was appended by a concurrent edit between the two updates; update it in place
+
+
+class LimitConflictError(ValueError):
+    """The new name of a limit is already listed for the store"""
+
+
+async def rename_limit(store_id: str, product: str, new_name: str) -> Optional[bool]:
+    """
+    Rename one limit in place; None when the store does not exist, False when
+    the limit does not. Raises LimitConflictError when the store already lists
+    new_name: renaming onto it would leave two entries for one product.
+    """
+    if new_name == product:
+        store = await db.stores.find_one({"id": store_id}, {"_id": 0, "limits.product": 1})
+        if store is None:
+            return None
+        return any(item["product"] == product for item in store.get("limits", []))
+    
+    # $elemMatch binds the positional operator; the $ne guard covers the whole array
+    result = await db.stores.update_one(
+        {"id": store_id, "limits": {"$elemMatch": {"product": product}}, "limits.product": {"$ne": new_name}},
+        {"$set": {"limits.$.product": new_name}, "$inc": {"limits_version": 1}}
+    )
+    if result.matched_count:
+        return True
+    
+    store = await db.stores.find_one({"id": store_id}, {"_id": 0, "limits.product": 1})
+    if store is None:
+        return None
+    listed = {item["product"] for item in store.get("limits", [])}
+    if product not in listed:
+        return False
+    raise LimitConflictError(new_name)
+
+
+def dedupe_limits(limits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One limit per product, the last one listed (what a product -> limit dict of the array keeps)"""
+    latest = {}
+    for limit in limits:
+        latest.pop(limit["product"], None)
+        latest[limit["product"]] = limit
+    return list(latest.values())
@@ -0,0 +1,81 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+class SynonymAutomaton:
+    """
+    Aho-Corasick automaton over product mapping patterns.
+
+    Reproduces the longest-match-wins rule of the original substring scan:
+    patterns are ranked by length (longest first, ties keep their original
+    order) and a product belongs to the group of the best-ranked pattern that
+    occurs anywhere in it. One pass over the product name replaces one
+    `pattern in product` test per pattern.
+    """
+
+    def __init__(self, patterns: List[Tuple[str, str]]):
+        """patterns: (lowered pattern, group_id) in mapping order"""
+        ranked = sorted(range(len(patterns)), key=lambda i: len(patterns[i][0]), reverse=True)
+        self._groups: List[str] = [patterns[i][1] for i in ranked]
+        self.pattern_count = len(patterns)
+
+        # Node 0 is the root; best[node] is the lowest pattern rank ending at node or any suffix of it
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._best: List[Optional[int]] = [None]
+        # The empty pattern is a substring of everything: it only applies when nothing longer matched
+        self._empty_rank: Optional[int] = None
+
+        for rank, i in enumerate(ranked):
+            pattern = patterns[i][0]
+            if not pattern:
+                if self._empty_rank is None:
+                    self._empty_rank = rank
+                continue
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                node = next_node
+            if self._best[node] is None:
+                self._best[node] = rank
+
+        self._build_failure_links()
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                inherited = self._best[self._fail[child]]
+                if inherited is not None and (self._best[child] is None or inherited < self._best[child]):
+                    self._best[child] = inherited
+                queue.append(child)
+
+    def find_group(self, text: str) -> Optional[str]:
+        """Group of the longest pattern contained in text (already lowered/stripped)"""
+        best = None
+        node = 0
+        goto = self._goto
+        fail = self._fail
+        best_at = self._best
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            rank = best_at[node]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        if best is None:
+            best = self._empty_rank
+        return self._groups[best] if best is not None else None
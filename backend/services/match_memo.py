@@ -0,0 +1,77 @@
+import logging
+from typing import Dict, Iterable, Optional
+
+from pymongo.errors import BulkWriteError
+
+from database import db
+from services.executor import run_blocking
+from services.matching import LimitMatcher
+
+
+# Newest limits_version per store whose older memo entries were already purged by this process
+_collected_versions: Dict[str, int] = {}
+
+
+async def _collect_stale_entries(store_id: str, limits_version: int) -> None:
+    """
+    Lazily drop memo entries computed against older limits of the store. Only
+    strictly older versions go: a request still holding an outdated store
+    document must not purge the entries of the current limits.
+    """
+    if _collected_versions.get(store_id, -1) >= limits_version:
+        return
+    result = await db.match_cache.delete_many({
+        "store_id": store_id,
+        "limits_version": {"$lt": limits_version}
+    })
+    _collected_versions[store_id] = max(limits_version, _collected_versions.get(store_id, -1))
+    if result.deleted_count:
+        logging.info(f"Match cache: removed {result.deleted_count} stale entries for store {store_id}")
+
+
+async def resolve_matches(store: dict, matcher: LimitMatcher, product_names: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Resolve product names to limit keys, consulting the persistent match_cache
+    collection first and writing newly computed matches back in bulk.
+    
+    Entries are keyed by (store_id, limits_version, product). The product name
+    is stored verbatim: exact matching distinguishes Latin/Cyrillic look-alikes,
+    so normalizing the key could merge names that match different limits.
+    Misses (no matching limit) are memoized too.
+    """
+    store_id = store["id"]
+    limits_version = store.get("limits_version", 0)
+    names = list(dict.fromkeys(product_names))
+    if not names:
+        return {}
+    
+    await _collect_stale_entries(store_id, limits_version)
+    
+    cached = await db.match_cache.find(
+        {"store_id": store_id, "limits_version": limits_version, "product": {"$in": names}},
+        {"_id": 0, "product": 1, "limit_key": 1}
+    ).to_list(None)
+    
+    resolved = {doc["product"]: doc.get("limit_key") for doc in cached}
+    
+    missing = [name for name in names if name not in resolved]
+    if missing:
+        computed = await run_blocking(matcher.match_many, missing)
+        resolved.update(computed)
+        try:
+            await db.match_cache.insert_many(
+                [{
+                    "store_id": store_id,
+                    "limits_version": limits_version,
+                    "product": name,
+                    "limit_key": key
+                } for name, key in computed.items()],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            # Another request may have memoized some of the same names concurrently
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+    
+    logging.info(f"Match cache: {len(names) - len(missing)} hits, {len(missing)} misses for store {store_id}")
+    return resolved
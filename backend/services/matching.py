@@ -1,7 +1,13 @@
+import logging
+import os
 import re
-from typing import Dict, Optional
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional
 import unicodedata
 
+from services.executor import run_blocking
+
 LAT_TO_CYR = str.maketrans({
     "A": "А", "B": "В", "C": "С", "E": "Е", "H": "Н",
     "K": "К", "M": "М", "O": "О", "P": "Р", "T": "Т",
@@ -33,23 +39,77 @@ def tokenize(text: str) -> tuple:
     return tuple(tokens)
 
 
-def find_exact_match(product_name: str, limits_dict: Dict[str, int]) -> Optional[str]:
+def _exact_key(name: str) -> str:
+    return name.lower().strip()
+
+
+def build_exact_index(limit_keys) -> Dict[str, str]:
+    """
+    Map lowered/stripped limit keys to the original keys.
+    On collision the key that comes first keeps the slot, which is the
+    one the linear scan in find_exact_match would have returned.
+    """
+    index: Dict[str, str] = {}
+    for limit_key in limit_keys:
+        index.setdefault(_exact_key(limit_key), limit_key)
+    return index
+
+
+def find_exact_match(
+    product_name: str,
+    limits_dict: Dict[str, int],
+    exact_index: Optional[Dict[str, str]] = None
+) -> Optional[str]:
     """
     Fast exact matching - for when product names match limit names exactly.
+    Pass a prebuilt exact_index (see build_exact_index) to avoid the linear scan.
     """
     # Try exact match first
     if product_name in limits_dict:
         return product_name
     
     # Try case-insensitive match
-    product_lower = product_name.lower().strip()
+    product_lower = _exact_key(product_name)
+    if exact_index is not None:
+        return exact_index.get(product_lower)
+    
     for limit_key in limits_dict.keys():
-        if limit_key.lower().strip() == product_lower:
+        if _exact_key(limit_key) == product_lower:
             return limit_key
     
     return None
 
 
+def _score_limit(limit_key: str, limit_tokens: tuple, product_tokens: tuple) -> Optional[int]:
+    """
+    Score a single limit against a tokenized product name.
+    Returns None when the limit does not match at all.
+    """
+    # Check if all limit tokens are present in product tokens
+    matches = 0
+    exact_matches = 0
+    
+    for limit_token in limit_tokens:
+        if limit_token in product_tokens:
+            exact_matches += 1
+        # Check partial match for words only (not numbers)
+        elif not limit_token.isdigit():
+            for product_token in product_tokens:
+                if not product_token.isdigit() and limit_token in product_token:
+                    matches += 1
+                    break
+    
+    # Calculate score: prioritize exact matches, especially for numbers
+    total_limit_tokens = len(limit_tokens)
+    if exact_matches == total_limit_tokens:
+        # Perfect match - all tokens match exactly
+        return exact_matches * 10000 + len(limit_key)
+    if exact_matches + matches >= total_limit_tokens:
+        # Partial match
+        return exact_matches * 1000 + matches * 100 + len(limit_key)
+    return None
+
+
 def find_best_match_improved(product_name: str, limits_dict: Dict[str, int]) -> Optional[str]:
     """
     Improved matching algorithm that correctly distinguishes between similar products.
@@ -71,33 +131,184 @@ def find_best_match_improved(product_name: str, limits_dict: Dict[str, int]) ->
         if not limit_tokens:
             continue
         
-        # Check if all limit tokens are present in product tokens
-        matches = 0
-        exact_matches = 0
-        
-        for limit_token in limit_tokens:
-            if limit_token in product_tokens:
-                exact_matches += 1
-            # Check partial match for words only (not numbers)
-            elif not limit_token.isdigit():
-                for product_token in product_tokens:
-                    if not product_token.isdigit() and limit_token in product_token:
-                        matches += 1
-                        break
-        
-        # Calculate score: prioritize exact matches, especially for numbers
-        total_limit_tokens = len(limit_tokens)
-        if exact_matches == total_limit_tokens:
-            # Perfect match - all tokens match exactly
-            score = exact_matches * 10000 + len(limit_key)
-        elif exact_matches + matches >= total_limit_tokens:
-            # Partial match
-            score = exact_matches * 1000 + matches * 100 + len(limit_key)
-        else:
-            continue
-        
-        if score > best_score:
+        score = _score_limit(limit_key, limit_tokens, product_tokens)
+        if score is not None and score > best_score:
             best_score = score
             best_match = limit_key
     
     return best_match
+
+
+class LimitMatcher:
+    """
+    Precompiled matcher for one store's limits.
+
+    Tokenizes every limit key once and keeps an inverted index
+    token -> limit positions, with numeric tokens indexed separately
+    (numbers only ever match exactly). Only limits sharing at least one
+    token with the product are scored, using the same rules and the same
+    tie-breaking (first limit in dict order wins) as find_best_match_improved.
+    """
+
+    def __init__(self, limits_dict: Dict[str, int]):
+        self.limits_dict = dict(limits_dict)
+        self._keys: List[str] = list(self.limits_dict.keys())
+        self._tokens: List[tuple] = []
+        self._word_index: Dict[str, List[int]] = defaultdict(list)
+        self._number_index: Dict[str, List[int]] = defaultdict(list)
+        self._max_word_len = 0
+        self.exact_index = build_exact_index(self._keys)
+        # Normalized keys claimed by more than one limit; the first one wins
+        self.exact_collisions: Dict[str, List[str]] = {}
+
+        for limit_key in self._keys:
+            normalized = _exact_key(limit_key)
+            winner = self.exact_index[normalized]
+            if winner != limit_key:
+                self.exact_collisions.setdefault(normalized, [winner]).append(limit_key)
+
+        for position, limit_key in enumerate(self._keys):
+            limit_tokens = tokenize(limit_key.lower())
+            self._tokens.append(limit_tokens)
+            for token in set(limit_tokens):
+                if token.isdigit():
+                    self._number_index[token].append(position)
+                else:
+                    self._word_index[token].append(position)
+                    self._max_word_len = max(self._max_word_len, len(token))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _candidates(self, product_tokens: tuple) -> List[int]:
+        """Positions of limits sharing at least one (sub)token with the product, in dict order"""
+        positions = set()
+        for product_token in set(product_tokens):
+            if product_token.isdigit():
+                positions.update(self._number_index.get(product_token, ()))
+                continue
+            # A word limit token matches any word product token containing it,
+            # so look up every substring up to the longest indexed word.
+            token_len = len(product_token)
+            for start in range(token_len):
+                stop = min(token_len, start + self._max_word_len)
+                for end in range(start + 1, stop + 1):
+                    hit = self._word_index.get(product_token[start:end])
+                    if hit:
+                        positions.update(hit)
+        return sorted(positions)
+
+    def find_exact(self, product_name: str) -> Optional[str]:
+        """O(1) equivalent of find_exact_match(product_name, limits_dict)"""
+        return find_exact_match(product_name, self.limits_dict, self.exact_index)
+
+    def match(self, product_name: str) -> Optional[str]:
+        """Same result as find_best_match_improved(product_name, limits_dict)"""
+        exact = self.find_exact(product_name)
+        if exact:
+            return exact
+        
+        product_tokens = tokenize(product_name.lower())
+        
+        best_match = None
+        best_score = 0
+        
+        for position in self._candidates(product_tokens):
+            limit_key = self._keys[position]
+            score = _score_limit(limit_key, self._tokens[position], product_tokens)
+            if score is not None and score > best_score:
+                best_score = score
+                best_match = limit_key
+        
+        return best_match
+
+    def match_many(self, product_names: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Resolve a whole column of product names in one pass.
+        Each distinct name is matched once; exact hits skip tokenization.
+        """
+        resolved: Dict[str, Optional[str]] = {}
+        for product_name in product_names:
+            if product_name not in resolved:
+                resolved[product_name] = self.match(product_name)
+        return resolved
+
+
+class MatcherCache:
+    """
+    Process-wide LRU cache of compiled matchers keyed by (store_id, limits_version).
+
+    Every limit write bumps the store's limits_version, so a stale entry can
+    never be returned and no TTL is needed; old versions simply age out.
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, LimitMatcher]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, store: dict) -> Optional[LimitMatcher]:
+        """Cached matcher of the store's current limits, None on a miss"""
+        key = (store["id"], store.get("limits_version", 0))
+        with self._lock:
+            matcher = self._entries.get(key)
+            if matcher is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return matcher
+            self.misses += 1
+        return None
+
+    def build(self, store: dict) -> LimitMatcher:
+        """Compile the store's matcher and cache it; CPU work, kept off the event loop by get_store_matcher"""
+        limits_dict = {item['product']: item['limit'] for item in store.get('limits', [])}
+        matcher = LimitMatcher(limits_dict)
+        if matcher.exact_collisions:
+            logging.warning(
+                f"Store {store['id']}: {len(matcher.exact_collisions)} limit names differ only by case/spaces, "
+                f"first one wins: {list(matcher.exact_collisions.values())[:5]}"
+            )
+        
+        key = (store["id"], store.get("limits_version", 0))
+        with self._lock:
+            self._entries[key] = matcher
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return matcher
+
+    def get(self, store: dict) -> LimitMatcher:
+        matcher = self.lookup(store)
+        if matcher is None:
+            matcher = self.build(store)
+        return matcher
+
+    def evict_store(self, store_id: str) -> None:
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == store_id]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+matcher_cache = MatcherCache(maxsize=int(os.environ.get("MATCHER_CACHE_SIZE", "64")))
+
+
+async def get_store_matcher(store: dict) -> LimitMatcher:
+    """
+    Compiled matcher for a store document, reused until its limits change.
+    On a miss it is compiled in the thread pool, not on the event loop.
+    """
+    matcher = matcher_cache.lookup(store)
+    if matcher is None:
+        matcher = await run_blocking(matcher_cache.build, store)
+    return matcher
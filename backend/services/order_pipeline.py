@@ -0,0 +1,282 @@
+import io
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+from database import db
+from services.executor import run_cpu_bound
+from services.filter_engine import CompiledFilter, apply_filters
+from services.ingest import read_table
+from services.match_memo import resolve_matches
+from services.matching import get_store_matcher
+from services.processing import apply_product_mappings
+from services.stock_matrix import stock_matrix_cache
+from services.stock_history import record_stock_history
+from services.xlsx_writer import iter_xlsx
+
+
+ORDER_COLUMNS = ['Товар', 'Остаток', 'Лимиты', 'Заказ']
+
+
+class OrderPipelineError(ValueError):
+    """Input that cannot produce an order (no data, no matching limits, nothing to order)"""
+
+
+class OrderResult:
+    """Outcome of one pipeline run: final order rows, the order_history document and stage timings"""
+    
+    def __init__(self, df: pd.DataFrame, order: Dict[str, Any], timings: Dict[str, float],
+                 merge_report: List[Dict[str, Any]], stock_history: Optional[List[Dict[str, Any]]] = None):
+        self.df = df
+        self.order = order
+        self.timings = timings
+        self.merge_report = merge_report
+        # Unsaved stock history entries when the pipeline ran with persist=False
+        self.stock_history = stock_history or []
+    
+    def server_timing(self) -> str:
+        """Stage timings formatted for the Server-Timing response header"""
+        return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in self.timings.items())
+
+
+class OrderPipeline:
+    """
+    Shared order flow of /process and /process-text:
+    ingest -> map -> match -> compute -> filter -> persist -> render.
+    Rendering is either streamed into the response (stream) or done in the
+    CPU pool when the bytes are needed at once (render).
+    
+    All per-row work is done on whole columns; each stage's wall time in
+    milliseconds is collected in `timings`.
+    """
+    
+    def __init__(
+        self,
+        store: dict,
+        filters: List[CompiledFilter],
+        seller_request: Optional[str] = None,
+        record_stock_history: bool = False
+    ):
+        self.store = store
+        self.filters = filters
+        self.seller_request = seller_request
+        self.record_stock_history = record_stock_history
+        # Entries left unsaved by run(persist=False); kept when a later stage fails
+        self.stock_history: List[Dict[str, Any]] = []
+        self.timings: Dict[str, float] = {}
+    
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - started) * 1000
+    
+    # ---- ingest ----
+    
+    @staticmethod
+    def ingest_frame(df: pd.DataFrame) -> pd.DataFrame:
+        """Normalize a Товар/Остаток frame"""
+        df = df[['Товар', 'Остаток']].copy()
+        df['Остаток'] = pd.to_numeric(df['Остаток'], errors='coerce').fillna(0)
+        df['Товар'] = df['Товар'].astype(str)
+        return df
+    
+    @staticmethod
+    def read_order_file(path: str) -> pd.DataFrame:
+        """Товар/Остаток frame from a spooled .xlsx/.xls/.csv upload; runs in the CPU pool"""
+        df = read_table(path)
+        if 'Товар' not in df.columns or 'Остаток' not in df.columns:
+            raise OrderPipelineError("Excel file must contain 'Товар' and 'Остаток' columns")
+        return OrderPipeline.ingest_frame(df)
+    
+    @staticmethod
+    async def load_global_stock(stores: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        """
+        Latest global stock as a product x store frame, without products
+        unavailable on the Электро warehouse. Load once, slice per store;
+        with stores given only those columns (and Электро) are read.
+        """
+        matrix = await stock_matrix_cache.get()
+        if matrix is None:
+            raise OrderPipelineError("Нет загруженных общих остатков")
+        
+        # Check Электро warehouse: if (Электро stock - 2) <= 0, skip this product
+        available = matrix.column('Электро') - 2 > 0
+        removed_by_electro = int((~available).sum())
+        if removed_by_electro > 0:
+            logging.info(f"Removed {removed_by_electro} products - not available on Электро warehouse")
+        return matrix.frame(None if stores is None else [*stores, 'Электро'], rows=available)
+    
+    @staticmethod
+    def ingest_store_column(stock: pd.DataFrame, store_name: str) -> pd.DataFrame:
+        """Товар/Остаток frame of one store taken from load_global_stock()"""
+        if len(stock) == 0:
+            raise OrderPipelineError(f"Нет данных для точки '{store_name}' в общих остатках")
+        column = stock[store_name] if store_name in stock.columns else pd.Series(0.0, index=stock.index)
+        return OrderPipeline.ingest_frame(pd.DataFrame({'Товар': stock.index, 'Остаток': column.to_numpy()}))
+    
+    @staticmethod
+    async def ingest_global_stock(store_name: str) -> pd.DataFrame:
+        """Store column of the latest global stock, without products unavailable on Электро"""
+        stock = await OrderPipeline.load_global_stock([store_name])
+        return OrderPipeline.ingest_store_column(stock, store_name)
+    
+    # ---- stages ----
+    
+    async def map(self, df: pd.DataFrame):
+        with self.stage("map"):
+            return await apply_product_mappings(df)
+    
+    async def match(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Attach Лимиты and keep only products whose matched limit is positive"""
+        with self.stage("match"):
+            matcher = await get_store_matcher(self.store)
+            limits_dict = matcher.limits_dict
+            logging.info(f"Starting limit matching for {len(df)} products against {len(limits_dict)} limits")
+            
+            matches = await resolve_matches(self.store, matcher, df['Товар'].unique())
+            limit_by_product = {
+                product: limits_dict[match]
+                for product, match in matches.items()
+                if match and limits_dict[match] > 0
+            }
+            logging.info(f"Found {len(limit_by_product)} products with matching limits")
+            
+            df = df.assign(Лимиты=df['Товар'].map(limit_by_product))
+            df = df[df['Лимиты'].notna()]
+            if len(df) == 0:
+                raise OrderPipelineError("Не найдено товаров с лимитами. Проверьте лимиты и названия товаров.")
+            return df
+    
+    def compute(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Заказ = max(0, Лимит - Остаток), zero orders removed"""
+        with self.stage("compute"):
+            df = df.assign(Заказ=(df['Лимиты'] - df['Остаток']).clip(lower=0))
+            return df[df['Заказ'] > 0]
+    
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        with self.stage("filter"):
+            df = apply_filters(df, self.filters)
+            if len(df) == 0:
+                raise OrderPipelineError("Не найдено товаров для заказа.")
+            return df
+    
+    def append_seller_request(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Seller request lines go to the end of the order without limits or filters"""
+        df = df[ORDER_COLUMNS].assign(is_seller_request=False)
+        if not (self.seller_request and self.seller_request.strip()):
+            return df
+        seller_lines = [line.strip() for line in self.seller_request.strip().split('\n') if line.strip()]
+        seller_rows = pd.DataFrame({
+            'Товар': seller_lines,
+            'Остаток': 0,
+            'Лимиты': 0,
+            'Заказ': 0,
+            'is_seller_request': True
+        })
+        return pd.concat([df, seller_rows], ignore_index=True)
+    
+    def stock_history_entries(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """History entries of ingested rows; a repeated product keeps its last row, as in global uploads"""
+        recorded_at = datetime.now(timezone.utc)
+        df = df.drop_duplicates('Товар', keep='last')
+        return [{
+            "id": str(uuid.uuid4()),
+            "store_id": self.store["id"],
+            "store_name": self.store["name"],
+            "product": product,
+            "stock": stock,
+            "recorded_at": recorded_at
+        } for product, stock in zip(df['Товар'].tolist(), df['Остаток'].tolist())]
+    
+    def order_document(self, df: pd.DataFrame) -> Dict[str, Any]:
+        order_items = [{
+            "product": product,
+            "stock": float(stock),
+            "order": float(order),
+            "limit": float(limit),
+            "is_seller_request": bool(is_seller)
+        } for product, stock, order, limit, is_seller in zip(
+            df['Товар'].tolist(), df['Остаток'].tolist(), df['Заказ'].tolist(),
+            df['Лимиты'].tolist(), df['is_seller_request'].tolist()
+        )]
+        return {
+            "id": str(uuid.uuid4()),
+            "store_id": self.store["id"],
+            "store_name": self.store["name"],
+            "created_at": datetime.now(timezone.utc),
+            "items": order_items,
+            "seller_request": self.seller_request if self.seller_request else None
+        }
+    
+    async def persist_stock_history(self, df: pd.DataFrame) -> None:
+        with self.stage("persist"):
+            await record_stock_history(self.stock_history_entries(df))
+    
+    async def persist_order(self, order: Dict[str, Any]) -> None:
+        with self.stage("persist"):
+            await db.order_history.insert_one(dict(order))
+    
+    def stream(self, df: pd.DataFrame) -> Iterator[bytes]:
+        """Workbook chunks produced while the response is being sent"""
+        return iter_order_workbook(self.store["name"], df['Товар'].tolist(), (int(order) for order in df['Заказ'].tolist()))
+    
+    async def render(self, df: pd.DataFrame) -> io.BytesIO:
+        with self.stage("render"):
+            return await run_cpu_bound(
+                render_order_workbook,
+                self.store["name"], df['Товар'].tolist(), [int(order) for order in df['Заказ'].tolist()]
+            )
+    
+    # ---- full run ----
+    
+    async def run(self, df: pd.DataFrame, persist: bool = True) -> OrderResult:
+        """
+        Run map..persist on an ingested frame; rendering is left to the caller.
+        With persist=False nothing is written: the stock history entries and the
+        order document are left on the result for the caller to insert in bulk.
+        Stock history is taken from the ingested rows, before mappings merge
+        them: global uploads record the same raw per-row values, so the two
+        never see each other's stock as a change. It is recorded (or left on
+        self.stock_history) even when no order can be made.
+        """
+        if self.record_stock_history:
+            if persist:
+                await self.persist_stock_history(df)
+            else:
+                self.stock_history = self.stock_history_entries(df)
+        
+        df, merge_report = await self.map(df)
+        
+        df = await self.match(df)
+        df = self.compute(df)
+        df = self.filter(df)
+        df = self.append_seller_request(df)
+        logging.info(f"Final order: {len(df)} items")
+        
+        order = self.order_document(df)
+        if persist:
+            await self.persist_order(order)
+        
+        logging.info(
+            f"Order pipeline for store {self.store['name']}: " +
+            ", ".join(f"{stage} {ms:.1f}ms" for stage, ms in self.timings.items())
+        )
+        return OrderResult(df, order, self.timings, merge_report, self.stock_history)
+
+
+def iter_order_workbook(store_name: str, products: Iterable[str], orders: Iterable[float]) -> Iterator[bytes]:
+    """Order workbook (store name column + Заказ column, all cells bold) streamed in chunks"""
+    return iter_xlsx('Заказ', [store_name, 'Заказ'], zip(products, orders))
+
+
+def render_order_workbook(store_name: str, products: List[str], orders: List[float]) -> io.BytesIO:
+    """Whole order workbook in memory, for callers that need the bytes (e.g. ZIP archives)"""
+    return io.BytesIO(b"".join(iter_order_workbook(store_name, products, orders)))
@@ -1,94 +1,148 @@
 import logging
 import pandas as pd
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 from database import db
+from services.executor import run_blocking
+from services.mapping_automaton import SynonymAutomaton
+from services.filter_engine import FilterExpressionError, compile_condition, compile_filter
 
 
 def evaluate_filter_expression(expression: str, limits: float, ostatok: float, zakaz: float) -> bool:
     """
-    Safely evaluate filter expression.
-    Supported: Лимиты, Остаток, Заказ, +, -, *, /, >, <, >=, <=, ==, !=
+    Evaluate filter expression for a single row.
+    Supported: Лимиты, Остаток, Заказ, +, -, *, /, >, <, >=, <=, ==, !=, and, or, not
+    Raises FilterExpressionError for invalid expressions; use
+    services.filter_engine.apply_filters to filter whole frames.
     """
+    return compile_filter(expression).evaluate(limits, ostatok, zakaz)
+
+
+async def load_saved_filters():
+    """Compile every saved filter into the in-process compile cache, so order requests skip parsing"""
     try:
-        expr = expression.replace('Лимиты', str(limits))
-        expr = expr.replace('Остаток', str(ostatok))
-        expr = expr.replace('Заказ', str(zakaz))
-        
-        allowed_names = {}
-        allowed_ops = {'__builtins__': {}}
-        
-        result = eval(expr, allowed_ops, allowed_names)
-        return bool(result)
+        count = 0
+        async for saved in db.filters.find({}, {"_id": 0, "id": 1, "expression": 1}):
+            try:
+                compile_condition(saved["expression"])
+                count += 1
+            except FilterExpressionError as e:
+                logging.warning(f"Saved filter {saved['id']} is invalid and will be rejected in orders: {e}")
+        logging.info(f"Compiled {count} saved filters")
     except Exception as e:
-        logging.error(f"Filter expression error: {e}")
-        return True
+        logging.error(f"Error loading saved filters: {e}")
+
+
+MAPPINGS_VERSION_KEY = {"_type": "product_mappings"}
+
+# Compiled synonym automaton of this process, its group -> main product names
+# and the mappings version it was built from
+_mapping_automaton: Dict[str, Any] = {"version": None, "automaton": None, "groups": {}}
+
+
+async def bump_mappings_version():
+    """Invalidate compiled synonym automatons in every worker after a mapping write"""
+    await db.cache_versions.update_one(MAPPINGS_VERSION_KEY, {"$inc": {"version": 1}}, upsert=True)
+    _mapping_automaton["version"] = None
+    _mapping_automaton["automaton"] = None
+    _mapping_automaton["groups"] = {}
 
 
-async def apply_product_mappings(df: pd.DataFrame) -> pd.DataFrame:
+async def get_mapping_automaton() -> Tuple[Optional[SynonymAutomaton], Dict[str, str]]:
+    """
+    Synonym automaton built from all product_mappings plus its group_id -> main
+    product map, rebuilt only when the mappings version changes.
+    The automaton is None when there are no mappings.
+    """
+    version_doc = await db.cache_versions.find_one(MAPPINGS_VERSION_KEY, {"_id": 0, "version": 1})
+    version = version_doc.get("version", 0) if version_doc else 0
+    if _mapping_automaton["version"] == version:
+        return _mapping_automaton["automaton"], _mapping_automaton["groups"]
+    
+    # Build list of (pattern, group_id) for grouping, streaming every mapping
+    patterns = []
+    groups = {}
+    idx = 0
+    async for mapping in db.product_mappings.find({}, {"_id": 0, "main_product": 1, "synonyms": 1}):
+        main_product = mapping['main_product']
+        group_id = f"group_{idx}"
+        groups[group_id] = main_product
+        patterns.append((main_product.lower().strip(), group_id))
+        for synonym in mapping.get('synonyms', []):
+            patterns.append((synonym.lower().strip(), group_id))
+        idx += 1
+    
+    automaton = None
+    if patterns:
+        automaton = SynonymAutomaton(patterns)
+        logging.info(
+            f"Compiled synonym automaton: {len(groups)} mappings, {automaton.pattern_count} patterns, "
+            f"mappings version {version}"
+        )
+    
+    _mapping_automaton["version"] = version
+    _mapping_automaton["automaton"] = automaton
+    _mapping_automaton["groups"] = groups
+    return automaton, groups
+
+
+async def apply_product_mappings(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[Dict[str, Any]]]:
     """
     Apply product mappings (synonyms) and merge rows with same products.
     Searches for synonyms as SUBSTRINGS and merges them.
     Keeps the FIRST found full product name (preserves original name for limit matching).
     Sums up stock values for merged products.
+    
+    Returns the merged frame and a merge report with one entry per mapping
+    group found in the data: main product, kept name, source rows, summed stock.
+    Failures propagate: an order is never built from rows left unmerged.
     """
-    try:
-        # Get all mappings
-        mappings = await db.product_mappings.find({}, {"_id": 0}).to_list(1000)
-        
-        if not mappings:
-            return df
-        
-        # Build list of (pattern, group_id) for grouping
-        patterns = []
-        for idx, mapping in enumerate(mappings):
-            main_product = mapping['main_product']
-            group_id = f"group_{idx}"
-            patterns.append((main_product.lower().strip(), group_id))
-            for synonym in mapping.get('synonyms', []):
-                patterns.append((synonym.lower().strip(), group_id))
-        
-        # Sort patterns by length (longest first) to match most specific first
-        patterns.sort(key=lambda x: len(x[0]), reverse=True)
-        
-        # Find group for each product
-        def find_group(product_name):
-            product_lower = str(product_name).lower().strip()
-            for pattern, group_id in patterns:
-                if pattern in product_lower:
-                    return group_id
-            return None
-        
-        # Assign groups
-        df['_group'] = df['Товар'].apply(find_group)
-        
-        # For products with groups, merge them
-        grouped_products = df[df['_group'].notna()]
-        ungrouped_products = df[df['_group'].isna()].copy()
-        
-        if len(grouped_products) > 0:
-            # Group by _group, keep first product name, sum stock
-            merged = grouped_products.groupby('_group').agg({
-                'Товар': 'first',
-                'Остаток': 'sum'
-            }).reset_index(drop=True)
-            
-            # Log merges
-            for group_id in grouped_products['_group'].unique():
-                group_rows = grouped_products[grouped_products['_group'] == group_id]
-                if len(group_rows) > 1:
-                    merged_name = group_rows['Товар'].iloc[0]
-                    total_stock = group_rows['Остаток'].sum()
-                    logging.info(f"Merged {len(group_rows)} products into '{merged_name}' with total stock {total_stock}")
-            
-            # Combine merged and ungrouped
-            ungrouped_products = ungrouped_products.drop('_group', axis=1)
-            result = pd.concat([merged, ungrouped_products], ignore_index=True)
-        else:
-            result = ungrouped_products.drop('_group', axis=1)
-        
-        logging.info(f"Applied product mappings: {len(df)} rows -> {len(result)} rows")
-        return result
-        
-    except Exception as e:
-        logging.error(f"Error applying product mappings: {e}")
-        return df
+    automaton, groups = await get_mapping_automaton()
+    
+    if automaton is None:
+        return df, []
+    
+    # Longest synonym contained in the product name wins; each distinct name is looked up once
+    names = df['Товар'].astype(str)
+    unique_names = names.unique()
+    name_groups = await run_blocking(
+        lambda: {name: automaton.find_group(name.lower().strip()) for name in unique_names}
+    )
+    tagged = df.assign(_group=names.map(name_groups))
+    
+    has_group = tagged['_group'].notna()
+    grouped_products = tagged[has_group]
+    ungrouped_products = tagged[~has_group].drop('_group', axis=1)
+    
+    if len(grouped_products) == 0:
+        logging.info(f"Applied product mappings: {len(df)} rows -> {len(ungrouped_products)} rows")
+        return ungrouped_products, []
+    
+    # One groupby: keep first product name, sum stock, count source rows
+    merged = grouped_products.groupby('_group').agg(
+        Товар=('Товар', 'first'),
+        Остаток=('Остаток', 'sum'),
+        source_rows=('Товар', 'size')
+    )
+    
+    merge_report = [
+        {
+            "group": groups.get(group_id, group_id),
+            "product": product,
+            "source_rows": int(source_rows),
+            "stock": float(stock)
+        }
+        for group_id, product, stock, source_rows in zip(
+            merged.index, merged['Товар'], merged['Остаток'], merged['source_rows']
+        )
+    ]
+    
+    # Combine merged and ungrouped
+    merged = merged.drop('source_rows', axis=1).reset_index(drop=True)
+    result = pd.concat([merged, ungrouped_products], ignore_index=True)
+    
+    merged_groups = sum(1 for entry in merge_report if entry["source_rows"] > 1)
+    logging.info(
+        f"Applied product mappings: {len(df)} rows -> {len(result)} rows "
+        f"({merged_groups} groups merged from several rows)"
+    )
+    return result, merge_report
@@ -0,0 +1,381 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import db
+from services.downsample import lttb_indices
+
+# "changes": write an entry only when the stock changed (plus keyframes); "full": every observation
+STOCK_HISTORY_MODE = os.environ.get("STOCK_HISTORY_MODE", "changes")
+# In "changes" mode an unchanged value is still written when its last entry is this old; 0 disables keyframes
+STOCK_KEYFRAME_DAYS = float(os.environ.get("STOCK_KEYFRAME_DAYS", "7"))
+
+LatestEntries = Dict[Tuple[str, str], Dict[str, Any]]
+
+
+def as_datetime(value: Any) -> datetime:
+    """A timestamp as an aware datetime; also accepts ISO strings written before the datetime migration"""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+async def load_latest_entries(
+    store_ids: Iterable[str],
+    products: Optional[Iterable[str]] = None
+) -> LatestEntries:
+    """stock and recorded_at of the last entry per (store_id, product), read from stock_latest"""
+    query: Dict[str, Any] = {"store_id": {"$in": list(store_ids)}}
+    if products is not None:
+        query["product"] = {"$in": list(products)}
+    cursor = db.stock_latest.find(query, {"_id": 0, "store_id": 1, "product": 1, "stock": 1, "recorded_at": 1})
+    return {(doc["store_id"], doc["product"]): doc async for doc in cursor}
+
+
+class _EntrySelector:
+    """Decides which observations are written to stock_history in the configured mode"""
+    
+    def __init__(self, recorded_at: Any):
+        self.full = STOCK_HISTORY_MODE == "full"
+        self.keyframe_before = (
+            as_datetime(recorded_at) - timedelta(days=STOCK_KEYFRAME_DAYS) if STOCK_KEYFRAME_DAYS > 0 else None
+        )
+    
+    def keep(self, previous: Optional[Dict[str, Any]], change: float) -> bool:
+        if self.full or previous is None or change != 0:
+            return True
+        return self.keyframe_before is not None and as_datetime(previous["recorded_at"]) <= self.keyframe_before
+
+
+def history_mask(history: pd.DataFrame, recorded_at: Any, latest: LatestEntries) -> np.ndarray:
+    """Rows of a history_frame() that should be written (new, changed or due for a keyframe)"""
+    selector = _EntrySelector(recorded_at)
+    if selector.full:
+        return np.ones(len(history), dtype=bool)
+    return np.fromiter((
+        selector.keep(latest.get((store_id, product)), change)
+        for store_id, product, change in zip(
+            history["store_id"].tolist(), history["product"].tolist(), history["change"].tolist()
+        )
+    ), dtype=bool, count=len(history))
+
+
+def select_history_entries(entries: List[Dict[str, Any]], latest: LatestEntries) -> List[Dict[str, Any]]:
+    """
+    Fill in prev_stock/change from the latest values where missing and keep
+    the entries that should be written.
+    """
+    selected = []
+    selectors: Dict[Any, _EntrySelector] = {}
+    for entry in entries:
+        previous = latest.get((entry["store_id"], entry["product"]))
+        if "prev_stock" not in entry:
+            entry["prev_stock"] = previous["stock"] if previous else 0
+            entry["change"] = entry["stock"] - entry["prev_stock"]
+        selector = selectors.get(entry["recorded_at"])
+        if selector is None:
+            selector = selectors[entry["recorded_at"]] = _EntrySelector(entry["recorded_at"])
+        if selector.keep(previous, entry["change"]):
+            selected.append(entry)
+    return selected
+
+
+async def update_latest_stocks(entries: List[Dict[str, Any]]) -> None:
+    """
+    Upsert stock_history entries into stock_latest, one document per
+    (store_id, product). An entry only replaces a document recorded at the
+    same time or earlier, so a back-dated upload never hides newer stock.
+    """
+    if not entries:
+        return
+    
+    operations = []
+    for entry in entries:
+        recorded_at = as_datetime(entry["recorded_at"])
+        operations.append(UpdateOne(
+            {
+                "store_id": entry["store_id"],
+                "product": entry["product"],
+                # A string recorded_at predates migrations/bson_datetimes.py and never compares with a date
+                "$or": [{"recorded_at": {"$lte": recorded_at}}, {"recorded_at": {"$type": "string"}}]
+            },
+            {"$set": {
+                "store_name": entry["store_name"],
+                "stock": entry["stock"],
+                "prev_stock": entry.get("prev_stock", 0),
+                "change": entry.get("change", 0),
+                "recorded_at": recorded_at
+            }},
+            upsert=True
+        ))
+    
+    try:
+        await db.stock_latest.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # The guard did not match because a newer document exists; the upsert then hits the unique key
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+def bucket_day(recorded_at: Any) -> datetime:
+    """Start (UTC midnight) of the day whose stock_history bucket an observation belongs to"""
+    moment = as_datetime(recorded_at).astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+
+
+def history_point(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "recorded_at": as_datetime(entry["recorded_at"]),
+        "stock": entry["stock"],
+        "prev_stock": entry.get("prev_stock", 0),
+        "change": entry.get("change", 0)
+    }
+
+
+def bucket_operations(entries: List[Dict[str, Any]]) -> List[UpdateOne]:
+    """Upserts appending entries to their (store_id, product, day) stock_history bucket"""
+    buckets: Dict[Tuple[str, str, datetime], List[Dict[str, Any]]] = {}
+    store_names: Dict[str, Any] = {}
+    for entry in entries:
+        key = (entry["store_id"], entry["product"], bucket_day(entry["recorded_at"]))
+        buckets.setdefault(key, []).append(history_point(entry))
+        store_names[entry["store_id"]] = entry.get("store_name")
+    return [UpdateOne(
+        {"store_id": store_id, "product": product, "day": day},
+        {"$push": {"points": {"$each": points}}, "$set": {"store_name": store_names[store_id]}},
+        upsert=True
+    ) for (store_id, product, day), points in buckets.items()]
+
+
+async def append_history_buckets(entries: List[Dict[str, Any]]) -> None:
+    operations = bucket_operations(entries)
+    if operations:
+        await db.stock_history_buckets.bulk_write(operations, ordered=False)
+
+
+def rollup_operations(entries: List[Dict[str, Any]]) -> List[UpdateOne]:
+    """
+    Upserts adding the net stock change of each (store, UTC day, product)
+    among entries to its rollup document; unchanged values and keyframes do
+    not move the period change, so they are left out.
+    """
+    changes: Dict[Tuple[str, datetime, str], float] = {}
+    for entry in entries:
+        if entry.get("change", 0) != 0:
+            key = (entry["store_id"], bucket_day(entry["recorded_at"]), entry["product"])
+            changes[key] = changes.get(key, 0) + entry["change"]
+    return [UpdateOne(
+        {"store_id": store_id, "day": day, "product": product},
+        {"$inc": {"change": change}},
+        upsert=True
+    ) for (store_id, day, product), change in changes.items()]
+
+
+async def append_store_rollups(entries: List[Dict[str, Any]]) -> None:
+    operations = rollup_operations(entries)
+    if operations:
+        await db.stock_store_daily.bulk_write(operations, ordered=False)
+
+
+async def record_stock_history(
+    entries: List[Dict[str, Any]],
+    latest: Optional[LatestEntries] = None,
+    complete_stores: Iterable[str] = (),
+    recorded_at: Any = None
+) -> List[Dict[str, Any]]:
+    """
+    Append observations to their stock_history buckets (one document per
+    store, product and day), the store's daily rollup and stock_latest.
+    Only new or changed values (and keyframes) are written unless
+    STOCK_HISTORY_MODE=full. complete_stores are stores whose whole
+    assortment was observed at recorded_at (a global upload): their ingest
+    is logged in stock_ingests so readers can carry unchanged values
+    forward. Returns the entries that were written.
+    """
+    if entries:
+        if latest is None:
+            latest = await load_latest_entries(
+                {entry["store_id"] for entry in entries},
+                {entry["product"] for entry in entries}
+            )
+        written = select_history_entries(entries, latest)
+    else:
+        written = []
+    
+    if written:
+        await append_history_buckets(written)
+        await append_store_rollups(written)
+        await update_latest_stocks(written)
+    
+    complete_stores = list(complete_stores)
+    if complete_stores and recorded_at is not None:
+        await db.stock_ingests.insert_many([
+            {"store_id": store_id, "recorded_at": as_datetime(recorded_at)} for store_id in complete_stores
+        ])
+    
+    if len(written) < len(entries):
+        logging.info(f"Stock history: {len(written)} of {len(entries)} observations written ({STOCK_HISTORY_MODE} mode)")
+    return written
+
+
+async def _last_ingest(store_id: str) -> Optional[Any]:
+    doc = await db.stock_ingests.find_one({"store_id": store_id}, {"_id": 0, "recorded_at": 1}, sort=[("recorded_at", -1)])
+    return doc["recorded_at"] if doc else None
+
+
+async def period_changes(store_id: str, start: Any) -> Dict[str, float]:
+    """Net stock change per product since the UTC day of start, summed by the server from the daily rollups"""
+    cursor = db.stock_store_daily.aggregate([
+        {"$match": {"store_id": store_id, "day": {"$gte": bucket_day(start)}}},
+        {"$group": {"_id": "$product", "change": {"$sum": "$change"}}}
+    ])
+    return {doc["_id"]: doc["change"] async for doc in cursor}
+
+
+async def latest_store_stock(store_id: str, since: Any = None) -> List[Dict[str, Any]]:
+    """
+    Latest stock of every product of a store, sorted by product.
+    
+    Without since, prev_stock/change describe the store's last global upload:
+    a product it did not write was unchanged there, rather than reporting
+    the earlier upload that last changed it. With since, change is the net
+    change over the period (whole UTC days, from the daily rollups) and
+    prev_stock the stock before it.
+    """
+    docs = await db.stock_latest.find({"store_id": store_id}, {"_id": 0}).sort("product", 1).to_list(10000)
+    last_ingest = await _last_ingest(store_id)
+    last_ingest_at = as_datetime(last_ingest) if last_ingest is not None else None
+    changes = await period_changes(store_id, since) if since is not None else None
+    
+    products = []
+    for doc in docs:
+        unchanged = last_ingest_at is not None and as_datetime(doc["recorded_at"]) < last_ingest_at
+        if changes is not None:
+            change = round(changes.get(doc["product"], 0), 6)
+            prev_stock = round(doc["stock"] - change, 6)
+        elif unchanged:
+            change, prev_stock = 0, doc["stock"]
+        else:
+            change, prev_stock = doc.get("change", 0), doc.get("prev_stock", 0)
+        products.append({
+            "product": doc["product"],
+            "latest_stock": doc["stock"],
+            "prev_stock": prev_stock,
+            "change": change,
+            "last_updated": last_ingest if unchanged else doc["recorded_at"]
+        })
+    return products
+
+
+def step_series(
+    entries: List[Dict[str, Any]],
+    base: Optional[Dict[str, Any]],
+    ingest_times: List[Any]
+) -> List[Dict[str, Any]]:
+    """
+    Step-wise stock series of one product: the stored entries, plus a point
+    with the carried-forward stock (change 0) at every global upload of the
+    store that did not write an entry for it. base is the last entry before
+    the window, the value carried into it.
+    """
+    by_time = {as_datetime(entry["recorded_at"]): entry for entry in entries}
+    ingests = {as_datetime(value): value for value in ingest_times}
+    
+    series = []
+    current = base
+    for moment in sorted(set(by_time) | set(ingests)):
+        entry = by_time.get(moment)
+        if entry is not None:
+            series.append(entry)
+            current = entry
+        elif current is not None:
+            series.append({
+                "store_id": current["store_id"],
+                "store_name": current.get("store_name"),
+                "product": current["product"],
+                "stock": current["stock"],
+                "prev_stock": current["stock"],
+                "change": 0,
+                "recorded_at": ingests[moment]
+            })
+    return series
+
+
+def bucket_entries(bucket: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The points of a bucket as stock_history entries, in recorded order"""
+    entries = [{
+        "store_id": bucket["store_id"],
+        "store_name": bucket.get("store_name"),
+        "product": bucket["product"],
+        **point
+    } for point in bucket.get("points", [])]
+    entries.sort(key=lambda entry: as_datetime(entry["recorded_at"]))
+    return entries
+
+
+def downsample_series(series: List[Dict[str, Any]], max_points: int) -> List[Dict[str, Any]]:
+    """
+    At most max_points points of a series by LTTB over (time, stock); first
+    and last are kept. The change of every dropped point is folded into the
+    next kept one, whose prev_stock becomes the stock of the kept point before
+    it, so the changes still add up to the stock movement.
+    """
+    if len(series) <= max_points:
+        return series
+    x = np.fromiter((as_datetime(point["recorded_at"]).timestamp() for point in series), dtype=np.float64, count=len(series))
+    y = np.fromiter((point["stock"] for point in series), dtype=np.float64, count=len(series))
+    kept = lttb_indices(x, y, max_points).tolist()
+    
+    downsampled = [series[kept[0]]]
+    for previous, index in zip(kept, kept[1:]):
+        point = dict(series[index])
+        if index - previous > 1:
+            point["change"] = sum(series[i].get("change", 0) for i in range(previous + 1, index + 1))
+            point["prev_stock"] = series[previous]["stock"]
+        downsampled.append(point)
+    return downsampled
+
+
+async def product_stock_series(
+    store_id: str,
+    product: str,
+    start: Any,
+    max_points: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    stock_history of one product since start, reconstructed into a step-wise
+    series and downsampled to max_points on the server. Reads one bucket per
+    day of the period plus the last bucket before it.
+    """
+    start_at = as_datetime(start)
+    start_day = bucket_day(start)
+    query = {"store_id": store_id, "product": product}
+    
+    buckets = await db.stock_history_buckets.find(
+        {**query, "day": {"$gte": start_day}}, {"_id": 0}
+    ).sort("day", 1).to_list(None)
+    previous = await db.stock_history_buckets.find_one(
+        {**query, "day": {"$lt": start_day}}, {"_id": 0}, sort=[("day", -1)]
+    )
+    
+    base = bucket_entries(previous)[-1] if previous and previous.get("points") else None
+    entries = []
+    for bucket in buckets:
+        for entry in bucket_entries(bucket):
+            if as_datetime(entry["recorded_at"]) < start_at:
+                base = entry
+            else:
+                entries.append(entry)
+    
+    ingests = await db.stock_ingests.find(
+        {"store_id": store_id, "recorded_at": {"$gte": start_at}},
+        {"_id": 0, "recorded_at": 1}
+    ).to_list(None)
+    series = step_series(entries, base, [doc["recorded_at"] for doc in ingests])
+    return downsample_series(series, max_points) if max_points else series
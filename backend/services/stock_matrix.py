@@ -0,0 +1,331 @@
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from database import db
+from services.executor import run_blocking
+from services.global_stock import get_snapshot, load_snapshot_frame
+
+# float32 holds 7 significant digits; widened values are rounded to those and to at most this many decimals
+FLOAT32_DIGITS = 7
+WIDEN_DECIMALS = 6
+
+# Memory-mapped copy of the latest snapshot shared by all workers on the host; empty disables it
+STOCK_MATRIX_PATH = os.environ.get(
+    "STOCK_MATRIX_PATH",
+    os.path.join(tempfile.gettempdir(), f"order_planner_{os.environ.get('DB_NAME', 'default')}_stock.matrix")
+)
+
+# Seconds a worker trusts its matrix before checking for a newer upload again
+STOCK_MATRIX_RECHECK_SECONDS = float(os.environ.get("STOCK_MATRIX_RECHECK_SECONDS", "5"))
+
+# File layout: header | float32 or float64 values (products x stores, C order)
+#   | index: uint32 rows sorted by product name, then uint64 offsets of each name in the names block
+#   | names: UTF-8 product names back to back, then the store list as JSON
+MATRIX_MAGIC = b"GSTOCKMX"
+MATRIX_FORMAT_VERSION = 3
+# magic, format, products, stores, value size, values/index/names offsets, names length, snapshot id
+MATRIX_HEADER = struct.Struct("<8sIIIIQQQQ64s")
+MATRIX_HEADER_SIZE = 128
+
+
+class MappedNames:
+    """
+    Read-only product names of a mapped matrix file, decoded from the shared
+    pages only when indexed, so workers do not each keep a copy of the list.
+    """
+    
+    def __init__(self, buffer: Any, offset: int, bounds: np.ndarray):
+        self._buffer = buffer
+        self._offset = offset
+        self._bounds = bounds
+    
+    def __len__(self) -> int:
+        return len(self._bounds) - 1
+    
+    def _name(self, row: int) -> str:
+        start = self._offset + int(self._bounds[row])
+        return self._buffer[start:self._offset + int(self._bounds[row + 1])].decode("utf-8")
+    
+    def __getitem__(self, key: Union[int, slice, np.ndarray]) -> Union[str, np.ndarray]:
+        """One name, or an object array of the names at a slice, positions or boolean mask"""
+        if isinstance(key, (int, np.integer)):
+            row = int(key)
+            return self._name(row + len(self) if row < 0 else row)
+        rows = np.arange(len(self))[key]
+        names = np.empty(len(rows), dtype=object)
+        names[:] = [self._name(row) for row in rows.tolist()]
+        return names
+    
+    def tolist(self) -> List[str]:
+        return [self._name(row) for row in range(len(self))]
+
+
+def _align(offset: int, size: int = 8) -> int:
+    return -(-offset // size) * size
+
+
+class StockMatrix:
+    """
+    One global stock snapshot as a read-only float32 matrix (products x stores),
+    or float64 when some value does not survive float32 (see narrow).
+    Products are found by binary search over rows sorted by name and stores
+    through an index map, so per-store and per-product lookups are array
+    slices. A mapped matrix reads values and product names straight from the
+    shared file; only the short store list is decoded per worker.
+    """
+    
+    def __init__(
+        self,
+        snapshot_id: str,
+        products: Union[Sequence[str], MappedNames],
+        stores: List[str],
+        values: np.ndarray,
+        buffer: Optional[Any] = None,
+        order: Optional[np.ndarray] = None
+    ):
+        self.snapshot_id = snapshot_id
+        # Backing mmap of a mapped file: values, names and order are zero-copy views into it
+        self._buffer = buffer
+        self.products = products if isinstance(products, MappedNames) else np.asarray(products, dtype=object)
+        self.stores = list(stores)
+        self.store_index: Dict[str, int] = {store: i for i, store in enumerate(stores)}
+        self.values = np.ascontiguousarray(values).reshape(len(products), len(stores))
+        if self.values.flags.writeable:
+            self.values.flags.writeable = False
+        # Row positions in product name order
+        self.order = np.argsort(self.products, kind="stable").astype(np.uint32) if order is None else order
+    
+    @classmethod
+    def from_frame(cls, snapshot_id: str, frame: pd.DataFrame) -> "StockMatrix":
+        return cls(snapshot_id, frame.index.tolist(), [str(store) for store in frame.columns], narrow(frame.to_numpy()))
+    
+    def __len__(self) -> int:
+        return len(self.products)
+    
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+    
+    @property
+    def mapped(self) -> bool:
+        return self._buffer is not None
+    
+    def column(self, store: str) -> np.ndarray:
+        """Stored stock of every product in one store (zeros for a store absent from the snapshot)"""
+        position = self.store_index.get(store)
+        if position is None:
+            return np.zeros(len(self.products), dtype=self.values.dtype)
+        return self.values[:, position]
+    
+    def row(self, product: str) -> Optional[int]:
+        """Row of a product, None when it is not in the snapshot"""
+        found = bisect.bisect_left(self.order, product, key=lambda row: self.products[row])
+        if found < len(self.order) and self.products[self.order[found]] == product:
+            return int(self.order[found])
+        return None
+    
+    def stock(self, product: str, store: str) -> float:
+        """Stock of one product in one store (0 when either is absent)"""
+        row = self.row(product)
+        column = self.store_index.get(store)
+        if row is None or column is None:
+            return 0.0
+        return float(widen(self.values[row, column]))
+    
+    def frame(self, stores: Optional[Iterable[str]] = None, rows: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """
+        float64 product x store frame of some stores (those present in the
+        snapshot) and rows (a boolean mask or positions; all by default).
+        """
+        wanted = self.stores if stores is None else [s for s in dict.fromkeys(stores) if s in self.store_index]
+        positions = [self.store_index[store] for store in wanted]
+        values = self.values[:, positions] if rows is None else self.values[np.ix_(rows, positions)]
+        products = self.products[:] if rows is None else self.products[rows]
+        return pd.DataFrame(widen(values), index=pd.Index(products, name="product"), columns=wanted)
+
+
+def widen(values: np.ndarray) -> np.ndarray:
+    """
+    Stored stock as float64. float32 values are rounded to the 7 significant
+    digits float32 carries (and at most WIDEN_DECIMALS decimals), which drops
+    float32 noise: 1.3 instead of 1.2999999523, 123456.7 instead of 123456.703125.
+    """
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values.astype(np.float64)
+    wide = values.astype(np.float64)
+    magnitude = np.zeros_like(wide)
+    np.floor(np.log10(np.abs(wide), out=magnitude, where=np.isfinite(wide) & (wide != 0)), out=magnitude)
+    scale = 10.0 ** np.clip(FLOAT32_DIGITS - 1 - magnitude, 0, WIDEN_DECIMALS)
+    return np.round(wide * scale) / scale
+
+
+def narrow(values: np.ndarray) -> np.ndarray:
+    """
+    float32 copy of float64 stock when every value widens back unchanged, the
+    float64 values otherwise. Supported by float32: up to 7 significant digits
+    and WIDEN_DECIMALS decimals, integers up to 2**24 (1.3, 123456.7, 16777216);
+    a single value outside that (1234567.8, 0.1234567) keeps the whole
+    snapshot in float64.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    narrowed = values.astype(np.float32)
+    return narrowed if np.array_equal(widen(narrowed), values, equal_nan=True) else values
+
+
+def write_matrix_file(path: str, matrix: StockMatrix) -> None:
+    """Write a matrix file next to path and move it into place atomically"""
+    encoded = [product.encode("utf-8") for product in matrix.products.tolist()]
+    bounds = np.zeros(len(encoded) + 1, dtype="<u8")
+    np.cumsum([len(name) for name in encoded], out=bounds[1:])
+    stores = json.dumps(matrix.stores, ensure_ascii=False).encode("utf-8")
+    values = np.ascontiguousarray(matrix.values, dtype=matrix.values.dtype.newbyteorder("<"))
+    order = np.ascontiguousarray(matrix.order, dtype="<u4")
+    
+    index_offset = _align(MATRIX_HEADER_SIZE + values.nbytes)
+    names_offset = index_offset + _align(order.nbytes) + bounds.nbytes
+    names_length = int(bounds[-1]) + len(stores)
+    header = MATRIX_HEADER.pack(
+        MATRIX_MAGIC, MATRIX_FORMAT_VERSION, len(matrix), len(matrix.stores), values.itemsize,
+        MATRIX_HEADER_SIZE, index_offset, names_offset, names_length, matrix.snapshot_id.encode("ascii")
+    )
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".stock_matrix_")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(header.ljust(MATRIX_HEADER_SIZE, b"\0"))
+            handle.write(values.tobytes())
+            handle.write(b"\0" * (index_offset - MATRIX_HEADER_SIZE - values.nbytes))
+            handle.write(order.tobytes().ljust(_align(order.nbytes), b"\0"))
+            handle.write(bounds.tobytes())
+            handle.writelines(encoded)
+            handle.write(stores)
+            handle.flush()
+            os.fsync(handle.fileno())
+        # Readers that already mapped the previous file keep it until they swap
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def map_matrix_file(path: str) -> Optional[StockMatrix]:
+    """Map a matrix file read-only; None when it is missing or not in the current format"""
+    try:
+        with open(path, "rb") as handle:
+            if os.fstat(handle.fileno()).st_size < MATRIX_HEADER_SIZE:
+                return None
+            buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    
+    (
+        magic, version, products_count, stores_count, value_size,
+        values_offset, index_offset, names_offset, names_length, snapshot_id
+    ) = MATRIX_HEADER.unpack_from(buffer, 0)
+    if magic != MATRIX_MAGIC or version != MATRIX_FORMAT_VERSION:
+        return None
+    
+    values = np.frombuffer(
+        buffer, dtype=f"<f{value_size}", count=products_count * stores_count, offset=values_offset
+    )
+    order = np.frombuffer(buffer, dtype="<u4", count=products_count, offset=index_offset)
+    bounds = np.frombuffer(
+        buffer, dtype="<u8", count=products_count + 1, offset=index_offset + _align(order.nbytes)
+    )
+    stores = json.loads(buffer[names_offset + int(bounds[-1]):names_offset + names_length].decode("utf-8"))
+    return StockMatrix(
+        snapshot_id.rstrip(b"\0").decode("ascii"), MappedNames(buffer, names_offset, bounds), stores,
+        values.reshape(products_count, stores_count), buffer=buffer, order=order
+    )
+
+
+class StockMatrixCache:
+    """
+    Process-level handle on the latest global stock snapshot as a StockMatrix.
+    
+    get() checks the id of the latest upload (an indexed, id-only query) at
+    most every STOCK_MATRIX_RECHECK_SECONDS. When it changed, the worker maps the shared matrix file read-only and
+    swaps to it; only when the file is missing or older than the upload is
+    the snapshot loaded from MongoDB and the file rewritten. An upload handled
+    by this process publishes the file directly and is served at once; other
+    workers pick it up at their next check. Without a path (or when the
+    file cannot be written) the matrix stays in process memory.
+    """
+    
+    def __init__(self, path: Optional[str] = STOCK_MATRIX_PATH):
+        self.path = path or None
+        self._matrix: Optional[StockMatrix] = None
+        self._lock = asyncio.Lock()
+        # time.monotonic() of the last check that found the current matrix to be the latest
+        self._checked_at = float("-inf")
+    
+    async def publish(self, snapshot_id: str, frame: pd.DataFrame) -> StockMatrix:
+        """Make a freshly saved snapshot the current matrix of every worker"""
+        matrix = StockMatrix.from_frame(snapshot_id, frame)
+        if self.path:
+            try:
+                await run_blocking(write_matrix_file, self.path, matrix)
+                mapped = await run_blocking(map_matrix_file, self.path)
+                # Another worker may have published a different snapshot in between
+                if mapped is not None and mapped.snapshot_id == snapshot_id:
+                    matrix = mapped
+            except OSError as e:
+                logging.warning(f"Stock matrix file {self.path} not written ({e}); keeping it in process memory")
+        self._matrix = matrix
+        self._checked_at = time.monotonic()
+        return matrix
+    
+    async def get(self) -> Optional[StockMatrix]:
+        matrix = self._matrix
+        if matrix is not None and time.monotonic() - self._checked_at < STOCK_MATRIX_RECHECK_SECONDS:
+            return matrix
+        
+        checked_at = time.monotonic()
+        latest = await db.global_stock.find_one({}, {"_id": 0, "id": 1}, sort=[("uploaded_at", -1)])
+        if not latest:
+            return None
+        matrix = self._matrix
+        if matrix is not None and matrix.snapshot_id == latest["id"]:
+            self._checked_at = checked_at
+            return matrix
+        
+        async with self._lock:
+            matrix = self._matrix
+            if matrix is not None and matrix.snapshot_id == latest["id"]:
+                return matrix
+            
+            if self.path:
+                mapped = await run_blocking(map_matrix_file, self.path)
+                if mapped is not None and mapped.snapshot_id == latest["id"]:
+                    self._matrix = mapped
+                    self._checked_at = checked_at
+                    return mapped
+            
+            snapshot = await get_snapshot(latest["id"])
+            if not snapshot:
+                return None
+            matrix = await self.publish(snapshot["id"], await load_snapshot_frame(snapshot))
+            logging.info(
+                f"Stock matrix loaded: snapshot {matrix.snapshot_id}, {len(matrix)} products x "
+                f"{len(matrix.stores)} stores, {matrix.nbytes / (1024 * 1024):.1f} MiB"
+                f"{' (memory-mapped)' if matrix.mapped else ''}"
+            )
+            return matrix
+
+
+stock_matrix_cache = StockMatrixCache()
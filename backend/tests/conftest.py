@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import motor.motor_asyncio
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+# Backend modules import each other as top-level packages (database, services, ...)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# database.py reads these at import time; the client connects lazily
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "limit_planner_test")
+# Keep pool jobs in-process: spawned workers would not see the in-memory database
+os.environ.setdefault("CPU_POOL_KIND", "thread")
+os.environ.setdefault("STOCK_MATRIX_PATH", "")
+
+# database.py builds its client from this name: every test runs on an in-memory MongoDB
+motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+
+
+async def _drop_collections(database) -> None:
+    for name in await database.list_collection_names():
+        await database.drop_collection(name)
+
+
+def _reset_process_caches() -> None:
+    """Forget what this process cached from an earlier test's database"""
+    import services.match_memo
+    import services.processing
+    from services.matching import matcher_cache
+    from services.stock_matrix import stock_matrix_cache
+    
+    for store_id in {key[0] for key in list(matcher_cache._entries)}:
+        matcher_cache.evict_store(store_id)
+    services.match_memo._collected_versions.clear()
+    services.processing._mapping_automaton["version"] = None
+    stock_matrix_cache._matrix = None
+
+
+@pytest.fixture
+def db():
+    """The application database, emptied before and after the test"""
+    from database import db as database
+    
+    asyncio.run(_drop_collections(database))
+    _reset_process_caches()
+    yield database
+    asyncio.run(_drop_collections(database))
+
+
+@pytest.fixture
+def client(db):
+    """TestClient of the API on the emptied database, with startup/shutdown run"""
+    from fastapi.testclient import TestClient
+    
+    import server
+    
+    with TestClient(server.app) as test_client:
+        yield test_client
@@ -0,0 +1,36 @@
+import asyncio
+import threading
+
+import pytest
+
+import services.executor as executor
+from services.executor import ExecutorBusyError, ExecutorTimeoutError, run_blocking
+
+
+def test_timed_out_job_keeps_its_slot_until_it_finishes(monkeypatch):
+    monkeypatch.setattr(executor, "CPU_POOL_MAX_PENDING", 1)
+    release = threading.Event()
+    finished = threading.Event()
+    
+    def job():
+        release.wait(5)
+        finished.set()
+        return "done"
+    
+    async def scenario():
+        with pytest.raises(ExecutorTimeoutError):
+            await run_blocking(job, timeout=0.05)
+        # The job is still running in the pool, so the cap still counts it
+        with pytest.raises(ExecutorBusyError):
+            await run_blocking(job, timeout=0.05)
+        
+        release.set()
+        await asyncio.to_thread(finished.wait, 5)
+        for _ in range(100):
+            if executor._pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        return await run_blocking(job)
+    
+    assert asyncio.run(scenario()) == "done"
+    assert executor._pending == 0
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from services.filter_engine import (
+    FilterExpressionError,
+    apply_filters,
+    compile_condition,
+    compile_filter,
+    compile_filters,
+    describe_filter,
+)
+
+
+ROWS = pd.DataFrame({
+    'Лимиты': [20, 10, 15, 30, 6, 3],
+    'Остаток': [12, 5, 3, 29, 0, 1],
+    'Заказ': [8, 5, 12, 1, 6, 2],
+})
+
+EXPRESSIONS = [
+    "Заказ >= 5",
+    "Остаток < Лимиты / 3",
+    "Заказ != 1 and Заказ != 2",
+    "Заказ > Лимиты / 2",
+    "Заказ > 5 and Остаток < 10",
+    "Заказ > 20 or Остаток < 3",
+    "not Заказ == 6",
+    "2 < Заказ <= 8",
+    "Остаток < Лимиты - 10",
+    "Заказ % 2 == 0",
+]
+
+
+def python_eval(expression, row):
+    env = {'Лимиты': row['Лимиты'], 'Остаток': row['Остаток'], 'Заказ': row['Заказ']}
+    return bool(eval(expression, {'__builtins__': {}}, env))
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_mask_matches_row_by_row_eval(expression):
+    expected = [python_eval(expression, row) for _, row in ROWS.iterrows()]
+    assert compile_filter(expression).mask(ROWS).tolist() == expected
+
+
+def test_apply_filters_combines_masks():
+    filters = [compile_filter(expr) for expr in ("Заказ >= 5", "Остаток < 10")]
+    assert apply_filters(ROWS, filters)['Заказ'].tolist() == [5, 12, 6]
+
+
+@pytest.mark.parametrize("expression", [
+    "Заказ >=",
+    "Цена > 5",
+    "__import__('os').system('ls')",
+    "Заказ ** 2 > 4",
+    "[Заказ][0] > 1",
+    "Заказ > 'a'",
+])
+def test_invalid_expressions_are_rejected(expression):
+    with pytest.raises(FilterExpressionError):
+        compile_filter(expression)
+
+
+def test_canonical_form_and_types():
+    compiled = compile_filter("Заказ>=5   and(Остаток<Лимиты/3)")
+    assert compiled.canonical == "Заказ >= 5 and Остаток < Лимиты / 3"
+    assert compiled.result_type == 'bool'
+    assert compile_filter("Лимиты * 2").result_type == 'number'
+    assert set(compiled.variables) == {'Заказ', 'Остаток', 'Лимиты'}
+
+
+def test_saved_filters_must_be_conditions_and_are_reused():
+    with pytest.raises(FilterExpressionError):
+        compile_condition("Лимиты * 2")
+
+    compiled = compile_condition("Заказ>=5")
+    assert compile_filters(["Заказ>=5", " "]) == [compiled]
+    assert compile_filters(["Заказ>=5"])[0] is compiled
+
+    assert describe_filter("Заказ >= 5")["cost"] == 3
+    assert describe_filter("Заказ >")["valid"] is False
@@ -0,0 +1,144 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from services.global_stock import (
+    _unpack_column, history_frame, snapshot_chunks, stock_data, stock_history_documents, stock_matrix
+)
+
+
+def test_stock_matrix_coerces_cells_and_drops_blank_products():
+    df = pd.DataFrame({
+        "Товар": ["Табак 25", " Табак 250 ", np.nan, "", "nan", "Табак 25"],
+        "Электро": [1, "x", 3, 4, 5, 7.5],
+        "Точка": [1.5, 2, 3, 4, 5, "8"],
+    })
+    assert stock_data(stock_matrix(df)) == {
+        "Табак 25": {"Электро": 7.5, "Точка": 8.0},
+        "Табак 250": {"Электро": 0.0, "Точка": 2.0},
+    }
+
+
+def test_history_documents_for_matched_stores_only():
+    stock = stock_matrix(pd.DataFrame({"Товар": ["a", "b"], "S1": [5, 1], "S2": [3, 0], "Склад": [9, 9]}))
+    history = history_frame(stock, {"S1": "id1", "S2": "id2"}, {("id1", "a"): 2, ("id2", "b"): 4})
+    documents = stock_history_documents(history, "2024-01-01T00:00:00+00:00")
+    
+    assert [(d["product"], d["store_id"], d["stock"], d["prev_stock"], d["change"]) for d in documents] == [
+        ("a", "id1", 5.0, 2.0, 3.0),
+        ("a", "id2", 3.0, 0.0, 3.0),
+        ("b", "id1", 1.0, 0.0, 1.0),
+        ("b", "id2", 0.0, 4.0, -4.0),
+    ]
+    ids = [uuid.UUID(d["id"]) for d in documents]
+    assert all(i.version == 4 for i in ids) and len(set(ids)) == len(ids)
+
+
+def test_snapshot_chunks_split_products_and_store_columns():
+    stock = stock_matrix(pd.DataFrame({"Товар": ["a", "b", "c"], "S1": [1, 2.5, 3], "S2": [0, 0, 7]}))
+    chunks = snapshot_chunks("snap", stock, chunk_size=2)
+    
+    products = [p for c in chunks if c["kind"] == "products" for p in c["products"]]
+    assert products == ["a", "b", "c"]
+    s2 = np.concatenate([_unpack_column(c["values"]) for c in chunks if c.get("column") == "S2"])
+    assert s2.tolist() == [0.0, 0.0, 7.0]
+    assert {c["chunk"] for c in chunks} == {0, 1}
+
+
+def test_stock_matrix_columns_rows_and_widening():
+    from services.stock_matrix import StockMatrix
+    
+    frame = pd.DataFrame({"S1": [1.3, 0, 5], "Электро": [3, 2, 9]}, index=["a", "b", "c"])
+    matrix = StockMatrix.from_frame("snap", frame)
+    
+    assert matrix.values.dtype == np.float32
+    assert matrix.column("Нет такой").tolist() == [0, 0, 0]
+    assert matrix.stock("a", "S1") == 1.3
+    sliced = matrix.frame(["S1", "Нет такой"], rows=matrix.column("Электро") - 2 > 0)
+    assert sliced.to_dict(orient="index") == {"a": {"S1": 1.3}, "c": {"S1": 5.0}}
+
+
+def test_float32_range_and_float64_fallback(tmp_path):
+    from services.stock_matrix import StockMatrix, map_matrix_file, widen, write_matrix_file
+    
+    supported = [1.3, 0.1, 1234.3, 123456.7, 9999999.0, 16777216.0, -2.5, 0.0, np.nan]
+    matrix = StockMatrix.from_frame("snap", pd.DataFrame({"S1": supported}, index=list("abcdefghi")))
+    assert matrix.values.dtype == np.float32
+    np.testing.assert_array_equal(widen(matrix.column("S1")), supported)
+    
+    for outside in (1234567.8, 0.1234567, 16777217.0, 12345678.5):
+        frame = pd.DataFrame({"S1": [1.3, outside]}, index=["a", "b"])
+        matrix = StockMatrix.from_frame("snap", frame)
+        assert matrix.values.dtype == np.float64
+        assert matrix.stock("b", "S1") == outside
+        assert matrix.frame().equals(frame.rename_axis("product"))
+        
+        path = str(tmp_path / "stock.matrix")
+        write_matrix_file(path, matrix)
+        mapped = map_matrix_file(path)
+        assert mapped.values.dtype == np.float64 and mapped.stock("b", "S1") == outside
+
+
+def test_matrix_file_maps_read_only_and_is_replaced_atomically(tmp_path):
+    from services.stock_matrix import StockMatrix, map_matrix_file, write_matrix_file
+    
+    path = str(tmp_path / "stock.matrix")
+    frame = pd.DataFrame({"S1": [1.5, 2.0], "Электро": [3.0, 0.0]}, index=["a", "б"])
+    write_matrix_file(path, StockMatrix.from_frame("snap-1", frame))
+    first = map_matrix_file(path)
+    write_matrix_file(path, StockMatrix.from_frame("snap-2", frame * 2))
+    second = map_matrix_file(path)
+    
+    assert first.mapped and not first.values.flags.writeable
+    assert (first.snapshot_id, first.stock("б", "S1")) == ("snap-1", 2.0)
+    assert (second.snapshot_id, second.stock("б", "S1")) == ("snap-2", 4.0)
+    assert map_matrix_file(str(tmp_path / "missing.matrix")) is None
+
+
+def test_mapped_matrix_reads_product_names_from_the_file(tmp_path):
+    from services.stock_matrix import MappedNames, StockMatrix, map_matrix_file, write_matrix_file
+    
+    path = str(tmp_path / "stock.matrix")
+    products = ["Табак 250", "a", "Табак 25", ""]
+    frame = pd.DataFrame({"S1": [1.0, 2.0, 3.0, 4.0], "Электро": [5.0, 0.0, 3.0, 0.0]}, index=products)
+    write_matrix_file(path, StockMatrix.from_frame("snap", frame))
+    mapped = map_matrix_file(path)
+    
+    assert isinstance(mapped.products, MappedNames)
+    assert mapped.products.tolist() == products and mapped.products[-1] == ""
+    assert mapped.stores == ["S1", "Электро"]
+    assert [mapped.stock(product, "S1") for product in products] == [1.0, 2.0, 3.0, 4.0]
+    assert mapped.row("Табак") is None and mapped.row("я") is None
+    rows = mapped.column("Электро") > 0
+    assert mapped.frame(["S1"], rows=rows).equals(StockMatrix.from_frame("snap", frame).frame(["S1"], rows=rows))
+
+
+def test_matrix_cache_rechecks_the_latest_upload_after_a_while(tmp_path, monkeypatch):
+    import asyncio
+    
+    from mongomock_motor import AsyncMongoMockClient
+    
+    import services.stock_matrix
+    from services.stock_matrix import StockMatrix, StockMatrixCache, write_matrix_file
+    
+    database = AsyncMongoMockClient()["limit_planner_test"]
+    monkeypatch.setattr(services.stock_matrix, "db", database)
+    path = str(tmp_path / "stock.matrix")
+    frame = pd.DataFrame({"S1": [1.0]}, index=["a"])
+    cache = StockMatrixCache(path)
+    
+    async def scenario():
+        await database.global_stock.insert_one({"id": "snap-1", "uploaded_at": "2024-01-01"})
+        await cache.publish("snap-1", frame)
+        # Another worker publishes a newer upload
+        await database.global_stock.insert_one({"id": "snap-2", "uploaded_at": "2024-01-02"})
+        write_matrix_file(path, StockMatrix.from_frame("snap-2", frame * 2))
+        
+        cached = await cache.get()
+        monkeypatch.setattr(services.stock_matrix, "STOCK_MATRIX_RECHECK_SECONDS", 0)
+        return cached, await cache.get()
+    
+    cached, rechecked = asyncio.run(scenario())
+    assert cached.snapshot_id == "snap-1"
+    assert (rechecked.snapshot_id, rechecked.stock("a", "S1")) == ("snap-2", 2.0)
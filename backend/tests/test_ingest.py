@@ -0,0 +1,133 @@
+import datetime
+import zipfile
+
+import pandas as pd
+from openpyxl import Workbook
+
+from services.ingest import read_table
+
+
+def test_xlsx_matches_pandas_read_excel(tmp_path):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["Товар", "Остаток", None, "Дата", "Товар"])
+    sheet.append(["Табак 25", 3, None, datetime.datetime(2024, 1, 2), "x"])
+    sheet.append(["Табак 250", 2.5, "z", datetime.datetime(2024, 1, 3, 12, 30), "y"])
+    sheet["A5"] = "после пропуска"
+    path = tmp_path / "stock.xlsx"
+    workbook.save(path)
+    
+    result = read_table(str(path))
+    expected = pd.read_excel(path)
+    assert list(result.columns) == ["Товар", "Остаток", "Unnamed: 2", "Дата", "Товар.1"]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_integer_columns_stay_integer(tmp_path):
+    path = tmp_path / "stock.xlsx"
+    pd.DataFrame({"Товар": ["a", "b"], "Остаток": [1, 2]}).to_excel(path, index=False)
+    assert read_table(str(path))["Остаток"].dtype == "int64"
+
+
+def test_csv_with_semicolons_decimal_comma_and_cp1251(tmp_path):
+    path = tmp_path / "stock.csv"
+    path.write_bytes("Товар;Остаток\nТабак 25;1,5\nТабак 250;\n".encode("cp1251"))
+    
+    df = read_table(str(path))
+    assert df["Товар"].tolist() == ["Табак 25", "Табак 250"]
+    assert df["Остаток"].iloc[0] == 1.5
+    assert pd.isna(df["Остаток"].iloc[1])
+
+
+def test_csv_encoding_is_chosen_before_rows_are_read(tmp_path):
+    path = tmp_path / "stock.csv"
+    lines = ["Товар;Остаток"] + [f"Tabak {i};{i}" for i in range(10_000)] + ["Табак последний;5"]
+    path.write_bytes("\n".join(lines).encode("cp1251"))
+    
+    df = read_table(str(path))
+    assert len(df) == 10_001
+    assert df["Товар"].iloc[-1] == "Табак последний"
+    assert df["Остаток"].dtype == "int64"
+
+
+def test_csv_text_columns_keep_their_text(tmp_path):
+    path = tmp_path / "stock.csv"
+    path.write_text("Товар;Остаток\n0123;1\nnan;2,5\n1,234;\nТабак;3\n", encoding="utf-8")
+    
+    df = read_table(str(path))
+    assert df["Товар"].tolist() == ["0123", "nan", "1,234", "Табак"]
+    assert df["Остаток"].tolist()[:2] == [1.0, 2.5] and pd.isna(df["Остаток"].iloc[2])
+
+
+def test_xlsx_error_cells_and_1904_dates(tmp_path):
+    workbook = Workbook()
+    workbook.epoch = datetime.datetime(1904, 1, 1)
+    sheet = workbook.active
+    sheet.append(["Товар", "Остаток", "Дата"])
+    sheet.append(["a", 1, datetime.datetime(2024, 1, 2)])
+    sheet.append(["b", "#N/A", datetime.datetime(2024, 1, 3)])
+    sheet["B3"].data_type = "e"
+    path = tmp_path / "stock.xlsx"
+    workbook.save(path)
+    
+    df = read_table(str(path))
+    assert df["Остаток"].iloc[0] == 1 and pd.isna(df["Остаток"].iloc[1])
+    assert df["Дата"].tolist() == [datetime.datetime(2024, 1, 2), datetime.datetime(2024, 1, 3)]
+    pd.testing.assert_frame_equal(df, pd.read_excel(path), check_dtype=False)
+
+
+def test_xlsx_with_thousands_of_rows_matches_pandas(tmp_path):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["Товар", "Остаток", "Цена", "Есть", "Комментарий"])
+    for i in range(6000):
+        if i % 997 == 0:
+            sheet.append([])
+            continue
+        sheet.append([
+            f"Табак {i} 25 г",
+            i % 50,
+            i / 8 if i % 3 else None,
+            i % 2 == 0,
+            "пусто" if i % 5 == 0 else None,
+        ])
+    sheet.append([])
+    path = tmp_path / "stock.xlsx"
+    workbook.save(path)
+    
+    result = read_table(str(path))
+    assert len(result) == 6000
+    pd.testing.assert_frame_equal(result, pd.read_excel(path), check_dtype=False)
+
+
+def test_xlsx_inline_strings_prefixed_tags_and_cells_without_references(tmp_path):
+    main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    package = "http://schemas.openxmlformats.org/package/2006/relationships"
+    sheet = (
+        f'<x:worksheet xmlns:x="{main}"><x:sheetData>'
+        '<x:row r="1"><x:c t="inlineStr"><x:is><x:t>Товар</x:t></x:is></x:c>'
+        '<x:c t="inlineStr"><x:is><x:t>Остаток</x:t></x:is></x:c></x:row>'
+        '<x:row r="2"><x:c r="A2" t="inlineStr"><x:is><x:r><x:t>Табак </x:t></x:r><x:r><x:t>25</x:t></x:r>'
+        '<x:rPh sb="0" eb="1"><x:t>タバコ</x:t></x:rPh></x:is></x:c>'
+        '<x:c r="B2"><x:f>1+2</x:f><x:v>3</x:v></x:c></x:row>'
+        '<x:row r="4"><x:c r="A4" t="str"><x:v>a &amp; b</x:v></x:c><x:c r="B4" t="b"><x:v>1</x:v></x:c></x:row>'
+        '</x:sheetData></x:worksheet>'
+    )
+    path = tmp_path / "stock.xlsx"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("xl/workbook.xml", (
+            f'<workbook xmlns="{main}" xmlns:r="{relationships}">'
+            '<sheets><sheet name="Лист1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ))
+        archive.writestr("xl/_rels/workbook.xml.rels", (
+            f'<Relationships xmlns="{package}"><Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+            f'Type="{relationships}/worksheet"/></Relationships>'
+        ))
+        archive.writestr("xl/worksheets/sheet1.xml", sheet)
+    
+    df = read_table(str(path))
+    assert list(df.columns) == ["Товар", "Остаток"]
+    assert df["Товар"].tolist()[0] == "Табак 25" and pd.isna(df["Товар"].iloc[1])
+    assert df["Товар"].iloc[2] == "a & b"
+    assert df["Остаток"].tolist()[0] == 3 and df["Остаток"].tolist()[2] is True
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import services.limits
+from services.limits import LimitConflictError, _limit_updates, dedupe_limits, merge_limits, rename_limit
+
+
+def test_dedupe_limits_keeps_last_entry_per_product():
+    limits = [
+        {"product": "a", "limit": 1},
+        {"product": "b", "limit": 2},
+        {"product": "a", "limit": 3},
+    ]
+    assert dedupe_limits(limits) == [{"product": "b", "limit": 2}, {"product": "a", "limit": 3}]
+    # What readers building a product -> limit dict already saw
+    assert {item["product"]: item["limit"] for item in dedupe_limits(limits)} == \
+        {item["product"]: item["limit"] for item in limits}
+
+
+def test_limit_updates_touch_a_single_element():
+    (in_place_filter, in_place), (append_filter, append) = _limit_updates({"id": "s1"}, "a/b", 5)
+    
+    assert in_place_filter == {"id": "s1", "limits.product": "a/b"}
+    assert in_place == {"$set": {"limits.$.limit": 5}, "$inc": {"limits_version": 1}}
+    assert append_filter == {"id": "s1", "limits.product": {"$ne": "a/b"}}
+    assert append["$push"] == {"limits": {"product": "a/b", "limit": 5}}
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    database = AsyncMongoMockClient()["limit_planner_test"]
+    monkeypatch.setattr(services.limits, "db", database)
+    asyncio.run(database.stores.insert_one({
+        "id": "s1",
+        "limits": [{"product": "a", "limit": 1}, {"product": "b", "limit": 2}],
+        "limits_version": 0,
+    }))
+    return database.stores
+
+
+def _limits(stores):
+    return asyncio.run(stores.find_one({"id": "s1"}))["limits"]
+
+
+def test_rename_limit_renames_in_place(stores):
+    assert asyncio.run(rename_limit("s1", "b", "c")) is True
+    assert _limits(stores) == [{"product": "a", "limit": 1}, {"product": "c", "limit": 2}]
+    assert asyncio.run(rename_limit("s1", "missing", "d")) is False
+    assert asyncio.run(rename_limit("nope", "a", "d")) is None
+
+
+def test_rename_limit_onto_listed_product_is_rejected(stores):
+    with pytest.raises(LimitConflictError):
+        asyncio.run(rename_limit("s1", "a", "b"))
+    # No duplicate entry and no version bump
+    assert _limits(stores) == [{"product": "a", "limit": 1}, {"product": "b", "limit": 2}]
+    assert asyncio.run(stores.find_one({"id": "s1"}))["limits_version"] == 0
+    assert asyncio.run(rename_limit("s1", "a", "a")) is True
+
+
+def test_concurrent_merges_of_a_new_product_both_apply(stores, monkeypatch):
+    original = type(stores).bulk_write
+    
+    async def interleaved_bulk_write(self, operations, ordered=True):
+        # One operation at a time, letting the other merge run in between, as the server may
+        matched = 0
+        for operation in operations:
+            matched += (await original(self, [operation], ordered=ordered)).matched_count
+            await asyncio.sleep(0)
+        return SimpleNamespace(matched_count=matched)
+    
+    monkeypatch.setattr(type(stores), "bulk_write", interleaved_bulk_write)
+    
+    async def merge_both():
+        # Both in-place updates miss, the first append wins, the second matches nothing
+        await asyncio.gather(
+            merge_limits("s1", [{"product": "c", "limit": 3}]),
+            merge_limits("s1", [{"product": "c", "limit": 4}]),
+        )
+    
+    asyncio.run(merge_both())
+    # One entry, holding the merge that finished last instead of losing it
+    assert _limits(stores) == [
+        {"product": "a", "limit": 1}, {"product": "b", "limit": 2}, {"product": "c", "limit": 4}
+    ]
+    assert asyncio.run(stores.find_one({"id": "s1"}))["limits_version"] == 2
+
+
+def test_merge_limits_into_every_store(stores):
+    asyncio.run(stores.insert_one({"id": "s2", "limits": [{"product": "c", "limit": 9}], "limits_version": 0}))
+    asyncio.run(merge_limits(None, [{"product": "c", "limit": 5}]))
+    assert _limits(stores)[-1] == {"product": "c", "limit": 5}
+    assert asyncio.run(stores.find_one({"id": "s2"}))["limits"] == [{"product": "c", "limit": 5}]
+    asyncio.run(merge_limits("missing", [{"product": "c", "limit": 1}]))
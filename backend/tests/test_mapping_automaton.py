@@ -0,0 +1,39 @@
+import random
+
+from services.mapping_automaton import SynonymAutomaton
+
+
+def naive_find_group(patterns, text):
+    ordered = sorted(patterns, key=lambda x: len(x[0]), reverse=True)
+    for pattern, group_id in ordered:
+        if pattern in text:
+            return group_id
+    return None
+
+
+def test_longest_pattern_wins():
+    patterns = [("кальян", "g0"), ("hookah", "g0"), ("кальян big", "g1"), ("чаша", "g2")]
+    automaton = SynonymAutomaton(patterns)
+    assert automaton.find_group("кальян big 3") == "g1"
+    assert automaton.find_group("кальян small") == "g0"
+    assert automaton.find_group("глиняная чаша") == "g2"
+    assert automaton.find_group("табак") is None
+
+
+def test_equal_length_keeps_mapping_order_and_empty_pattern_is_last_resort():
+    automaton = SynonymAutomaton([("abc", "g0"), ("bcd", "g1"), ("", "g2")])
+    assert automaton.find_group("xbcdabc") == "g0"
+    assert automaton.find_group("zzz") == "g2"
+
+
+def test_matches_naive_scan_on_random_patterns():
+    rng = random.Random(7)
+    alphabet = "абвг"
+    patterns = [
+        ("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))), f"group_{rng.randint(0, 9)}")
+        for _ in range(80)
+    ]
+    automaton = SynonymAutomaton(patterns)
+    for _ in range(1000):
+        text = "".join(rng.choice(alphabet + " ") for _ in range(rng.randint(0, 12)))
+        assert automaton.find_group(text) == naive_find_group(patterns, text), text
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import services.match_memo
+from services.match_memo import resolve_matches
+
+
+class _Matcher:
+    """Stands in for LimitMatcher: limit key is the name upper-cased, 'x' matches nothing"""
+    
+    def __init__(self):
+        self.computed = []
+    
+    def match_many(self, names):
+        self.computed.extend(names)
+        return {name: None if name == "x" else name.upper() for name in names}
+
+
+@pytest.fixture
+def match_cache(monkeypatch):
+    database = AsyncMongoMockClient()["limit_planner_test"]
+    monkeypatch.setattr(services.match_memo, "db", database)
+    monkeypatch.setattr(services.match_memo, "_collected_versions", {})
+    return database.match_cache
+
+
+def _versions(match_cache):
+    docs = asyncio.run(match_cache.find({}, {"_id": 0}).to_list(None))
+    return sorted((doc["limits_version"], doc["product"]) for doc in docs)
+
+
+def test_resolve_memoizes_matches_and_misses(match_cache):
+    store = {"id": "s1", "limits_version": 1}
+    matcher = _Matcher()
+    
+    assert asyncio.run(resolve_matches(store, matcher, ["a", "x", "a"])) == {"a": "A", "x": None}
+    assert asyncio.run(resolve_matches(store, matcher, ["x", "b", "a"])) == {"x": None, "b": "B", "a": "A"}
+    assert matcher.computed == ["a", "x", "b"]
+    assert _versions(match_cache) == [(1, "a"), (1, "b"), (1, "x")]
+
+
+def test_stale_entries_are_collected_without_touching_newer_limits(match_cache):
+    asyncio.run(resolve_matches({"id": "s1", "limits_version": 1}, _Matcher(), ["a"]))
+    asyncio.run(resolve_matches({"id": "s2", "limits_version": 1}, _Matcher(), ["a"]))
+    asyncio.run(resolve_matches({"id": "s1", "limits_version": 2}, _Matcher(), ["b"]))
+    assert _versions(match_cache) == [(1, "a"), (2, "b")]
+    
+    # A request that read the store before the limits changed
+    asyncio.run(resolve_matches({"id": "s1", "limits_version": 1}, _Matcher(), ["c"]))
+    assert (2, "b") in _versions(match_cache)
+    assert services.match_memo._collected_versions == {"s1": 2, "s2": 1}
@@ -0,0 +1,115 @@
+import asyncio
+import random
+import threading
+
+import services.matching as matching
+from services.matching import LimitMatcher, MatcherCache, find_best_match_improved, get_store_matcher
+
+
+LIMITS = {
+    "Дарксайд 25": 5,
+    "Дарксайд 250": 3,
+    "Adalya 50": 10,
+    "Adalya": 4,
+    "Табак Must Have 25": 6,
+    "Must Have": 2,
+    "Уголь 72": 8,
+    "уголь 72": 1,
+    "Кальян": 7,
+    "Чаша": 2,
+    "Spectrum 40": 9,
+    "": 1,
+    "---": 1,
+}
+
+PRODUCTS = [
+    "Дарксайд 25",
+    "Табак Дарксайд Core 25 г",
+    "Табак Дарксайд 250 г",
+    "Табак для кальяна Adalya 50 г Love 66",
+    "Adalya Lady Killer 20",
+    "УГОЛЬ 72 шт",
+    "Кальянная чаша глиняная",
+    "Must Have Pinkman 25",
+    "Spectrum Hard 40 г",
+    "Неизвестный товар",
+    "",
+    "57595925",
+]
+
+
+def test_matcher_agrees_with_reference_on_known_products():
+    matcher = LimitMatcher(LIMITS)
+    for product in PRODUCTS:
+        assert matcher.match(product) == find_best_match_improved(product, LIMITS), product
+
+
+def test_matcher_distinguishes_numbers():
+    matcher = LimitMatcher(LIMITS)
+    assert matcher.match("Табак Дарксайд 250 г") == "Дарксайд 250"
+    assert matcher.match("Табак Дарксайд Core 25 г") == "Дарксайд 25"
+
+
+def test_matcher_agrees_with_reference_on_random_names():
+    rng = random.Random(42)
+    words = ["табак", "дарк", "дарксайд", "adalya", "must", "have", "уголь", "кальян",
+             "чаша", "lady", "core", "spectrum", "hard", "г", "шт"]
+    numbers = ["2", "20", "25", "250", "40", "50", "72"]
+
+    def name():
+        parts = rng.sample(words, rng.randint(1, 3)) + rng.sample(numbers, rng.randint(0, 2))
+        rng.shuffle(parts)
+        return " ".join(parts)
+
+    limits = {name(): rng.randint(0, 10) for _ in range(60)}
+    matcher = LimitMatcher(limits)
+    for _ in range(500):
+        product = name()
+        assert matcher.match(product) == find_best_match_improved(product, limits), product
+
+
+def test_matcher_cache_keys_on_limits_version():
+    cache = MatcherCache(maxsize=2)
+    store = {"id": "s1", "limits_version": 1, "limits": [{"product": "Кальян", "limit": 3}]}
+
+    first = cache.get(store)
+    assert cache.get(store) is first
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    bumped = dict(store, limits_version=2, limits=[{"product": "Чаша", "limit": 1}])
+    assert cache.get(bumped).match("Чаша глиняная") == "Чаша"
+
+    cache.get({"id": "s2", "limits": []})
+    assert cache.stats()["size"] == 2
+    cache.get(store)
+    assert cache.stats()["misses"] == 4
+
+
+def test_store_matcher_is_compiled_off_the_event_loop(monkeypatch):
+    compiled_in = []
+
+    class RecordingMatcher(LimitMatcher):
+        def __init__(self, limits_dict):
+            compiled_in.append(threading.current_thread())
+            super().__init__(limits_dict)
+
+    monkeypatch.setattr(matching, "LimitMatcher", RecordingMatcher)
+    monkeypatch.setattr(matching, "matcher_cache", MatcherCache())
+    store = {"id": "s1", "limits_version": 1, "limits": [{"product": "Кальян", "limit": 3}]}
+
+    async def get_twice():
+        return await get_store_matcher(store), await get_store_matcher(store), threading.current_thread()
+
+    first, second, loop_thread = asyncio.run(get_twice())
+    assert first is second and first.match("Кальян big") == "Кальян"
+    assert len(compiled_in) == 1 and compiled_in[0] is not loop_thread
+    assert matching.matcher_cache.stats()["hits"] == 1
+
+
+def test_exact_index_collisions_keep_first_key():
+    limits = {"Уголь 72": 1, " уголь 72 ": 2, "УГОЛЬ 72": 3}
+    matcher = LimitMatcher(limits)
+    assert matcher.find_exact("уголь 72") == "Уголь 72"
+    assert matcher.find_exact("УГОЛЬ 72") == "УГОЛЬ 72"
+    assert matcher.exact_collisions == {"уголь 72": ["Уголь 72", " уголь 72 ", "УГОЛЬ 72"]}
+    assert matcher.match_many(["уголь 72", "уголь 72", "Чаша"]) == {"уголь 72": "Уголь 72", "Чаша": None}
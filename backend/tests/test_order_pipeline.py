@@ -0,0 +1,115 @@
+import asyncio
+import io
+import json
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+from services.filter_engine import compile_filters
+from services.order_pipeline import OrderPipeline, OrderPipelineError
+
+STORE = {
+    "id": "s1",
+    "name": "Точка",
+    "limits": [
+        {"product": "a", "limit": 10},
+        {"product": "b", "limit": 5},
+        {"product": "c", "limit": 3},
+        {"product": "z", "limit": 0},
+    ],
+    "limits_version": 0,
+}
+# a: 10 - 4 = 6, b: 5 - 7 clipped to 0, c: 3 - 1 = 2, z: limit 0, d: no limit
+STOCK = [("a", 4), ("b", 7), ("c", 1), ("z", 0), ("d", 2)]
+
+
+@pytest.fixture
+def store(db):
+    asyncio.run(db.stores.insert_one(dict(STORE)))
+    return STORE
+
+
+def _rows(response):
+    assert response.status_code == 200, response.text
+    sheet = load_workbook(io.BytesIO(response.content)).active
+    return [list(row) for row in sheet.iter_rows(values_only=True)]
+
+
+def _process_text(client, filters=(), seller_request=None, stock=STOCK):
+    return client.post("/api/process-text", json={
+        "store_id": "s1",
+        "data": [{"product": product, "stock": value} for product, value in stock],
+        "filter_expressions": list(filters),
+        "seller_request": seller_request,
+    })
+
+
+def _process_file(client, filters=(), seller_request="", stock=STOCK):
+    csv = pd.DataFrame(stock, columns=["Товар", "Остаток"]).to_csv(index=False).encode("utf-8")
+    return client.post(
+        "/api/process",
+        params={"store_id": "s1", "filter_expressions": json.dumps(list(filters)), "seller_request": seller_request},
+        files={"file": ("order.csv", csv)},
+    )
+
+
+def _orders(db):
+    return asyncio.run(db.order_history.find({}, {"_id": 0}).sort("created_at", 1).to_list(None))
+
+
+def test_text_and_file_entry_points_give_the_same_order(client, store, db):
+    expected = [["Точка", "Заказ"], ["a", 6], ["c", 2]]
+    assert _rows(_process_text(client)) == expected
+    assert _rows(_process_file(client)) == expected
+    
+    text_order, file_order = _orders(db)
+    assert text_order["items"] == file_order["items"] == [
+        {"product": "a", "stock": 4.0, "order": 6.0, "limit": 10.0, "is_seller_request": False},
+        {"product": "c", "stock": 1.0, "order": 2.0, "limit": 3.0, "is_seller_request": False},
+    ]
+
+
+def test_filters_apply_to_the_computed_order(client, store):
+    assert _rows(_process_text(client, ["Заказ >= 3"])) == [["Точка", "Заказ"], ["a", 6]]
+    assert _rows(_process_file(client, ["Остаток < Лимиты / 2"])) == [["Точка", "Заказ"], ["a", 6], ["c", 2]]
+
+
+def test_seller_lines_come_last_without_limits_or_filters(client, store, db):
+    rows = _rows(_process_text(client, ["Заказ >= 3"], seller_request=" x \n\n y\n"))
+    assert rows == [["Точка", "Заказ"], ["a", 6], ["x", 0], ["y", 0]]
+    
+    items = _orders(db)[0]["items"]
+    assert items[1:] == [
+        {"product": "x", "stock": 0.0, "order": 0.0, "limit": 0.0, "is_seller_request": True},
+        {"product": "y", "stock": 0.0, "order": 0.0, "limit": 0.0, "is_seller_request": True},
+    ]
+
+
+def test_no_matched_limits_and_nothing_to_order_are_400(client, store, db):
+    for process in (_process_text, _process_file):
+        response = process(client, stock=[("d", 1), ("z", 0)])
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Не найдено товаров с лимитами")
+        
+        response = process(client, ["Заказ > 100"])
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Не найдено товаров для заказа."
+    assert _orders(db) == []
+
+
+def test_run_without_persist_leaves_the_writes_to_the_caller(store, db):
+    frame = OrderPipeline.ingest_frame(pd.DataFrame(STOCK, columns=["Товар", "Остаток"]))
+    pipeline = OrderPipeline(STORE, compile_filters([]), record_stock_history=True)
+    
+    result = asyncio.run(pipeline.run(frame, persist=False))
+    assert result.df["Заказ"].tolist() == [6, 2]
+    assert result.order["items"][0]["product"] == "a"
+    assert [entry["product"] for entry in result.stock_history] == ["a", "b", "c", "z", "d"]
+    assert _orders(db) == [] and asyncio.run(db.stock_latest.count_documents({})) == 0
+    
+    # Stock seen before the pipeline gave up stays available to the caller
+    failing = OrderPipeline(STORE, compile_filters(["Заказ > 100"]), record_stock_history=True)
+    with pytest.raises(OrderPipelineError):
+        asyncio.run(failing.run(frame, persist=False))
+    assert len(failing.stock_history) == 5
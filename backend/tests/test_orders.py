@@ -0,0 +1,78 @@
+import asyncio
+import io
+import json
+import zipfile
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from routes.orders import archive_entry_name
+
+
+def test_archive_entry_names_are_safe_and_unique():
+    used = {"summary.json"}
+    names = [
+        archive_entry_name({"id": "s1", "name": "Ленина 5/2"}, used),
+        archive_entry_name({"id": "s2", "name": "Ленина 5_2"}, used),
+        archive_entry_name({"id": "s3", "name": "../..\\x:y"}, used),
+        archive_entry_name({"id": "s4", "name": " .. "}, used),
+        archive_entry_name({"id": "s5", "name": "summary"}, used),
+        archive_entry_name({"id": "s6", "name": "ЛЕНИНА 5_2"}, used),
+    ]
+    assert names == [
+        "Ленина 5_2.xlsx",
+        "Ленина 5_2 (s2).xlsx",
+        "_.._x_y.xlsx",
+        "s4.xlsx",
+        "summary.xlsx",
+        "ЛЕНИНА 5_2 (s6).xlsx",
+    ]
+
+
+def test_process_all_archives_successes_and_failures(client, db, monkeypatch):
+    stores = [
+        {"id": "s1", "name": "Ленина 5/2", "limits": [{"product": "a", "limit": 10}]},
+        {"id": "s2", "name": "Ленина 5_2", "limits": [{"product": "b", "limit": 10}]},
+        {"id": "s3", "name": "Пустая", "limits": []},
+    ]
+    asyncio.run(db.stores.insert_many([dict(store) for store in stores]))
+    stock = pd.DataFrame({
+        "Товар": ["a", "b"], "Ленина 5/2": [4, 1], "Ленина 5_2": [2, 3], "Пустая": [5, 6], "Электро": [9, 9]
+    })
+    upload = client.post("/api/global-stock/upload", files={"file": ("stock.csv", stock.to_csv(index=False).encode())})
+    assert upload.status_code == 200, upload.text
+    asyncio.run(db.stock_latest.delete_many({}))
+    
+    inserts = []
+    collection_type = type(db.order_history)
+    insert_many = collection_type.insert_many
+    
+    def counting_insert_many(self, documents, *args, **kwargs):
+        if self.name == "order_history":
+            inserts.append(len(documents))
+        return insert_many(self, documents, *args, **kwargs)
+    
+    monkeypatch.setattr(collection_type, "insert_many", counting_insert_many)
+    response = client.post("/api/process-all", json={"store_ids": ["s1", "s2", "s3"]})
+    assert response.status_code == 200, response.text
+    
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == ["summary.json", "Ленина 5_2 (s2).xlsx", "Ленина 5_2.xlsx"]
+    summary = {entry["store_id"]: entry for entry in json.loads(archive.read("summary.json"))}
+    assert summary["s1"]["file"] == "Ленина 5_2.xlsx" and summary["s1"]["total_order"] == 6
+    assert summary["s2"]["file"] == "Ленина 5_2 (s2).xlsx" and summary["s2"]["total_order"] == 7
+    assert summary["s3"]["error"].startswith("Не найдено товаров с лимитами") and "file" not in summary["s3"]
+    
+    sheet = load_workbook(io.BytesIO(archive.read("Ленина 5_2.xlsx"))).active
+    assert [list(row) for row in sheet.iter_rows(values_only=True)] == [["Ленина 5/2", "Заказ"], ["a", 6]]
+    
+    orders = asyncio.run(db.order_history.find({}, {"_id": 0}).to_list(None))
+    assert inserts == [2]
+    assert sorted(order["store_id"] for order in orders) == ["s1", "s2"]
+    assert {order["id"] for order in orders} == {summary["s1"]["order_id"], summary["s2"]["order_id"]}
+    
+    # Every store's stock is recorded, including the one that could not be ordered
+    latest = asyncio.run(db.stock_latest.find({}, {"_id": 0, "store_id": 1, "product": 1, "stock": 1}).to_list(None))
+    assert sorted((doc["store_id"], doc["product"], doc["stock"]) for doc in latest) == [
+        ("s1", "a", 4), ("s1", "b", 1), ("s2", "a", 2), ("s2", "b", 3), ("s3", "a", 5), ("s3", "b", 6)
+    ]
@@ -0,0 +1,70 @@
+import asyncio
+
+import pandas as pd
+import pytest
+
+import services.processing as processing
+from services.processing import apply_product_mappings
+
+
+def _apply(df):
+    return asyncio.run(apply_product_mappings(df))
+
+
+def test_merge_report_lists_each_group_found(db):
+    asyncio.run(db.product_mappings.insert_many([
+        {"main_product": "Табак 25", "synonyms": ["табак 25"]},
+        {"main_product": "Чаша", "synonyms": ["чаша глиняная"]},
+    ]))
+    df = pd.DataFrame({
+        "Товар": ["Табак 25 синий", "Уголь", "Табак 25 син.", "Чаша глиняная"],
+        "Остаток": [3.0, 4.0, 2.0, 1.0],
+    })
+    
+    result, report = _apply(df)
+    assert result.to_dict("list") == {
+        "Товар": ["Табак 25 синий", "Чаша глиняная", "Уголь"],
+        "Остаток": [5.0, 1.0, 4.0],
+    }
+    assert report == [
+        {"group": "Табак 25", "product": "Табак 25 синий", "source_rows": 2, "stock": 5.0},
+        {"group": "Чаша", "product": "Чаша глиняная", "source_rows": 1, "stock": 1.0},
+    ]
+
+
+def test_nothing_mapped_keeps_rows_and_reports_nothing(db):
+    asyncio.run(db.product_mappings.insert_one({"main_product": "Чаша", "synonyms": []}))
+    df = pd.DataFrame({"Товар": ["Уголь", "Табак"], "Остаток": [4.0, 1.0]})
+    
+    result, report = _apply(df)
+    assert report == []
+    pd.testing.assert_frame_equal(result, df)
+
+
+def test_every_group_is_merged_without_a_cap(db):
+    asyncio.run(db.product_mappings.insert_many([
+        {"main_product": f"Марка{i:03d}", "synonyms": []} for i in range(150)
+    ]))
+    df = pd.DataFrame({
+        "Товар": [f"Марка{i:03d} {flavour}" for i in range(150) for flavour in ("мята", "дыня")],
+        "Остаток": [1.0, 2.0] * 150,
+    })
+    
+    result, report = _apply(df)
+    assert len(result) == 150 and result["Остаток"].tolist() == [3.0] * 150
+    assert len(report) == 150
+    assert {entry["group"] for entry in report} == {f"Марка{i:03d}" for i in range(150)}
+    assert all(entry["source_rows"] == 2 and entry["stock"] == 3.0 for entry in report)
+
+
+def test_automaton_failure_is_not_hidden(db, monkeypatch):
+    class BrokenAutomaton:
+        def find_group(self, text):
+            raise RuntimeError("automaton is broken")
+    
+    async def broken_automaton():
+        return BrokenAutomaton(), {}
+    
+    monkeypatch.setattr(processing, "get_mapping_automaton", broken_automaton)
+    with pytest.raises(RuntimeError, match="automaton is broken"):
+        _apply(pd.DataFrame({"Товар": ["Уголь"], "Остаток": [4.0]}))
@@ -0,0 +1,225 @@
+import asyncio
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from database import create_indexes
+from services.downsample import lttb_indices
+from services.global_stock import history_frame, stock_matrix
+from services.stock_history import (
+    bucket_entries, bucket_operations, downsample_series, history_mask, rollup_operations, select_history_entries,
+    step_series, update_latest_stocks
+)
+
+
+def test_history_mask_keeps_new_changed_and_keyframe_rows():
+    stock = stock_matrix(pd.DataFrame({"Товар": ["a", "b", "c", "d"], "S1": [5, 1, 2, 3]}))
+    latest = {
+        ("id1", "a"): {"stock": 5.0, "recorded_at": "2024-01-09T00:00:00+00:00"},
+        ("id1", "b"): {"stock": 4.0, "recorded_at": "2024-01-09T00:00:00+00:00"},
+        ("id1", "c"): {"stock": 2.0, "recorded_at": "2024-01-01T00:00:00+00:00"},
+    }
+    history = history_frame(stock, {"S1": "id1"}, {key: doc["stock"] for key, doc in latest.items()})
+    mask = history_mask(history, "2024-01-10T00:00:00+00:00", latest)
+    
+    # a unchanged, b changed, c unchanged but its last entry is older than a keyframe period, d new
+    assert history["product"][mask].tolist() == ["b", "c", "d"]
+
+
+def test_select_history_entries_fills_previous_stock():
+    latest = {("id1", "a"): {"stock": 3, "recorded_at": "2024-01-09T00:00:00+00:00"}}
+    entries = [
+        {"store_id": "id1", "product": "a", "stock": 3, "recorded_at": "2024-01-10T00:00:00+00:00"},
+        {"store_id": "id1", "product": "b", "stock": 2, "recorded_at": "2024-01-10T00:00:00+00:00"},
+    ]
+    assert select_history_entries(entries, latest) == [
+        {"store_id": "id1", "product": "b", "stock": 2, "prev_stock": 0, "change": 2,
+         "recorded_at": "2024-01-10T00:00:00+00:00"},
+    ]
+    assert entries[0]["prev_stock"] == 3 and entries[0]["change"] == 0
+
+
+def test_step_series_carries_values_to_uploads_without_entries():
+    def entry(stock, day):
+        return {"store_id": "id1", "store_name": "S1", "product": "a", "stock": stock,
+                "prev_stock": 0, "change": stock, "recorded_at": f"2024-01-0{day}T00:00:00+00:00"}
+    
+    ingests = [f"2024-01-0{day}T00:00:00+00:00" for day in (2, 3, 4, 5)]
+    series = step_series([entry(7, 4)], base=entry(5, 1), ingest_times=ingests)
+    
+    assert [(point["recorded_at"][:10], point["stock"], point["change"]) for point in series] == [
+        ("2024-01-02", 5, 0), ("2024-01-03", 5, 0), ("2024-01-04", 7, 7), ("2024-01-05", 7, 0),
+    ]
+    # Nothing is known before the first entry
+    assert step_series([entry(7, 4)], base=None, ingest_times=ingests)[0]["recorded_at"].startswith("2024-01-04")
+
+
+def test_bucket_operations_group_entries_by_store_product_and_utc_day():
+    entries = [
+        {"store_id": "id1", "store_name": "S1", "product": "a", "stock": 1, "prev_stock": 0, "change": 1,
+         "recorded_at": "2024-01-10T08:00:00+00:00"},
+        {"store_id": "id1", "store_name": "S1", "product": "a", "stock": 2, "prev_stock": 1, "change": 1,
+         "recorded_at": "2024-01-10T23:30:00-03:00"},
+    ]
+    operations = bucket_operations(entries)
+    
+    assert [op._filter for op in operations] == [
+        {"store_id": "id1", "product": "a", "day": datetime(2024, 1, 10, tzinfo=timezone.utc)},
+        {"store_id": "id1", "product": "a", "day": datetime(2024, 1, 11, tzinfo=timezone.utc)},
+    ]
+    bucket = {"store_id": "id1", "store_name": "S1", "product": "a",
+              "points": operations[0]._doc["$push"]["points"]["$each"]}
+    assert bucket_entries(bucket) == [{
+        "store_id": "id1", "store_name": "S1", **entries[0],
+        "recorded_at": datetime(2024, 1, 10, 8, tzinfo=timezone.utc)
+    }]
+
+
+def test_lttb_keeps_endpoints_and_spikes():
+    x = np.arange(100, dtype=float)
+    y = np.zeros(100)
+    y[37] = 50
+    kept = lttb_indices(x, y, 10)
+    
+    assert len(kept) == 10 and kept[0] == 0 and kept[-1] == 99 and 37 in kept
+    assert np.all(np.diff(kept) > 0)
+    assert lttb_indices(x[:5], y[:5], 10).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_downsample_series_bounds_points():
+    series = [{"recorded_at": f"2024-01-01T00:{minute:02d}:00+00:00", "stock": minute % 7} for minute in range(60)]
+    
+    assert len(downsample_series(series, 12)) == 12
+    assert downsample_series(series, 100) is series
+
+
+def test_downsample_series_folds_dropped_changes():
+    stocks = [minute % 7 + (minute // 10) for minute in range(60)]
+    series = [{
+        "recorded_at": f"2024-01-01T00:{minute:02d}:00+00:00",
+        "stock": stock,
+        "prev_stock": stocks[minute - 1] if minute else 0,
+        "change": stock - (stocks[minute - 1] if minute else 0),
+    } for minute, stock in enumerate(stocks)]
+    
+    downsampled = downsample_series(series, 12)
+    assert sum(point["change"] for point in downsampled) == sum(point["change"] for point in series)
+    for previous, point in zip(downsampled, downsampled[1:]):
+        assert point["prev_stock"] == previous["stock"]
+        assert point["change"] == point["stock"] - point["prev_stock"]
+    # The input series is left as it was
+    assert all(point["change"] == point["stock"] - point["prev_stock"] for point in series[1:])
+
+
+def test_rollup_operations_net_change_per_store_day_product():
+    def entry(product, change, time):
+        return {"store_id": "id1", "store_name": "S1", "product": product, "stock": 5, "prev_stock": 5 - change,
+                "change": change, "recorded_at": f"2024-01-10T{time}:00+00:00"}
+    
+    operations = rollup_operations([entry("a", 2, "08:00"), entry("b", 0, "08:00"), entry("a", -1, "20:00")])
+    day = datetime(2024, 1, 10, tzinfo=timezone.utc)
+    
+    assert [(op._filter, op._doc) for op in operations] == [
+        ({"store_id": "id1", "day": day, "product": "a"}, {"$inc": {"change": 1}}),
+    ]
+
+
+def test_pipeline_and_upload_stock_of_a_mapped_product_do_not_swing(client, db):
+    # Both names contain the synonym, so the order pipeline merges them into one row of 5
+    asyncio.run(db.product_mappings.insert_one({"main_product": "Табак 25", "synonyms": ["табак 25"]}))
+    asyncio.run(db.stores.insert_one({"id": "s1", "name": "S1", "limits": [{"product": "Табак 25 синий", "limit": 9}]}))
+    stock = pd.DataFrame({"Товар": ["Табак 25 синий", "Табак 25 син."], "S1": [3, 2], "Электро": [9, 9]})
+    
+    def upload():
+        response = client.post("/api/global-stock/upload", files={"file": ("stock.csv", stock.to_csv(index=False).encode())})
+        assert response.status_code == 200, response.text
+    
+    upload()
+    response = client.post("/api/process-text", json={"store_id": "s1", "use_global_stock": True})
+    assert response.status_code == 200, response.text
+    upload()
+    
+    buckets = asyncio.run(db.stock_history_buckets.find({"store_id": "s1"}, {"_id": 0}).to_list(None))
+    changes = {bucket["product"]: [point["change"] for point in bucket["points"]] for bucket in buckets}
+    # Only the first observation of each row; nothing moved afterwards
+    assert changes == {"Табак 25 синий": [3], "Табак 25 син.": [2]}
+    rollups = asyncio.run(db.stock_store_daily.find({"store_id": "s1"}, {"_id": 0, "product": 1, "change": 1}).to_list(None))
+    assert sorted((doc["product"], doc["change"]) for doc in rollups) == [("Табак 25 син.", 2), ("Табак 25 синий", 3)]
+
+
+def _latest(db):
+    return {
+        (doc["store_id"], doc["product"]): (doc["stock"], doc["recorded_at"])
+        for doc in asyncio.run(db.stock_latest.find({}, {"_id": 0}).to_list(None))
+    }
+
+
+def test_update_latest_stocks_never_goes_back_in_time(db):
+    asyncio.run(create_indexes())
+    
+    def entry(product, stock, day):
+        return {"store_id": "id1", "store_name": "S1", "product": product, "stock": stock,
+                "recorded_at": datetime(2024, 1, day, tzinfo=timezone.utc)}
+    
+    asyncio.run(update_latest_stocks([entry("a", 5, 10)]))
+    # Back-dated a loses to the newer document (its upsert hits the unique key); new b is written
+    asyncio.run(update_latest_stocks([entry("a", 9, 9), entry("b", 1, 9)]))
+    assert _latest(db) == {
+        ("id1", "a"): (5, datetime(2024, 1, 10, tzinfo=timezone.utc)),
+        ("id1", "b"): (1, datetime(2024, 1, 9, tzinfo=timezone.utc)),
+    }
+    
+    asyncio.run(update_latest_stocks([entry("a", 7, 10), entry("b", 2, 11)]))
+    assert _latest(db) == {
+        ("id1", "a"): (7, datetime(2024, 1, 10, tzinfo=timezone.utc)),
+        ("id1", "b"): (2, datetime(2024, 1, 11, tzinfo=timezone.utc)),
+    }
+
+
+def test_backfill_matches_previous_stock_aggregation(db):
+    from migrations.backfill_stock_latest import backfill
+    
+    history = []
+    for store_id in ("id1", "id2"):
+        for product, stocks in (("a", [1, 4, 2]), ("b", [3]), ("c", [0, 6])):
+            previous = 0
+            for day, stock in enumerate(stocks, start=1):
+                history.append({
+                    "store_id": store_id, "store_name": store_id.upper(), "product": product, "stock": stock,
+                    "prev_stock": previous, "change": stock - previous,
+                    "recorded_at": datetime(2024, 1, day, tzinfo=timezone.utc)
+                })
+                previous = stock
+    # Entries from before prev_stock/change were stored, written out of order
+    del history[3]["prev_stock"], history[3]["change"]
+    history.reverse()
+    asyncio.run(db.stock_history.insert_many(history))
+    
+    async def previous_aggregation(store_id):
+        # What GET /stores/{id}/stock-history ran over stock_history before stock_latest
+        return await db.stock_history.aggregate([
+            {"$match": {"store_id": store_id}},
+            {"$sort": {"recorded_at": -1}},
+            {"$group": {
+                "_id": "$product",
+                "latest_stock": {"$first": "$stock"},
+                "prev_stock": {"$first": {"$ifNull": ["$prev_stock", 0]}},
+                "change": {"$first": {"$ifNull": ["$change", 0]}},
+                "last_updated": {"$first": "$recorded_at"}
+            }}
+        ]).to_list(None)
+    
+    expected = {
+        (store_id, doc["_id"]): (doc["latest_stock"], doc["prev_stock"], doc["change"], doc["last_updated"])
+        for store_id in ("id1", "id2")
+        for doc in asyncio.run(previous_aggregation(store_id))
+    }
+    assert asyncio.run(backfill()) == 6
+    latest = {
+        (doc["store_id"], doc["product"]): (doc["stock"], doc["prev_stock"], doc["change"], doc["recorded_at"])
+        for doc in asyncio.run(db.stock_latest.find({}, {"_id": 0}).to_list(None))
+    }
+    assert latest == expected
+    assert latest[("id1", "a")] == (2, 4, -2, datetime(2024, 1, 3, tzinfo=timezone.utc))
+    assert latest[("id1", "b")] == (3, 0, 0, datetime(2024, 1, 1, tzinfo=timezone.utc))
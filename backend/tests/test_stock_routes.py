@@ -0,0 +1,38 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
+
+def _order(store_id, days_ago, *items):
+    return {
+        "id": f"{store_id}-{days_ago}-{len(items)}",
+        "store_id": store_id,
+        "created_at": datetime.now(timezone.utc) - timedelta(days=days_ago),
+        "items": [{"product": product, "stock": 0.0, "order": order, "limit": 10.0, "is_seller_request": False}
+                  for product, order in items],
+    }
+
+
+def test_product_history_returns_only_the_products_order_lines(client, db):
+    asyncio.run(db.stores.insert_one({"id": "s1", "name": "Точка", "limits": []}))
+    asyncio.run(db.order_history.insert_many([
+        _order("s1", 2, ("Табак 25", 6.0), ("Табак 250", 4.0)),
+        _order("s1", 1, ("Табак 250", 3.0), ("Табак 25", 1.0)),
+        _order("s1", 1, ("Уголь", 5.0)),
+        _order("s1", 20, ("Табак 25", 8.0)),
+        _order("s2", 1, ("Табак 25", 9.0)),
+    ]))
+    
+    response = client.get(f"/api/stores/s1/stock-history/{quote('Табак 25')}", params={"period": "week"})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body["product"] == "Табак 25" and body["store_name"] == "Точка"
+    assert [entry["order"] for entry in body["order_history"]] == [6.0, 1.0]
+    assert body["stock_history"] == []
+    
+    response = client.get(f"/api/stores/s1/stock-history/{quote('Табак 25')}", params={"period": "month"})
+    assert [entry["order"] for entry in response.json()["order_history"]] == [8.0, 6.0, 1.0]
+
+
+def test_product_history_of_unknown_store_is_404(client):
+    assert client.get("/api/stores/missing/stock-history/a").status_code == 404
@@ -0,0 +1,41 @@
+import io
+import math
+
+import numpy
+from openpyxl import load_workbook
+
+from services.xlsx_writer import iter_xlsx
+
+
+def _load(chunks):
+    return load_workbook(io.BytesIO(b"".join(chunks)))
+
+
+def test_round_trip_through_openpyxl():
+    rows = [
+        ['<a & "b">', "tab\there\x01\x0b", 3, 2.5],
+        [None, math.nan, numpy.int64(7), numpy.float64(0.1)],
+        ["0123", "1e5", True, -math.inf],
+    ]
+    workbook = _load(iter_xlsx('Лист "1" & <2>', ["Товар", "Заказ", "Кол-во", "Цена"], iter(rows), chunk_size=16))
+    sheet = workbook.active
+    
+    assert sheet.title == 'Лист "1" & <2>'
+    assert [list(row) for row in sheet.iter_rows(values_only=True)] == [
+        ["Товар", "Заказ", "Кол-во", "Цена"],
+        # Markup is escaped, control characters XML cannot carry are dropped
+        ['<a & "b">', "tab\there", 3, 2.5],
+        # NaN and None leave the cell empty; numpy scalars are written as numbers
+        [None, None, 7, 0.1],
+        # Numeric-looking text stays text
+        ["0123", "1e5", True, None],
+    ]
+    assert sheet["C2"].data_type == "n" and sheet["A4"].data_type == "s"
+
+
+def test_every_cell_shares_the_bold_style_unless_disabled():
+    sheet = _load(iter_xlsx("s", ["Товар", "Заказ"], [["a", 1]])).active
+    assert all(cell.font.b for row in sheet.iter_rows() for cell in row)
+    
+    plain = _load(iter_xlsx("s", ["Товар", "Заказ"], [["a", 1]], style=None)).active
+    assert not any(cell.font.b for row in plain.iter_rows() for cell in row)